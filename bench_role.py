@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+PatientRoleProviderの処理時間とメモリ使用量を、患者データの大きさを変えて測る。
+
+合成した患者データ (患者数、行動履歴の日数、1日分の文字数を指定) を一時ディレクトリに作り、
+以下をJSONで出力する。
+
+- initialize: 読み込み元から (cold) と、FrameCacheから (warm) の読み込み時間。
+  memoryはtracemallocで測ったcoldの読み込み中の最大量と、読み込み後に残った量。
+- get_patient_prompt_chunks: prompt_cacheに無い場合 (miss) とある場合 (hit)。
+  調査日は最後の日にして、全ての日の行動履歴を含める。
+- get_patient_details, get_available_patient_ids, _split_text_for_prompt
+- scaling: 日数と文字数が同じ組のうち、患者数が最小と最大の組の間で、
+  時間 (またはメモリ) が患者数の何乗で増えているか。1に近ければ線形。
+
+患者数などはカンマ区切りで複数指定でき、全ての組み合わせを測る。
+日数がPatientRoleProviderの日付の列 (2022-04-02から2022-04-30) より多い場合は、
+日付の列を増やした場合として、providerの列を増やして測る。
+
+    python bench_role.py -n 100,1000,5000 -d 29 -l 200 -o role.json
+"""
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from itertools import product
+from math import log
+from time import perf_counter
+from typing import List
+
+from chatconf import ChatConfigModel
+from framecache import FrameCache
+from lazyimport import lazy_import
+from modelRole import PatientRoleProvider
+from rolesource import create_role_source
+
+pd = lazy_import("pandas")
+
+FIRST_DAY = datetime(2022, 4, 2)
+SPLIT_MAX_LENGTH = 2000
+SENTENCES = [
+    "朝は自宅で家族と食事をした。", "電車で職場に向かった。", "昼は同僚と近くの店で食事をした。",
+    "午後は会議に出席した。", "帰りにスーパーで買い物をした。", "夜は自宅で過ごした。",
+    "友人と電話で話した。", "体温は36度台だった。", "少しのどに違和感があった。", "早めに就寝した。",
+]
+PREFECTURES = ["東京都", "神奈川県", "千葉県", "埼玉県", "大阪府", "愛知県", "福岡県"]
+
+def make_text(rng: random.Random, length: int) -> str:
+    """句点と改行を含む、length文字の行動履歴。"""
+    parts = []
+    size = 0
+    while size < length:
+        sentence = rng.choice(SENTENCES)
+        if rng.random() < 0.2:
+            sentence += "\n"
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)[:length]
+
+def make_frame(patients: int, days: int, text_length: int, seed: int) -> pd.DataFrame:
+    rng = random.Random(seed)
+    day_columns = [FIRST_DAY + timedelta(days=i) for i in range(days)]
+    rows = []
+    for i in range(1, patients + 1):
+        onset = FIRST_DAY + timedelta(days=rng.randrange(max(1, days)))
+        row = {
+            "ID": i,
+            "氏名": f"患者{i:05d}",
+            "年齢": rng.randrange(10, 90),
+            "生年月日": datetime(1940 + rng.randrange(70), 1 + rng.randrange(12), 1 + rng.randrange(28)),
+            "性別": rng.choice(["男", "女"]),
+            "変換後都道府県": rng.choice(PREFECTURES),
+            "プロフィール": make_text(rng, 100),
+            "感染日": onset - timedelta(days=2),
+            "発症日": onset,
+        }
+        for day in day_columns:
+            row[day] = make_text(rng, text_length)
+        row["（旅行有の場合）旅行先が流行地か否か、旅行の目的等"] = "なし"
+        row["備考欄"] = make_text(rng, 50)
+        row["都道府県"] = row["変換後都道府県"]
+        row["作業ステータス"] = "完了" if rng.random() < 0.8 else "作業中"
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def write_workbook(df: pd.DataFrame, fmt: str, path: str):
+    """読み込み元と同じ形式で書く。xlsxは3枚目のシートに置く。"""
+    if fmt == "xlsx":
+        with pd.ExcelWriter(path, engine="openpyxl") as writer:
+            pd.DataFrame({"説明": ["合成データ"]}).to_excel(writer, sheet_name="表紙", index=False)
+            pd.DataFrame({"説明": ["合成データ"]}).to_excel(writer, sheet_name="説明", index=False)
+            df.to_excel(writer, sheet_name="患者", index=False)
+    elif fmt == "csv":
+        df.rename(columns=_column_name).to_csv(path, index=False)
+    else:
+        with sqlite3.connect(path) as conn:
+            df.rename(columns=_column_name).to_sql("patients", conn, index=False, if_exists="replace")
+
+def _column_name(column):
+    return column.strftime("%Y-%m-%d") if isinstance(column, datetime) else column
+
+def make_config(fmt: str, path: str) -> ChatConfigModel:
+    config = ChatConfigModel(server_cert=None, log_file=os.devnull, assistants_storage="",
+                             role_source="sqlite" if fmt == "sqlite" else "file",
+                             role_source_path=path, role_source_table="patients",
+                             role_refresh_interval=0, patient_prompt_cache_size=256)
+    config.logger = logging.getLogger("bench_role")
+    config.loop = asyncio.get_running_loop()
+    return config
+
+def make_provider(config: ChatConfigModel, days: int, cache_prefix: str) -> PatientRoleProvider:
+    provider = PatientRoleProvider(config)
+    provider.frame_cache = FrameCache(os.path.basename(cache_prefix), os.path.dirname(cache_prefix))
+    extra = [FIRST_DAY + timedelta(days=i) for i in range(days)]
+    extra = [d for d in extra if d not in provider.target_columns]
+    if extra:
+        # 日付の列が増えた場合として、読み込む列を増やす
+        provider.target_columns = provider.target_columns + extra
+        provider.use_columns = set(provider.target_columns) | {"作業ステータス"}
+        provider.source = create_role_source(config, provider.use_columns)
+    return provider
+
+def remove_cache(cache_prefix: str):
+    directory, prefix = os.path.split(cache_prefix)
+    for name in os.listdir(directory):
+        if name.startswith(prefix):
+            os.remove(os.path.join(directory, name))
+
+def timeit(fn, count: int) -> List[float]:
+    values = []
+    for _ in range(count):
+        start = perf_counter()
+        fn()
+        values.append(perf_counter() - start)
+    return values
+
+async def timeit_async(fn, count: int) -> List[float]:
+    values = []
+    for _ in range(count):
+        start = perf_counter()
+        await fn()
+        values.append(perf_counter() - start)
+    return values
+
+async def bench_case(opt, tmpdir: str, patients: int, days: int, text_length: int) -> dict:
+    name = f"patients_{patients}-days_{days}-len_{text_length}.{opt.format}"
+    path = os.path.join(tmpdir, name)
+    cache_prefix = os.path.join(tmpdir, "cached_data")
+    start = perf_counter()
+    df = make_frame(patients, days, text_length, opt.seed)
+    write_workbook(df, opt.format, path)
+    generate = perf_counter() - start
+    day_texts = [t for t in df[FIRST_DAY].tolist()][:opt.samples] if days else []
+    del df
+    config = make_config(opt.format, path)
+
+    # initialize。cold (読み込み元) の後はFrameCacheのファイルができるため、warmはそこから読む。
+    cold, warm = [], []
+    for _ in range(opt.repeat):
+        remove_cache(cache_prefix)
+        provider = make_provider(config, days, cache_prefix)
+        cold.extend(await timeit_async(provider.initialize, 1))
+        provider = make_provider(config, days, cache_prefix)
+        warm.extend(await timeit_async(provider.initialize, 1))
+    if provider.data is None:
+        raise RuntimeError(f"Failed to load {path}")
+
+    # メモリ。tracemallocは処理を遅くするため、時間とは別に測る。
+    remove_cache(cache_prefix)
+    del provider
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    provider = make_provider(config, days, cache_prefix)
+    await provider.initialize()
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rng = random.Random(opt.seed)
+    ids = [str(rng.randrange(1, patients + 1)) for _ in range(opt.samples)]
+    last_day = FIRST_DAY + timedelta(days=max(0, days - 1))
+    interview_date_str = last_day.strftime("%Y年%m月%d日") + "（月曜日）"
+    chunks_miss, chunks_hit = [], []
+    chunk_count = chunk_chars = 0
+    for patient_id in ids:
+        provider.prompt_cache.clear()
+        chunks_miss.extend(timeit(lambda: provider.get_patient_prompt_chunks(patient_id, interview_date_str), 1))
+        chunks_hit.extend(timeit(lambda: provider.get_patient_prompt_chunks(patient_id, interview_date_str), 1))
+        chunks, _ = provider.get_patient_prompt_chunks(patient_id, interview_date_str)
+        chunk_count += len(chunks)
+        chunk_chars += sum(len(c) for c in chunks)
+    details = []
+    for patient_id in ids:
+        details.extend(timeit(lambda: provider.get_patient_details(patient_id), 1))
+    available = timeit(provider.get_available_patient_ids, opt.samples)
+    split = []
+    for text in day_texts:
+        split.extend(timeit(lambda: provider._split_text_for_prompt(text, SPLIT_MAX_LENGTH), 1))
+
+    return {
+        "patients": patients,
+        "days": days,
+        "text_length": text_length,
+        "format": opt.format,
+        "file_bytes": os.path.getsize(path),
+        "generate_s": generate,
+        "initialize_cold_s": _summary(cold),
+        "initialize_warm_s": _summary(warm),
+        "memory": {
+            "initialize_peak_bytes": peak - before,
+            "retained_bytes": retained - before,
+            "retained_bytes_per_patient": (retained - before) / patients,
+        },
+        "get_patient_prompt_chunks_miss_s": _summary(chunks_miss),
+        "get_patient_prompt_chunks_hit_s": _summary(chunks_hit),
+        "prompt_chunks": {"mean_count": chunk_count / len(ids), "mean_chars": chunk_chars / len(ids)},
+        "get_patient_details_s": _summary(details),
+        "get_available_patient_ids_s": _summary(available),
+        "available_patient_ids": len(provider.get_available_patient_ids()),
+        "split_text_for_prompt_s": _summary(split),
+    }
+
+# scalingで見る値 (ケースの結果から取り出す)
+SCALING_METRICS = {
+    "initialize_cold": lambda c: c["initialize_cold_s"]["p50"],
+    "initialize_warm": lambda c: c["initialize_warm_s"]["p50"],
+    "retained_bytes": lambda c: c["memory"]["retained_bytes"],
+    "initialize_peak_bytes": lambda c: c["memory"]["initialize_peak_bytes"],
+    "get_patient_prompt_chunks_miss": lambda c: c["get_patient_prompt_chunks_miss_s"]["p50"],
+    "get_patient_details": lambda c: c["get_patient_details_s"]["p50"],
+    "get_available_patient_ids": lambda c: c["get_available_patient_ids_s"]["p50"],
+}
+
+def scaling(cases: List[dict]) -> List[dict]:
+    """患者数に対する増え方を、log(値の比) / log(患者数の比) で表す。"""
+    groups = {}
+    for case in cases:
+        groups.setdefault((case["days"], case["text_length"]), []).append(case)
+    result = []
+    for (days, text_length), group in groups.items():
+        group.sort(key=lambda c: c["patients"])
+        small, large = group[0], group[-1]
+        if small["patients"] == large["patients"]:
+            continue
+        exponents = {}
+        for metric, value in SCALING_METRICS.items():
+            a, b = value(small), value(large)
+            exponents[metric] = log(b / a) / log(large["patients"] / small["patients"]) if a > 0 and b > 0 else None
+        result.append({"days": days, "text_length": text_length,
+                       "patients": [small["patients"], large["patients"]], "exponent": exponents})
+    return result
+
+def _summary(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def quantile(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": quantile(0.5),
+        "p95": quantile(0.95),
+        "max": values[-1],
+    }
+
+def _int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+async def main(opt) -> dict:
+    cases = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for patients, days, text_length in product(opt.patients, opt.days, opt.lengths):
+            print(f"patients={patients} days={days} text_length={text_length}", file=sys.stderr)
+            cases.append(await bench_case(opt, tmpdir, patients, days, text_length))
+    return {
+        "python": sys.version.split()[0],
+        "pandas": pd.__version__,
+        "config": {"format": opt.format, "repeat": opt.repeat, "samples": opt.samples, "seed": opt.seed},
+        "cases": cases,
+        "scaling": scaling(cases),
+        # プロセス全体の最大RSS (Linuxではキロバイト)
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="Measure PatientRoleProvider with synthetic patient data.")
+    ap.add_argument("-n", help="specify the numbers of patients, comma separated.", dest="patients",
+                    type=_int_list, default=[100, 1000])
+    ap.add_argument("-d", help="specify the numbers of day columns, comma separated.", dest="days",
+                    type=_int_list, default=[29])
+    ap.add_argument("-l", help="specify the lengths of a day's text, comma separated.", dest="lengths",
+                    type=_int_list, default=[200])
+    ap.add_argument("-f", help="specify the format of the data.", dest="format",
+                    choices=["xlsx", "csv", "sqlite"], default="xlsx")
+    ap.add_argument("-r", help="specify the number of initialize runs.", dest="repeat", type=int, default=3)
+    ap.add_argument("-s", help="specify the number of patients sampled for the lookups.", dest="samples",
+                    type=int, default=200)
+    ap.add_argument("-o", help="specify the result file. default is stdout.", dest="output")
+    ap.add_argument("--seed", help="seed of the synthetic data.", type=int, default=1)
+    opt = ap.parse_args()
+    result = asyncio.run(main(opt))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if opt.output:
+        with open(opt.output, "w") as fd:
+            fd.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+チャットサーバの起動時間を測る。
+
+- import: `python -X importtime -c "import chatapi"` の結果から、chatapiの読み込み時間と
+  時間のかかっているモジュールを集計する。
+- listen: チャットサーバを起動し、プロセスの開始から接続を受け付けるまでの時間を測る。
+  患者データはrole_source=fileの存在しないファイルを指定し、読み込みを待たない。
+
+    python bench_startup.py -n 5 -o startup.json
+"""
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+SERVER_SCRIPT = """
+import asyncio, json, sys, time
+t0 = time.perf_counter()
+from uvicorn import Config, Server
+from chatconf import set_config
+from chatapi import api
+t1 = time.perf_counter()
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+config = set_config("bench_startup", loop, [sys.argv[1]])
+app = api(config)
+t2 = time.perf_counter()
+print(json.dumps({"import": t1 - t0, "app": t2 - t1}), flush=True)
+server = Server(Config(app=app, host="127.0.0.1", port=int(sys.argv[2]), log_level="warning"))
+loop.run_until_complete(server.serve())
+"""
+
+def run_importtime(module: str) -> list:
+    """-X importtimeの結果を (モジュール名, self[us], cumulative[us], 深さ) のリストで返す。"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=BASE_DIR, capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if m:
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2))
+    return rows
+
+def import_profile(module: str, runs: int, top: int) -> dict:
+    totals = []
+    rows = []
+    for _ in range(runs):
+        rows = run_importtime(module)
+        totals.append(next(cum for name, _, cum, _ in rows if name == module))
+    # chatapiが直接読み込むモジュールの内訳は最後の回のもの
+    direct = sorted(((name, cum) for name, _, cum, depth in rows if depth == 1),
+                    key=lambda r: r[1], reverse=True)
+    by_self = sorted(((name, own) for name, own, _, _ in rows), key=lambda r: r[1], reverse=True)
+    return {
+        "module": module,
+        "total_ms": _summary([t / 1000 for t in totals]),
+        "direct_imports_ms": [{"module": n, "cumulative_ms": c / 1000} for n, c in direct[:top]],
+        "slowest_self_ms": [{"module": n, "self_ms": s / 1000} for n, s in by_self[:top]],
+        "loaded_modules": len(rows),
+    }
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _wait_listening(port: int, proc, timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return True
+        except OSError:
+            time.sleep(0.005)
+    return False
+
+def listen_profile(runs: int, timeout: float) -> dict:
+    listen, imports, apps = [], [], []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conf_file = os.path.join(tmpdir, "conf.json")
+        with open(conf_file, "w") as fd:
+            json.dump({
+                "server_cert": None,
+                "log_file": os.path.join(tmpdir, "chatserver.log"),
+                "assistants_storage": "assistants.json",
+                "role_source": "file",
+                "role_source_path": os.path.join(tmpdir, "patients.csv"),
+                "role_refresh_interval": 0,
+            }, fd)
+        env = {k: v for k, v in os.environ.items() if k != "DATABASE_URL"}
+        for _ in range(runs):
+            port = _free_port()
+            start = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, "-c", SERVER_SCRIPT, conf_file, str(port)],
+                                    cwd=BASE_DIR, env=env, stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, text=True)
+            try:
+                if not _wait_listening(port, proc, timeout):
+                    raise RuntimeError("The server did not start listening.")
+                listen.append(time.perf_counter() - start)
+                phases = json.loads(proc.stdout.readline())
+                imports.append(phases["import"])
+                apps.append(phases["app"])
+            finally:
+                proc.terminate()
+                proc.wait()
+    return {
+        "process_start_to_listen_s": _summary(listen),
+        "import_s": _summary(imports),
+        "api_construct_s": _summary(apps),
+    }
+
+def _summary(values: list) -> dict:
+    return {
+        "median": statistics.median(values),
+        "min": min(values),
+        "max": max(values),
+        "runs": len(values),
+    }
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="Measure the startup time of the chat server.")
+    ap.add_argument("-n", help="specify the number of runs.", dest="runs", type=int, default=5)
+    ap.add_argument("-t", help="specify the number of modules listed.", dest="top", type=int, default=15)
+    ap.add_argument("-o", help="specify the result file. default is stdout.", dest="output")
+    ap.add_argument("--timeout", help="seconds to wait for the server to listen.",
+                    type=float, default=30)
+    ap.add_argument("--import-only", help="skip starting the server.",
+                    action="store_true", dest="import_only")
+    opt = ap.parse_args()
+    result = {
+        "python": sys.version.split()[0],
+        "import": import_profile("chatapi", opt.runs, opt.top),
+    }
+    if not opt.import_only:
+        result["listen"] = listen_profile(opt.runs, opt.timeout)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if opt.output:
+        with open(opt.output, "w") as fd:
+            fd.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+動いているチャットサーバに、保健師役の利用者 (trainee) をN人同時に接続して負荷をかける。
+各traineeはmodelChatの手順どおりに
+POST /v1 (RegistrationRequest) → /v1/ws/{user_id} → Established → MessageSubmitted×k → EndSessionRequest
+を行い、以下をJSONで出力する。
+
+- register: POST /v1 の応答時間
+- established: POST /v1 を送ってからEstablishedを受け取るまで
+- round_trip: MessageSubmittedを送ってから応答 (MessageForwarded) を受け取るまで
+- end: EndSessionRequestを送ってからSessionTerminated (または切断) まで
+- sessions_per_s: 最後まで終わったセッション数 / 全体の時間
+
+相手はmodeで選ぶ。
+- ai: 患者役のAI。サーバのOpenAIの設定 (または偽のバックエンド) が必要。
+- pair: このスクリプトが患者役の利用者も接続し、受け取った発言をそのまま返す。
+  サーバのhuman_match_timeoutを0より大きくしておく (0だと先に来た方がAIと組み合わされる)。
+
+    python bench_wsload.py -u http://127.0.0.1:8889 -n 50 -k 5 -o wsload.json
+"""
+import asyncio
+import json
+import sys
+import time
+from argparse import ArgumentParser
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import websockets
+
+from modelChat import (MsgType, RegistrationRequest, MessageSubmitted, EndSessionRequest,
+                       ContinueConversationRequest)
+
+# 応答の終わりとみなすメッセージ
+REPLY_TYPES = (MsgType.MessageForwarded.name, MsgType.ToolCallDetected.name)
+END_TYPES = (MsgType.SessionTerminated.name,)
+
+class BenchError(Exception):
+    pass
+
+async def http_request(url: str, method: str = "GET", body: Optional[dict] = None,
+                       timeout: float = 30) -> dict:
+    """HTTP/1.1で1回だけ送り、JSONの応答を返す。"""
+    u = urlsplit(url)
+    port = u.port or (443 if u.scheme == "https" else 80)
+    data = json.dumps(body).encode() if body is not None else b""
+    head = (f"{method} {u.path or '/'}{'?' + u.query if u.query else ''} HTTP/1.1\r\n"
+            f"Host: {u.hostname}:{port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n").encode()
+    async def _request():
+        reader, writer = await asyncio.open_connection(u.hostname, port, ssl=u.scheme == "https" or None)
+        try:
+            writer.write(head + data)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        header, _, payload = response.partition(b"\r\n\r\n")
+        status = int(header.split(b" ", 2)[1])
+        if status >= 400:
+            raise BenchError(f"HTTP {status}")
+        if b"transfer-encoding: chunked" in header.lower():
+            payload = _dechunk(payload)
+        return json.loads(payload)
+    return await asyncio.wait_for(_request(), timeout)
+
+def _dechunk(payload: bytes) -> bytes:
+    body = b""
+    while payload:
+        size, _, payload = payload.partition(b"\r\n")
+        n = int(size, 16)
+        if n == 0:
+            break
+        body += payload[:n]
+        payload = payload[n + 2:]
+    return body
+
+def ws_url(base: str, user_id: str) -> str:
+    u = urlsplit(base)
+    scheme = "wss" if u.scheme == "https" else "ws"
+    return f"{scheme}://{u.netloc}/v1/ws/{user_id}"
+
+async def recv_until(ws, msg_types, timeout: float) -> dict:
+    """msg_typesのいずれかを受け取るまで読む。それ以外 (QueuePosition, MessageDeltaなど) は読み飛ばす。"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise BenchError(f"Timed out waiting for {'/'.join(msg_types)}")
+        try:
+            msg = json.loads(await asyncio.wait_for(ws.recv(), remaining))
+        except asyncio.TimeoutError:
+            raise BenchError(f"Timed out waiting for {'/'.join(msg_types)}")
+        if msg.get("msg_type") in msg_types:
+            return msg
+        if msg.get("msg_type") in (MsgType.PreparationRejected.name, MsgType.SessionTerminated.name):
+            raise BenchError(f"Unexpected {msg['msg_type']}")
+
+class Result():
+    def __init__(self):
+        self.register: List[float] = []
+        self.established: List[float] = []
+        self.round_trip: List[float] = []
+        self.end: List[float] = []
+        self.completed = 0
+        self.failed = 0
+        self.messages = 0
+        self.errors: Dict[str, int] = {}
+
+    def error(self, e: Exception):
+        self.failed += 1
+        key = str(e) if isinstance(e, BenchError) else type(e).__name__
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+async def trainee(opt, result: Result, index: int):
+    start = time.perf_counter()
+    req = RegistrationRequest(user_name=f"bench-{index}", user_role="保健師",
+                              target_patient_id=opt.patient_id)
+    accepted = await http_request(f"{opt.url}/v1", "POST", req.model_dump(), opt.timeout)
+    result.register.append(time.perf_counter() - start)
+    user_id, session_id = accepted["user_id"], accepted["session_id"]
+    async with websockets.connect(ws_url(opt.url, user_id), open_timeout=opt.timeout,
+                                  max_size=None) as ws:
+        established = await recv_until(ws, (MsgType.Established.name,), opt.timeout)
+        result.established.append(time.perf_counter() - start)
+        # 人間同士の場合は相手のsession_idに合わせる
+        session_id = established["session_id"]
+        for i in range(opt.messages):
+            if opt.think > 0:
+                await asyncio.sleep(opt.think)
+            sent = time.perf_counter()
+            await ws.send(MessageSubmitted(session_id=session_id, user_id=user_id,
+                                           user_msg=f"{opt.text} ({i + 1})").model_dump_json())
+            reply = await recv_until(ws, REPLY_TYPES, opt.timeout)
+            result.round_trip.append(time.perf_counter() - sent)
+            result.messages += 1
+            if reply["msg_type"] == MsgType.ToolCallDetected.name:
+                # AIが終了を提案した場合は会話を続ける
+                await ws.send(ContinueConversationRequest(session_id=session_id, user_id=user_id).model_dump_json())
+        sent = time.perf_counter()
+        await ws.send(EndSessionRequest(session_id=session_id, user_id=user_id).model_dump_json())
+        try:
+            await recv_until(ws, END_TYPES, opt.timeout)
+        except websockets.ConnectionClosed:
+            pass
+        result.end.append(time.perf_counter() - sent)
+    result.completed += 1
+
+async def partner(opt, index: int, stop: asyncio.Event):
+    """pairの場合の患者役。受け取った発言をそのまま返し、セッションが終われば終わる。"""
+    req = RegistrationRequest(user_name=f"bench-partner-{index}", user_role="患者")
+    accepted = await http_request(f"{opt.url}/v1", "POST", req.model_dump(), opt.timeout)
+    user_id = accepted["user_id"]
+    async with websockets.connect(ws_url(opt.url, user_id), open_timeout=opt.timeout,
+                                  max_size=None) as ws:
+        established = await recv_until(ws, (MsgType.Established.name,), opt.timeout)
+        session_id = established["session_id"]
+        while not stop.is_set():
+            try:
+                msg = json.loads(await ws.recv())
+            except websockets.ConnectionClosed:
+                return
+            if msg.get("msg_type") == MsgType.MessageForwarded.name:
+                await ws.send(MessageSubmitted(session_id=session_id, user_id=user_id,
+                                               user_msg=msg["user_msg"]).model_dump_json())
+            elif msg.get("msg_type") in END_TYPES:
+                return
+
+async def run(opt) -> dict:
+    result = Result()
+    semaphore = asyncio.Semaphore(opt.concurrency or opt.trainees)
+    stop = asyncio.Event()
+
+    async def one(index: int):
+        await asyncio.sleep(opt.ramp * index / max(1, opt.trainees))
+        async with semaphore:
+            tasks = [asyncio.create_task(trainee(opt, result, index))]
+            if opt.mode == "pair":
+                tasks.append(asyncio.create_task(partner(opt, index, stop)))
+            try:
+                await tasks[0]
+            except Exception as e:
+                result.error(e)
+            if len(tasks) > 1:
+                # 相手が組み合わされないまま残った場合
+                try:
+                    await asyncio.wait_for(tasks[1], opt.timeout)
+                except Exception:
+                    pass
+
+    stats_before = await _server_stats(opt)
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(opt.trainees)))
+    wall = time.perf_counter() - start
+    stop.set()
+    return {
+        "python": sys.version.split()[0],
+        "config": {
+            "url": opt.url,
+            "mode": opt.mode,
+            "trainees": opt.trainees,
+            "concurrency": opt.concurrency or opt.trainees,
+            "messages": opt.messages,
+            "think_s": opt.think,
+            "ramp_s": opt.ramp,
+        },
+        "sessions": {"completed": result.completed, "failed": result.failed, "errors": result.errors},
+        "wall_s": wall,
+        "sessions_per_s": result.completed / wall if wall else 0.0,
+        "messages_per_s": result.messages / wall if wall else 0.0,
+        "register_s": _summary(result.register),
+        "established_s": _summary(result.established),
+        "round_trip_s": _summary(result.round_trip),
+        "end_s": _summary(result.end),
+        "server_stats": {"before": stats_before, "after": await _server_stats(opt)},
+    }
+
+async def _server_stats(opt) -> Optional[dict]:
+    try:
+        return await http_request(f"{opt.url}/v1/stats", timeout=opt.timeout)
+    except Exception:
+        return None
+
+def _summary(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    def quantile(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": quantile(0.5),
+        "p95": quantile(0.95),
+        "p99": quantile(0.99),
+        "max": values[-1],
+    }
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description="WebSocket load test of the chat server.")
+    ap.add_argument("-u", help="specify the base URL of the server.", dest="url",
+                    default="http://127.0.0.1:8889")
+    ap.add_argument("-n", help="specify the number of trainees.", dest="trainees", type=int, default=10)
+    ap.add_argument("-c", help="specify the number of concurrent sessions. default is the number of trainees.",
+                    dest="concurrency", type=int, default=0)
+    ap.add_argument("-k", help="specify the number of messages per session.", dest="messages", type=int, default=3)
+    ap.add_argument("-m", help="specify the peer of the trainees.", dest="mode",
+                    choices=["ai", "pair"], default="ai")
+    ap.add_argument("-p", help="specify the patient id for the AI.", dest="patient_id", default="1")
+    ap.add_argument("-o", help="specify the result file. default is stdout.", dest="output")
+    ap.add_argument("--text", help="message sent by the trainees.", default="今日はどうされましたか？")
+    ap.add_argument("--think", help="seconds to wait before each message.", type=float, default=0)
+    ap.add_argument("--ramp", help="seconds over which the trainees start.", type=float, default=0)
+    ap.add_argument("--timeout", help="seconds to wait for each response.", type=float, default=120)
+    opt = ap.parse_args()
+    opt.url = opt.url.rstrip("/")
+    result = asyncio.run(run(opt))
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if opt.output:
+        with open(opt.output, "w") as fd:
+            fd.write(text + "\n")
+    else:
+        print(text)
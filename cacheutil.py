@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Hashable, Optional
+
+class LRUCache():
+    """
+    件数上限つきのLRUキャッシュ。
+    上限を超えると最も長く参照されていないものから捨てる。
+    ttlを指定すると、put()からttl秒経ったものは無かったものとして扱う。
+    キャッシュサイズの見積もりに使えるよう、ヒット/ミス数を数える。
+    """
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (有効期限, 値)
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            expires_at, value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires_at is not None and expires_at <= monotonic():
+            del self.data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        expires_at = monotonic() + self.ttl if self.ttl is not None else None
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.data
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,16 +1,19 @@
-from fastapi import FastAPI, Body, Request, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Body, Request, HTTPException, Depends, Query, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.encoders import jsonable_encoder
-from pydantic import BaseModel
-from typing import List, Union
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
+from typing import List, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, desc, select, update
 import uuid
 import os
 import asyncio
+import hmac
+import importlib
 import json
+import threading
 from datetime import datetime, timezone, timedelta
+from time import monotonic
 from random import random, choice
 from hashlib import sha1
 
@@ -20,67 +23,85 @@ from modelHistory import *
 from modelRole import PatientRoleProvider
 import modelDatabase
 from modelSession import Session as SessionModel # New
-from openai import NotFoundError
-from openai_assistant import OpenAIAssistantWrapper
-
-class APISession(BaseModel):
-    users: List[Union[UserDef, AssistantDef]]
-    history: History
-    session_id: str
+from openai_assistant import OpenAIAssistantWrapper, openai
+from openai_threadpool import AssistantThreadPool
+from chatlogwriter import ChatLogWriter
+from sessionregistry import APISession, SessionRegistry
+from matchmaker import Matchmaker, QueueFull
+from sessionstore import create_session_store
+from sessionpipeline import FINAL, JOB, MessageBatch, SessionPipeline, SessionState
+from sessioncache import SessionSnapshotCache
+from logquery import InvalidCursor, keyset_page, split_page
+import logexport
+from historyarchive import HistoryArchive
+import metrics
+from openai_etc import openai_get_apikey
+import profiler
+
+# /v1/logs の1ページの件数
+LOGS_PAGE_SIZE = 50
+LOGS_MAX_PAGE_SIZE = 500
+
+# 起動後に裏で読み込んでおくモジュール
+WARMUP_MODULES = ("pandas", "openai")
+
+# /v1/admin/profile/... で1回に調べられる秒数の上限
+PROFILE_MAX_SECONDS = 120
 
 # --- Global State ---
-users_waiting = {}
-users_session = {}
+registry = SessionRegistry()
+log_writer: ChatLogWriter = None
+session_cache: SessionSnapshotCache = None
 
 # --- Helper Functions (Top Level) ---
 def get_id() -> str:
     base = f"{datetime.now().timestamp()}-{random()}"
     return sha1(base.encode()).hexdigest()
 
-async def log_message(db: Session, session_id: str, user_name: str, patient_id: str, user_role: str, sender: str, message: str, logger, is_initial_message: bool = False):
-    if not modelDatabase.SessionLocal:
+def _chat_log_record(session_id: str, user_name: str, patient_id: str, user_role: str, sender: str, message: str, is_initial_message: bool = False) -> dict:
+    # JST (UTC+9) のタイムゾーンを定義
+    jst = timezone(timedelta(hours=9))
+    # ログメッセージが作成された正確な時刻を記録
+    return dict(
+        session_id=session_id, user_name=user_name, patient_id=patient_id,
+        user_role=user_role, sender=sender, message=message,
+        is_initial_message=is_initial_message,
+        created_at=datetime.now(jst)
+    )
+
+def _to_utc(dt: datetime) -> datetime:
+    return dt.astimezone(timezone.utc) if dt.tzinfo is not None else dt
+
+async def log_message(session_id: str, user_name: str, patient_id: str, user_role: str, sender: str, message: str, logger, is_initial_message: bool = False):
+    if not log_writer:
         return
-    try:
-        # JST (UTC+9) のタイムゾーンを定義
-        jst = timezone(timedelta(hours=9))
-        # ログメッセージが作成された正確な時刻を記録
-        log_entry = modelDatabase.ChatLog(
-            session_id=session_id, user_name=user_name, patient_id=patient_id,
-            user_role=user_role, sender=sender, message=message,
-            is_initial_message=is_initial_message,
-            created_at=datetime.now(jst)
-        )
-        db.add(log_entry)
-        db.commit()
-        db.refresh(log_entry)
-        logger.debug(f"Logged message for session {session_id}")
-    except Exception as e:
-        logger.error(f"Failed to log message: {e}")
-        db.rollback()
+    record = _chat_log_record(session_id, user_name, patient_id, user_role, sender, message, is_initial_message)
+    if session_cache:
+        session_cache.append_log(record)
+    # 実際の書き込みはChatLogWriterがまとめて行う
+    await log_writer.put(record)
+    logger.debug(f"Queued message log for session {session_id}")
+
+async def log_messages(records: List[dict], logger):
+    """_chat_log_record()で作った複数のログをまとめてキューに積む。"""
+    if not log_writer or not records:
+        return
+    if session_cache:
+        for record in records:
+            session_cache.append_log(record)
+    await log_writer.put_many(records)
+    logger.debug(f"Queued {len(records)} message logs for session {records[0]['session_id']}")
 
-async def _mark_session_completed(db: Session, session_id: str, logger):
+async def _mark_session_completed(db: AsyncSession, session_id: str, logger):
     try:
-        db.query(modelDatabase.ChatLog).filter(
+        await db.execute(update(modelDatabase.ChatLog).where(
             modelDatabase.ChatLog.session_id == session_id
-        ).update({modelDatabase.ChatLog.completed: True})
-        db.commit()
+        ).values({modelDatabase.ChatLog.completed: True}))
+        await db.commit()
         logger.debug(f"Session {session_id} marked as completed.")
     except Exception as e:
         logger.error(f"Failed to mark session as completed: {e}")
-        db.rollback()
-
-async def _save_history(session_id: str, history: History, logger) -> None:
-    filename = f"history-{session_id}.json"
-    with open(filename, "w", encoding="utf-8") as fd:
-        json.dump(history.model_dump(exclude={'session_id'}), fd, ensure_ascii=False)
-    logger.debug(f"History has been saved {filename}")
-
-def _find_peer_human(user: UserDef) -> UserDef:
-    peer_role = "保健師" if user.role == "患者" else "患者"
-    for u in users_waiting.values():
-        if u.role == peer_role and u.status == Status.Prepared.name:
-            return u
-    return None
+        await db.rollback()
 
 def _find_peer_ai(user: UserDef) -> AssistantDef:
     assistants = json.load(open("assistants.json"))
@@ -97,13 +118,9 @@ def _find_peer_ai(user: UserDef) -> AssistantDef:
     return None
 
 def _find_user_session(user_id: str) -> APISession:
-    for s in users_session.values():
-        for u in s.users:
-            if u.user_id == user_id:
-                return s
-    return None
+    return registry.find_user_session(user_id)
 
-async def _execute_debriefing(session: APISession, user: UserDef, db: Session, logger, oaw: OpenAIAssistantWrapper):
+async def _execute_debriefing(session: APISession, user: UserDef, logger, oaw: OpenAIAssistantWrapper):
     """Debriefing処理を実行し、結果をクライアントに送信する"""
     peer_ai = next((p for p in session.users if isinstance(p, AssistantDef)), None)
     
@@ -197,50 +214,213 @@ async def _execute_debriefing(session: APISession, user: UserDef, db: Session, l
 
     await user.ws.send_json(DebriefingResponse(session_id=session.session_id, debriefing_data=debriefing_data).dict())
     # ログにはJSON全体を保存する
-    await log_message(db, session.session_id, "System", peer_ai.assistant_id, peer_ai.role, "System", f"Debriefing Data: {json.dumps(debriefing_data, ensure_ascii=False)}", logger)
+    await log_message(session.session_id, "System", peer_ai.assistant_id, peer_ai.role, "System", f"Debriefing Data: {json.dumps(debriefing_data, ensure_ascii=False)}", logger)
 
 
 # --- Main API Factory ---
 def api(config):
+    global session_cache
     logger = config.logger
+    session_store = create_session_store(config)
+    # 他のワーカが書いたログや終了したセッションはこのプロセスのキャッシュに反映されないため、
+    # ストアを共有する場合はキャッシュせずに毎回DBから読む
+    cache_size = config.session_cache_size if session_store.backend == "memory" else 0
+    session_cache = SessionSnapshotCache(cache_size, config.session_cache_ttl)
+    history_archive = HistoryArchive(config.history_archive_path)
     oaw = OpenAIAssistantWrapper(config)
     role_provider = PatientRoleProvider(config)
+    matchmaker = Matchmaker(registry, session_store, config.max_queue_size, logger)
+    thread_pool = AssistantThreadPool(config, oaw, role_provider)
     
     app = FastAPI()
+    # 起動後の読み込み処理 (_warmup) の状態
+    warmup = {"task": None, "duration": None}
+    # プロファイルは同時に1つだけ取る
+    profiling = {"token": None, "lock": asyncio.Lock(), "watchdog": None}
+    if config.enable_profiling:
+        try:
+            profiling["token"] = openai_get_apikey(config.admin_token_storage)
+        except Exception as e:
+            logger.error(f"Profiling is disabled because the admin token can't be read: {e}")
 
     @app.on_event("startup")
     async def startup_event():
+        global log_writer
         db_url = os.getenv("DATABASE_URL")
         if db_url:
             logger.info("Initializing Database...")
             modelDatabase.initialize_database(db_url)
-            modelDatabase.init_db()
+            await modelDatabase.init_db()
+            log_writer = ChatLogWriter(config)
+            log_writer.start()
             logger.info("Database initialized.")
         else:
             logger.warning("DATABASE_URL is not set. Running without database logging.")
-        
+        session_store.start(_on_store_event)
+        if config.slow_callback_ms > 0:
+            _start_watchdog(config.slow_callback_ms)
+        # 患者データの読み込みなどは、接続の受け付けを始めてから裏で行う
+        warmup["task"] = asyncio.create_task(_warmup())
+
+    async def _warmup():
+        start = monotonic()
+        # 読み込みに時間のかかるモジュールは、イベントループを止めないようスレッドで読み込む
+        for module in WARMUP_MODULES:
+            await asyncio.to_thread(importlib.import_module, module)
         logger.info("Initializing PatientRoleProvider...")
         try:
             await role_provider.initialize()
             logger.info("PatientRoleProvider initialized successfully.")
         except Exception as e:
             logger.error(f"Failed to initialize PatientRoleProvider: {e}")
-
-    def get_db():
+        # 最初のセッションでクライアントの作成を待たせない
+        oaw.client
+        role_provider.start()
+        thread_pool.start()
+        warmup["duration"] = monotonic() - start
+        logger.info(f"Warmup finished in {warmup['duration']:.2f}s")
+
+    async def _on_store_event(event: dict):
+        """他のノードから届いたイベントを処理する。"""
+        if event["type"] == "matched":
+            matchmaker.on_matched(event)
+        elif event["type"] == "send":
+            user = registry.find_user(event["user_id"])
+            if user is None or user.ws is None:
+                logger.debug(f"Dropped an event for user {event['user_id']} not connected here.")
+                return
+            await session_store.send(user, event["payload"], event["close"], event["code"])
+
+    def _start_watchdog(threshold_ms: float):
+        watchdog = profiler.LoopWatchdog(threshold_ms / 1000, logger)
+        watchdog.start()
+        profiling["watchdog"] = watchdog
+        logger.info(f"Event loop watchdog started. threshold={threshold_ms}ms")
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        if profiling["watchdog"] is not None:
+            await profiling["watchdog"].stop()
+        task = warmup["task"]
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await thread_pool.stop()
+        await role_provider.stop()
+        await session_store.stop()
+        if log_writer:
+            logger.info("Flushing pending chat logs...")
+            await log_writer.stop()
+        await modelDatabase.close_database()
+
+    async def get_db():
         if not modelDatabase.SessionLocal:
             raise HTTPException(status_code=503, detail="Database is not initialized.")
-        db = modelDatabase.SessionLocal()
-        try:
+        async with modelDatabase.SessionLocal() as db:
             yield db
-        finally:
-            db.close()
+
+    # /v1/metricsで出力する時に値を取り出すもの
+    metrics.REGISTRY.gauge("chat_active_sessions", "Sessions active in this process.",
+                           lambda: len(registry.sessions))
+    metrics.REGISTRY.gauge("chat_waiting_users", "Users connected to this process and waiting for a session.",
+                           lambda: len(registry.waiting))
+    metrics.REGISTRY.gauge("chat_log_queue_depth", "Chat log records waiting to be written.",
+                           lambda: log_writer.queue.qsize() if log_writer else 0)
+    metrics.REGISTRY.gauge("chat_openai_running", "OpenAI operations holding a scheduler slot.",
+                           lambda: oaw.scheduler.running)
+    metrics.REGISTRY.gauge("chat_openai_waiting", "OpenAI operations waiting for a scheduler slot.",
+                           lambda: oaw.scheduler.waiting)
+    metrics.REGISTRY.gauge("chat_role_refresh_duration_seconds", "Duration of the last patient data reload.",
+                           lambda: role_provider.last_refresh_duration or 0)
 
     # --- API Endpoints ---
+    @app.get("/v1/metrics")
+    async def get_metrics():
+        """Prometheusのテキスト形式のメトリクス。"""
+        return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+    @app.get("/v1/stats")
+    async def get_stats():
+        return {
+            "warmup": {"done": warmup["duration"] is not None, "duration": warmup["duration"]},
+            "log_writer": log_writer.stats() if log_writer else None,
+            "prompt_cache": role_provider.prompt_cache.stats(),
+            "role_data": role_provider.stats(),
+            "sessions": registry.stats(),
+            "matchmaker": matchmaker.stats(),
+            "session_store": session_store.stats(),
+            "thread_pool": thread_pool.stats(),
+            "openai": oaw.scheduler.stats(),
+            "openai_fake": oaw.client.stats() if config.openai_backend == "fake" else None,
+            "session_cache": session_cache.stats(),
+        }
+
+    async def require_admin(request: Request):
+        """enable_profilingが無効なら存在しないものとして扱い、トークンが違えば拒否する。"""
+        token = profiling["token"]
+        if not token:
+            raise HTTPException(status_code=404, detail="Not Found")
+        given = request.headers.get("x-admin-token", "")
+        auth = request.headers.get("authorization", "")
+        if auth.lower().startswith("bearer "):
+            given = auth[7:].strip()
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+    async def _exclusive_profile(coro):
+        if profiling["lock"].locked():
+            coro.close()
+            raise HTTPException(status_code=409, detail="Another profile is running.")
+        async with profiling["lock"]:
+            return await coro
+
+    @app.get("/v1/admin/profile/cpu", dependencies=[Depends(require_admin)])
+    async def profile_cpu(seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+                          interval_ms: float = Query(5, ge=1, le=1000),
+                          top: int = Query(30, ge=1, le=500)):
+        """イベントループのスレッドをseconds秒サンプリングする。"""
+        sampler = profiler.SamplingProfiler(threading.get_ident(), interval_ms / 1000)
+        logger.info(f"CPU profiling for {seconds}s")
+        return await _exclusive_profile(asyncio.to_thread(sampler.run, seconds, top))
+
+    @app.get("/v1/admin/profile/memory", dependencies=[Depends(require_admin)])
+    async def profile_memory(seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+                             top: int = Query(30, ge=1, le=500)):
+        """seconds秒の間に増えたメモリを、確保した行ごとに返す。"""
+        logger.info(f"Memory profiling for {seconds}s")
+        return await _exclusive_profile(profiler.memory_diff(seconds, top))
+
+    @app.get("/v1/admin/profile/watchdog", dependencies=[Depends(require_admin)])
+    async def get_watchdog():
+        watchdog = profiling["watchdog"]
+        return watchdog.stats() if watchdog else {"running": False}
+
+    @app.post("/v1/admin/profile/watchdog", dependencies=[Depends(require_admin)])
+    async def start_watchdog(threshold_ms: float = Query(100, ge=10)):
+        """イベントループがthreshold_ms以上止まったらスタックをログに出す。動いていれば閾値を変える。"""
+        if profiling["watchdog"] is not None:
+            await profiling["watchdog"].stop()
+        _start_watchdog(threshold_ms)
+        return profiling["watchdog"].stats()
+
+    @app.delete("/v1/admin/profile/watchdog", dependencies=[Depends(require_admin)])
+    async def stop_watchdog():
+        watchdog = profiling["watchdog"]
+        if watchdog is None:
+            return {"running": False}
+        await watchdog.stop()
+        profiling["watchdog"] = None
+        logger.info("Event loop watchdog stopped.")
+        return watchdog.stats()
+
     @app.get("/v1/patients")
     async def get_available_patients():
         if role_provider.df is None:
             raise HTTPException(status_code=503, detail="Patient data is not ready.")
-        return {"patient_ids": role_provider.get_available_patient_ids()}
+        return {"patient_ids": role_provider.get_available_patient_ids(), "data_version": role_provider.data_version}
 
     @app.get("/v1/patient/{patient_id}")
     async def get_patient_details(patient_id: str):
@@ -252,181 +432,225 @@ def api(config):
         return details
 
     @app.get("/v1/session/{session_id}")
-    async def get_session_status(session_id: str, db: Session = Depends(get_db)):
+    async def get_session_status(session_id: str, db: AsyncSession = Depends(get_db)):
         """指定されたセッションが再開可能か確認し、関連情報を返す"""
         logger.info(f"Attempting to restore session with session_id: {session_id}") # DEBUG LOG
-        # Query the new sessions table
-        db_session = db.query(SessionModel).filter(
-            SessionModel.session_id == session_id,
-            SessionModel.status == 'active'
-        ).first()
-
-        if not db_session:
-            raise HTTPException(status_code=404, detail="Active session not found.")
-
-        # If session is found, proceed to gather history and other details
+        # patient_infoの取得に患者データが必要
         if role_provider.df is None:
             logger.warning("Role provider not initialized in get_session_status. Initializing...")
             await role_provider.initialize()
             if role_provider.df is None:
                 raise HTTPException(status_code=503, detail="Patient data could not be loaded on demand.")
 
-        history_logs = db.query(modelDatabase.ChatLog).filter(
-            modelDatabase.ChatLog.session_id == session_id,
-            modelDatabase.ChatLog.sender != 'System',  # システムログは除外
-            modelDatabase.ChatLog.is_initial_message == False # 初期メッセージは除外
-        ).order_by(modelDatabase.ChatLog.created_at.asc()).all()
+        # スナップショットがキャッシュに無い場合だけDBを読む
+        snapshot = await session_cache.load(db, session_id, role_provider, log_writer)
+        if not snapshot or snapshot.session["status"] != 'active':
+            raise HTTPException(status_code=404, detail="Active session not found.")
+        db_session = snapshot.session
 
         chat_history = []
-        user_icon = 'mdi-account-tie-woman' if db_session.user_role == '保健師' else 'mdi-account'
-        assistant_icon = 'mdi-account' if db_session.user_role == '保健師' else 'mdi-account-tie-woman'
-
-        for log in history_logs:
-            if log.sender == 'User':
+        user_icon = 'mdi-account-tie-woman' if db_session["user_role"] == '保健師' else 'mdi-account'
+        assistant_icon = 'mdi-account' if db_session["user_role"] == '保健師' else 'mdi-account-tie-woman'
+
+        for log in snapshot.transcript:
+            # システムログと初期メッセージは除外
+            if log["sender"] == 'System' or log["is_initial_message"]:
+                continue
+            if log["sender"] == 'User':
                 chat_history.append({
                     "sender": "user",
-                    "message": log.message,
+                    "message": log["message"],
                     "icon": user_icon
                 })
-            elif log.sender == 'Assistant':
+            elif log["sender"] == 'Assistant':
                 chat_history.append({
                     "sender": "assistant",
-                    "message": log.message,
+                    "message": log["message"],
                     "icon": assistant_icon
                 })
 
-        patient_info = {}
-        if db_session.user_role == '保健師' and db_session.patient_id:
-            patient_info = role_provider.get_patient_details(db_session.patient_id)
-
         # Create a new user_id for the restored session to allow reconnection
         new_user_id = get_id()
         restored_user = UserDef(
             user_id=new_user_id,
-            user_name=db_session.user_name,
-            role=db_session.user_role,
+            user_name=db_session["user_name"],
+            role=db_session["user_role"],
             status=Status.Registered.name, # Set as Registered to allow WS connection
-            target_patient_id=db_session.patient_id,
+            target_patient_id=db_session["patient_id"],
             session_id=session_id # Pass the session_id for reconnection
         )
-        users_waiting[new_user_id] = restored_user
+        await matchmaker.register(restored_user)
 
         return {
             "session_id": session_id,
             "user_id": new_user_id, # Return the NEW user_id
-            "user_name": db_session.user_name,
-            "user_role": db_session.user_role,
-            "patient_id": db_session.patient_id,
+            "user_name": db_session["user_name"],
+            "user_role": db_session["user_role"],
+            "patient_id": db_session["patient_id"],
             "chat_history": chat_history,
-            "patient_info": patient_info,
-            "interview_date": db_session.interview_date or db_session.created_at.strftime("%Y年%m月%d日"),
+            "patient_info": snapshot.patient_info,
+            "interview_date": db_session["interview_date"] or db_session["created_at"].strftime("%Y年%m月%d日"),
         }
 
     @app.get("/v1/logs")
-    async def get_logs(db: Session = Depends(get_db)):
-        """対話ログのセッション一覧を取得する"""
+    async def get_logs(user_name: Optional[str] = None, patient_id: Optional[str] = None,
+                       role: Optional[str] = None, status: Optional[str] = None,
+                       date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                       cursor: Optional[str] = None,
+                       limit: int = Query(LOGS_PAGE_SIZE, ge=1, le=LOGS_MAX_PAGE_SIZE),
+                       db: AsyncSession = Depends(get_db)):
+        """
+        対話ログのセッション一覧を新しい順に取得する。
+        続きはレスポンスのnext_cursorをcursorに指定して取得する。
+        """
         if not modelDatabase.SessionLocal:
             raise HTTPException(status_code=503, detail="Database is not initialized.")
 
-        sessions = db.query(SessionModel).order_by(
-            desc(SessionModel.created_at)
-        ).all()
-        
-        return [
-            {
-                "session_id": session.session_id,
-                "user_name": session.user_name,
-                "user_role": session.user_role,
-                "patient_id": session.patient_id,
-                "started_at": session.created_at.isoformat()
-            } for session in sessions
-        ]
+        stmt = select(SessionModel)
+        if user_name:
+            stmt = stmt.where(SessionModel.user_name == user_name)
+        if patient_id:
+            stmt = stmt.where(SessionModel.patient_id == patient_id)
+        if role:
+            stmt = stmt.where(SessionModel.user_role == role)
+        if status:
+            stmt = stmt.where(SessionModel.status == status)
+        # created_atはUTCで保存しているため、タイムゾーンつきの指定はUTCにして比べる
+        if date_from:
+            stmt = stmt.where(SessionModel.created_at >= _to_utc(date_from))
+        if date_to:
+            stmt = stmt.where(SessionModel.created_at < _to_utc(date_to))
+        try:
+            stmt = keyset_page(stmt, SessionModel, cursor, limit, descending=True)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        sessions, next_cursor = split_page((await db.execute(stmt)).scalars().all(), limit)
+
+        return {
+            "items": [
+                {
+                    "session_id": session.session_id,
+                    "user_name": session.user_name,
+                    "user_role": session.user_role,
+                    "patient_id": session.patient_id,
+                    "status": session.status,
+                    "started_at": session.created_at.isoformat()
+                } for session in sessions
+            ],
+            "next_cursor": next_cursor,
+        }
+
+    @app.get("/v1/export")
+    async def export_logs(format: str = "ndjson", gzip: bool = False,
+                          date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                          patient_id: Optional[str] = None):
+        """対話ログを一括で書き出す。件数によらず、読んだ行から順に送る。"""
+        if not modelDatabase.SessionLocal:
+            raise HTTPException(status_code=503, detail="Database is not initialized.")
+        try:
+            logexport.check_format(format)
+        except logexport.ExportError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        filename = logexport.export_filename(format, gzip)
+        return StreamingResponse(
+            logexport.export_logs(format, gzip, date_from, date_to, patient_id),
+            media_type="application/gzip" if gzip and format != "parquet" else logexport.MEDIA_TYPES[format],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
 
     @app.get("/v1/logs/{session_id}")
-    async def get_log_detail(session_id: str, db: Session = Depends(get_db)):
-        """特定のセッションの対話ログ詳細を取得する"""
+    async def get_log_detail(session_id: str, cursor: Optional[str] = None,
+                             limit: int = Query(LOGS_MAX_PAGE_SIZE, ge=1, le=LOGS_MAX_PAGE_SIZE),
+                             db: AsyncSession = Depends(get_db)):
+        """特定のセッションの対話ログ詳細を古い順に取得する"""
         if not modelDatabase.SessionLocal:
             raise HTTPException(status_code=503, detail="Database is not initialized.")
-            
-        logs = db.query(modelDatabase.ChatLog).filter(
-            modelDatabase.ChatLog.session_id == session_id
-        ).order_by(
-            modelDatabase.ChatLog.created_at
-        ).all()
-        
-        if not logs:
+
+        stmt = select(modelDatabase.ChatLog).where(modelDatabase.ChatLog.session_id == session_id)
+        try:
+            stmt = keyset_page(stmt, modelDatabase.ChatLog, cursor, limit)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        logs, next_cursor = split_page((await db.execute(stmt)).scalars().all(), limit)
+
+        if not logs and not cursor:
             raise HTTPException(status_code=404, detail="Session not found")
-            
-        return [
-            {
-                "id": log.id,
-                "sender": log.sender,
-                "role": log.user_role,
-                "message": log.message,
-                "created_at": log.created_at.isoformat()
-            } for log in logs
-        ]
+
+        return {
+            "items": [
+                {
+                    "id": log.id,
+                    "sender": log.sender,
+                    "role": log.user_role,
+                    "message": log.message,
+                    "created_at": log.created_at.isoformat()
+                } for log in logs
+            ],
+            "next_cursor": next_cursor,
+        }
 
     @app.post("/v1")
-    async def post_request(req: RegistrationRequest, db: Session = Depends(get_db)):
+    async def post_request(req: RegistrationRequest, db: AsyncSession = Depends(get_db)):
         if req.msg_type != MsgType.RegistrationRequest.name:
             raise HTTPException(status_code=406, detail="Invalid message type")
         
         user_id = get_id()
         session_id = str(uuid.uuid4())
-        users_waiting[user_id] = UserDef(
-            user_id=user_id, user_name=req.user_name, role=req.user_role,
-            status=Status.Registered.name, target_patient_id=req.target_patient_id,
-            session_id=session_id
-        )
+        try:
+            await matchmaker.admit(UserDef(
+                user_id=user_id, user_name=req.user_name, role=req.user_role,
+                status=Status.Registered.name, target_patient_id=req.target_patient_id,
+                session_id=session_id
+            ))
+        except QueueFull as e:
+            logger.warning(f"Registration rejected: {e}")
+            return JSONResponse(status_code=503, content=RegistrationRejected(reason=str(e)).dict())
         return RegistrationAccepted(user_id=user_id, session_id=session_id)
 
     @app.websocket("/v1/ws/{user_id}")
-    async def websocket_endpoint(user_id: str, ws: WebSocket, db: Session = Depends(get_db)):
-        if user_id not in users_waiting:
+    async def websocket_endpoint(user_id: str, ws: WebSocket, db: AsyncSession = Depends(get_db)):
+        # 登録を受け付けたのが他のワーカでも、ストアから引ける
+        user = await matchmaker.lookup(user_id)
+        if user is None:
             await ws.close(code=1008)
             return
 
         await ws.accept()
-        user = users_waiting[user_id]
-        user.ws = ws
         user.status = Status.Prepared.name
+        await matchmaker.attach(user, ws)
 
         try:
             # Case 1: Reconnecting to a session active in memory
-            active_session = users_session.get(user.session_id)
+            active_session = registry.get_session(user.session_id)
             if active_session:
                 logger.info(f"Reconnecting user {user.user_id} to active session {user.session_id}")
-                # Update WebSocket object
-                for i, u in enumerate(active_session.users):
-                    if isinstance(u, UserDef):
-                        active_session.users[i].ws = ws
-                        break
+                # Replace the stale user (and its WebSocket) with the reconnected one
+                await matchmaker.leave(user.user_id)
+                registry.attach_user(active_session, user)
                 # History is already in memory, so just start the handler
                 await _session_handler(user, db, logger, oaw)
                 return
 
             # Case 2: Restoring a session from DB (e.g., after server restart)
-            db_session = db.query(SessionModel).filter(SessionModel.session_id == user.session_id).first()
-            if db_session and db_session.status == 'active':
-                logger.info(f"No active session in memory for {user.session_id}. Rebuilding from DB.")
+            snapshot = await session_cache.load(db, user.session_id, role_provider, log_writer) if user.session_id else None
+            if snapshot and snapshot.session["status"] == 'active':
+                logger.info(f"No active session in memory for {user.session_id}. Rebuilding from snapshot.")
                 assistant = _find_peer_ai(user)
-                assistant.thread_id = db_session.thread_id
+                assistant.thread_id = snapshot.session["thread_id"]
                 history = History(assistant={"role": assistant.role, "assistant_id": assistant.assistant_id})
-                active_session = APISession(users=[user, assistant], history=history, session_id=user.session_id)
-                users_session[user.session_id] = active_session
+                active_session = APISession(users=[user, assistant], history=history, session_id=user.session_id,
+                                            role_data=role_provider.data)
+                await matchmaker.leave(user.user_id)
+                registry.add_session(active_session)
 
-                # Restore history from DB
-                history_logs = db.query(modelDatabase.ChatLog).filter(
-                    modelDatabase.ChatLog.session_id == active_session.session_id,
-                    modelDatabase.ChatLog.sender != 'System'
-                ).order_by(modelDatabase.ChatLog.created_at.asc()).all()
+                # Restore history from the snapshot
+                history_logs = [log for log in snapshot.transcript if log["sender"] != 'System']
 
                 for log in history_logs:
                     user_role = user.role
                     assistant_role = "患者" if user_role == "保健師" else "保健師"
-                    role = user_role if log.sender == 'User' else assistant_role
-                    active_session.history.history.append(MessageInfo(role=role, text=log.message))
+                    role = user_role if log["sender"] == 'User' else assistant_role
+                    active_session.history.history.append(MessageInfo(role=role, text=log["message"]))
                 
                 logger.info(f"Restored {len(history_logs)} messages to server-side session history for session {user.session_id}.")
                 await _session_handler(user, db, logger, oaw)
@@ -434,16 +658,19 @@ def api(config):
 
             # Case 3: Creating a new session
             logger.info(f"Creating a new session for user {user.user_id}")
-            peer = _find_peer_human(user)
+            peer = await matchmaker.match(user)
+            if peer is None and config.human_match_timeout > 0:
+                # 人間の相手が来るまでしばらく待ち、来なければAIと組み合わせる
+                if await matchmaker.wait_for_match(user, config.human_match_timeout):
+                    await _session_handler(user, db, logger)
+                    return
             if peer:
                 session_id = user.session_id or get_id() # Fallback for safety
                 session = APISession(users=[user, peer], history=History(), session_id=session_id)
-                users_session[session_id] = session
-                del users_waiting[user.user_id]
-                del users_waiting[peer.user_id]
-                
-                await peer.ws.send_json(Established(session_id=session_id).dict())
-                await user.ws.send_json(Established(session_id=session_id).dict())
+                registry.add_session(session)
+                # 相手が他のワーカにいる場合、そのワーカにも同じセッションが作られる
+                await matchmaker.complete(user, peer, session)
+                await matchmaker.notify_positions(peer.role)
                 await _session_handler(user, db, logger)
             else:
                 assistant = _find_peer_ai(user)
@@ -455,7 +682,7 @@ def api(config):
                         return
 
                     # Check if session already exists in the database
-                    db_session = db.query(SessionModel).filter(SessionModel.session_id == session_id).first()
+                    db_session = (await db.execute(select(SessionModel).where(SessionModel.session_id == session_id))).scalars().first()
 
                     if not db_session:
                         # Create a new session record in the database only if it doesn't exist
@@ -468,8 +695,13 @@ def api(config):
                             status='active'
                         )
                         db.add(db_session)
-                        db.commit()
-                        db.refresh(db_session)
+                        await db.commit()
+                        await db.refresh(db_session)
+                        # 以降のログはlog_message()からスナップショットにも追記される
+                        patient_info = {}
+                        if user.role == "保健師" and db_session.patient_id and role_provider.index is not None:
+                            patient_info = role_provider.get_patient_details(db_session.patient_id)
+                        session_cache.put_session_row(db_session, patient_info)
 
                     # Reuse or create thread_id and interview_date
                     interview_date_str = db_session.interview_date
@@ -478,55 +710,60 @@ def api(config):
                         logger.info(f"Reusing existing thread_id: {assistant.thread_id}")
                         prompt_needed = False
                     else:
-                        assistant.thread_id = await oaw.create_thread()
-                        db_session.thread_id = assistant.thread_id
-                        # interview_date is set below, so commit together
+                        # The thread is created below, already seeded with the prompt,
+                        # and committed together with interview_date
                         prompt_needed = True
 
                     history = History(assistant={"role": assistant.role, "assistant_id": assistant.assistant_id})
-                    session = APISession(users=[user, assistant], history=history, session_id=session_id)
-                    users_session[session_id] = session
-                    del users_waiting[user.user_id]
+                    session = APISession(users=[user, assistant], history=history, session_id=session_id,
+                                         role_data=role_provider.data)
+                    await matchmaker.leave(user.user_id)
+                    registry.add_session(session)
 
                     if assistant.role == "患者":
                         patient_id_for_ai = user.target_patient_id or "1"
                         
                         if prompt_needed:
-                            prompt_chunks, interview_date_str = role_provider.get_patient_prompt_chunks(patient_id_for_ai)
+                            warm = thread_pool.claim(patient_id_for_ai)
+                            if warm:
+                                # 事前に用意されたスレッドを使う
+                                logger.info(f"Using warm thread {warm.thread_id} for patient {patient_id_for_ai}")
+                                prompt_chunks, interview_date_str = warm.prompt_chunks, warm.interview_date_str
+                                assistant.thread_id = warm.thread_id
+                                await _record_prompt_chunks(session_id, user, patient_id_for_ai, prompt_chunks, history)
+                            else:
+                                prompt_chunks, interview_date_str = role_provider.get_patient_prompt_chunks(patient_id_for_ai, data=session.role_data)
+                                if interview_date_str:
+                                    assistant.thread_id = await _create_seeded_thread(session_id, user, patient_id_for_ai, prompt_chunks, history)
+                                else:
+                                    assistant.thread_id = await oaw.create_thread(session_id)
+                            db_session.thread_id = assistant.thread_id
                             db_session.interview_date = interview_date_str
-                            db.commit()
+                            await db.commit()
+                            session_cache.update_session(session_id, thread_id=assistant.thread_id, interview_date=interview_date_str)
                             logger.info(f"Saved new interview_date: {interview_date_str}")
-                        else:
-                            prompt_chunks, _ = role_provider.get_patient_prompt_chunks(patient_id_for_ai, interview_date_str=db_session.interview_date)
 
                         if prompt_needed and interview_date_str:
-                            for chunk in prompt_chunks:
-                                await oaw.add_message_to_thread(assistant.thread_id, chunk)
-                                history.history.append(MessageInfo(role="system", text=chunk))
-                                await log_message(db, session_id, user.user_name, patient_id_for_ai, user.role, "System", chunk, logger)
-                            
-                            patient_details = role_provider.get_patient_details(patient_id_for_ai)
+                            patient_details = role_provider.get_patient_details(patient_id_for_ai, data=session.role_data)
                             patient_name = patient_details.get("name", "名無し")
                             initial_bot_message = f"私の名前は{patient_name}です。何でも聞いてください。"
                             history.history.append(MessageInfo(role="患者", text=initial_bot_message))
-                            await log_message(db, session_id, "AI", patient_id_for_ai, "患者", "Assistant", initial_bot_message, logger, is_initial_message=True)
+                            await log_message(session_id, "AI", patient_id_for_ai, "患者", "Assistant", initial_bot_message, logger, is_initial_message=True)
                         elif prompt_needed:
                              logger.error(f"Failed to generate prompt for patient ID {patient_id_for_ai}")
 
                     elif assistant.role == "保健師":
                         if prompt_needed:
                             interview_date_str = datetime.now().strftime("%Y年%m月%d日")
-                            db_session.interview_date = interview_date_str
-                            db.commit()
-
                             prompt_chunks, initial_bot_message = role_provider.get_interviewer_prompt_chunks()
-                            for chunk in prompt_chunks:
-                                await oaw.add_message_to_thread(assistant.thread_id, chunk)
-                                history.history.append(MessageInfo(role="system", text=chunk))
-                                await log_message(db, session_id, user.user_name, "N/A", user.role, "System", chunk, logger)
+                            assistant.thread_id = await _create_seeded_thread(session_id, user, "N/A", prompt_chunks, history)
+                            db_session.thread_id = assistant.thread_id
+                            db_session.interview_date = interview_date_str
+                            await db.commit()
+                            session_cache.update_session(session_id, thread_id=assistant.thread_id, interview_date=interview_date_str)
                             
                             history.history.append(MessageInfo(role="保健師", text=initial_bot_message))
-                            await log_message(db, session_id, "AI", assistant.assistant_id, "保健師", "Assistant", initial_bot_message, logger, is_initial_message=True)
+                            await log_message(session_id, "AI", assistant.assistant_id, "保健師", "Assistant", initial_bot_message, logger, is_initial_message=True)
                             await user.ws.send_json(MessageForwarded(session_id=session_id, user_msg=initial_bot_message).dict())
 
                     final_interview_date = db_session.interview_date or db_session.created_at.strftime("%Y年%m月%d日")
@@ -534,130 +771,197 @@ def api(config):
                     await _session_handler(user, db, logger, oaw)
                 else:
                     await user.ws.send_json(Prepared().dict())
-                    await _session_handler(user, db, logger)
+                    if await matchmaker.wait_for_match(user):
+                        await _session_handler(user, db, logger)
         except WebSocketDisconnect:
             logger.debug(f"WS Exception: {user.user_id}")
         finally:
-            if user_id in users_waiting: del users_waiting[user_id]
+            await matchmaker.leave(user_id)
             session = _find_user_session(user_id)
             if session:
+                registry.remove_session(session.session_id)
                 for u in session.users:
-                    if u.user_id != user_id and hasattr(u, 'ws') and u.ws:
-                        await u.ws.close(code=1001)
-                del users_session[session.session_id]
-
-    async def _session_handler(user: UserDef, db: Session, logger, oaw: OpenAIAssistantWrapper = None):
+                    if u.user_id != user_id and isinstance(u, UserDef):
+                        try:
+                            await session_store.send(u, close=True, code=1001)
+                        except Exception as e:
+                            logger.debug(f"Failed to close the peer {u.user_id}: {e}")
+
+    async def _record_prompt_chunks(session_id: str, user: UserDef, patient_id: str, prompt_chunks: List[str], history: History):
+        """スレッドに投入したプロンプトのチャンクを、履歴とログに残す。"""
+        history.history.extend(MessageInfo(role="system", text=chunk) for chunk in prompt_chunks)
+        records = [_chat_log_record(session_id, user.user_name, patient_id, user.role, "System", chunk) for chunk in prompt_chunks]
+        await log_messages(records, logger)
+
+    async def _create_seeded_thread(session_id: str, user: UserDef, patient_id: str, prompt_chunks: List[str], history: History) -> str:
+        """プロンプトのチャンクを投入済みのスレッドを作成する。チャンクのログ書き込みは並行して行う。"""
+        thread_id, _ = await asyncio.gather(
+            oaw.create_seeded_thread(prompt_chunks, session_id),
+            _record_prompt_chunks(session_id, user, patient_id, prompt_chunks, history),
+        )
+        return thread_id
+
+    async def _send_to_ai(user: UserDef, session: APISession, peer: AssistantDef, text: str, tools=None,
+                          add_message: bool = True, on_added=None):
+        """AIにメッセージを送る。stream_responsesが有効なら応答の断片を逐次クライアントへ転送する。"""
+        if not config.stream_responses:
+            return await oaw.send_message(peer, text, tools=tools, add_message=add_message, on_added=on_added)
+
+        async def forward_delta(delta: str):
+            await user.ws.send_json(MessageDelta(session_id=session.session_id, delta=delta).dict())
+        return await oaw.stream_message(peer, text, on_delta=forward_delta, tools=tools,
+                                        add_message=add_message, on_added=on_added)
+
+    async def _session_handler(user: UserDef, setup_db: AsyncSession, logger, oaw: OpenAIAssistantWrapper = None):
+        """
+        セッション中のWSのメッセージを処理する。受信と発言の処理はSessionPipelineで分け、
+        AIの応答を待っている間もContinue/Debriefing/EndSessionを受け付ける。
+        各処理はキャンセルされることがあるため、DBは操作ごとに短いセッションで扱う。
+        """
         session = _find_user_session(user.user_id)
         if not session: return
-
-        try:
-            while True:
-                data = await user.ws.receive_json()
-                msg_type = data.get("msg_type")
-
-                if msg_type == MsgType.MessageSubmitted.name:
-                    m = MessageSubmitted.model_validate(data)
-                    await log_message(db, session.session_id, user.user_name, user.target_patient_id, user.role, "User", m.user_msg, logger, is_initial_message=False)
-                    session.history.history.append(MessageInfo(role=user.role, text=m.user_msg))
-
-                    for peer in session.users:
-                        if peer.user_id == user.user_id: continue
-                        
-                        if isinstance(peer, AssistantDef) and oaw:
-                            try:
-                                # ロールに応じてFunction Callingを制御
-                                tools_param = None # デフォルト（保健師ロール）
-                                if user.role == "患者":
-                                    tools_param = [] # 患者ロールの場合は無効化
-
-                                response_msg, tool_call = await oaw.send_message(
-                                    peer, m.user_msg, tools=tools_param
-                                )
-                            except NotFoundError:
-                                logger.warning(f"Thread {peer.thread_id} not found. Recreating thread...")
-                                # スレッドを再作成し、DBとセッション情報を更新
-                                new_thread_id = await oaw.create_thread()
-                                peer.thread_id = new_thread_id
-                                db_session = db.query(SessionModel).filter(SessionModel.session_id == session.session_id).first()
-                                if db_session:
-                                    db_session.thread_id = new_thread_id
-                                    db.commit()
-                                
-                                # プロンプトを再注入する必要がある
-                                if peer.role == "患者":
-                                    patient_id_for_ai = user.target_patient_id or "1"
-                                    prompt_chunks, _ = role_provider.get_patient_prompt_chunks(patient_id_for_ai, interview_date_str=db_session.interview_date if db_session else None)
-                                    for chunk in prompt_chunks:
-                                        await oaw.add_message_to_thread(peer.thread_id, chunk)
-                                elif peer.role == "保健師":
-                                    prompt_chunks, _ = role_provider.get_interviewer_prompt_chunks()
-                                    for chunk in prompt_chunks:
-                                        await oaw.add_message_to_thread(peer.thread_id, chunk)
-
-                                logger.info(f"Re-sending message to new thread {new_thread_id}")
-                                response_msg, tool_call = await oaw.send_message(peer, m.user_msg)
-
-                            if tool_call and tool_call.function.name == "end_conversation_and_start_debriefing":
-                                # LLMが会話の終了を判断した場合、クライアントに通知して確認を促す
-                                logger.info(f"Tool call detected: {tool_call.function.name}. Notifying client...")
-                                await user.ws.send_json(ToolCallDetected(session_id=session.session_id).dict())
-                            elif response_msg:
-                                if response_msg.startswith("FAILED:"):
-                                    # エラー応答
-                                    logger.error(f"AI response failed: {response_msg}")
-                                    await user.ws.send_json(MessageRejected(session_id=session.session_id, reason=response_msg).dict())
-                                else:
-                                    # 通常のテキスト応答
-                                    session.history.history.append(MessageInfo(role=peer.role, text=response_msg))
-                                    await log_message(db, session.session_id, "AI", peer.assistant_id, peer.role, "Assistant", response_msg, logger, is_initial_message=False)
-                                    await user.ws.send_json(MessageForwarded(session_id=session.session_id, user_msg=response_msg).dict())
-                        elif isinstance(peer, UserDef):
-                            await log_message(db, session.session_id, peer.user_name, peer.target_patient_id, peer.role, "Assistant", m.user_msg, logger, is_initial_message=False)
-                            await peer.ws.send_json(MessageForwarded(session_id=session.session_id, user_msg=m.user_msg).dict())
-
-                elif msg_type == MsgType.DebriefingRequest.name:
-                    m = DebriefingRequest.model_validate(data)
-                    logger.info(f"DebriefingRequest received from user: {m.user_id}")
-                    await _execute_debriefing(session, user, db, logger, oaw)
-
-                elif msg_type == MsgType.ContinueConversationRequest.name:
-                    m = ContinueConversationRequest.model_validate(data)
-                    logger.info(f"ContinueConversationRequest received from user: {m.user_id}")
-                    peer_ai = next((p for p in session.users if isinstance(p, AssistantDef)), None)
-                    if peer_ai and oaw:
-                        cancelled = await oaw.cancel_run(peer_ai.thread_id)
-                        if cancelled:
-                            logger.info(f"Run cancelled for thread {peer_ai.thread_id}. Notifying client to continue.")
-                            await user.ws.send_json(ConversationContinueAccepted(session_id=session.session_id).dict())
+        # セッション確立までに使ったコネクションを、WSの待ち受け中は保持しない
+        await setup_db.close()
+
+        async def on_messages(batch: MessageBatch) -> Optional[SessionState]:
+            # Continueで取り消されて処理し直す場合は、batchに記録した済んだ処理を飛ばす
+            messages = batch.messages
+            for m in messages[batch.recorded:]:
+                await log_message(session.session_id, user.user_name, user.target_patient_id, user.role, "User", m.user_msg, logger, is_initial_message=False)
+                session.history.history.append(MessageInfo(role=user.role, text=m.user_msg))
+                batch.recorded += 1
+
+            for peer in session.users:
+                if peer.user_id == user.user_id: continue
+
+                if isinstance(peer, AssistantDef) and oaw:
+                    # AIの応答を待つ間に届いた発言は、まとめて1回のrunで送る
+                    request_text = "\n".join(m.user_msg for m in messages)
+
+                    def on_added():
+                        batch.delivered = len(messages)
+                    try:
+                        # ロールに応じてFunction Callingを制御
+                        tools_param = None # デフォルト（保健師ロール）
+                        if user.role == "患者":
+                            tools_param = [] # 患者ロールの場合は無効化
+
+                        # スレッドに追加済みなら、取り消されたrunだけをやり直す
+                        response_msg, tool_call = await _send_to_ai(
+                            user, session, peer, request_text, tools=tools_param,
+                            add_message=batch.delivered < len(messages), on_added=on_added
+                        )
+                    except openai.NotFoundError:
+                        logger.warning(f"Thread {peer.thread_id} not found. Recreating thread...")
+                        async with modelDatabase.SessionLocal() as db:
+                            db_session = (await db.execute(select(SessionModel).where(SessionModel.session_id == session.session_id))).scalars().first()
+
+                        # プロンプトを再注入する必要がある
+                        prompt_chunks = []
+                        if peer.role == "患者":
+                            patient_id_for_ai = user.target_patient_id or "1"
+                            prompt_chunks, _ = role_provider.get_patient_prompt_chunks(patient_id_for_ai, interview_date_str=db_session.interview_date if db_session else None, data=session.role_data)
+                        elif peer.role == "保健師":
+                            prompt_chunks, _ = role_provider.get_interviewer_prompt_chunks()
+
+                        # プロンプト投入済みのスレッドを再作成し、DBとセッション情報を更新
+                        new_thread_id = await oaw.create_seeded_thread(prompt_chunks, session.session_id)
+                        peer.thread_id = new_thread_id
+                        if db_session:
+                            async with modelDatabase.SessionLocal() as db:
+                                await db.execute(update(SessionModel).where(
+                                    SessionModel.session_id == session.session_id
+                                ).values(thread_id=new_thread_id))
+                                await db.commit()
+                        session_cache.update_session(session.session_id, thread_id=new_thread_id)
+
+                        logger.info(f"Re-sending message to new thread {new_thread_id}")
+                        response_msg, tool_call = await _send_to_ai(user, session, peer, request_text, on_added=on_added)
+                    batch.done = True
+
+                    if tool_call and tool_call.function.name == "end_conversation_and_start_debriefing":
+                        # LLMが会話の終了を判断した場合、クライアントに通知して確認を促す
+                        logger.info(f"Tool call detected: {tool_call.function.name}. Notifying client...")
+                        await user.ws.send_json(ToolCallDetected(session_id=session.session_id).dict())
+                        # runはrequires_actionのままなので、Continueまで次の発言を送らない
+                        return SessionState.AwaitingAction
+                    elif response_msg:
+                        if response_msg.startswith("FAILED:"):
+                            # エラー応答
+                            logger.error(f"AI response failed: {response_msg}")
+                            await user.ws.send_json(MessageRejected(session_id=session.session_id, reason=response_msg).dict())
                         else:
-                            logger.warning(f"Failed to cancel run for thread {peer_ai.thread_id}. Client might be stuck.")
-
-                elif msg_type == MsgType.EndSessionRequest.name:
-                    m = EndSessionRequest.model_validate(data)
-                    await _save_history(session.session_id, session.history, logger)
-                    
-                    # Mark session as completed in the new table
-                    db_session = db.query(SessionModel).filter(SessionModel.session_id == session.session_id).first()
-                    if db_session:
-                        db_session.status = 'completed'
-                        db_session.completed_at = datetime.now()
-                        db.commit()
-
-                    for u in session.users:
-                        if hasattr(u, 'ws') and u.ws:
-                            reason = "EndSession request is accepted." if u.user_id == m.user_id else "Peer sent the end of session."
-                            await u.ws.send_json(SessionTerminated(session_id=session.session_id, reason=reason).dict())
-                            await u.ws.close()
-                        if isinstance(u, AssistantDef) and oaw:
-                            await oaw.delete_thread(u)
-                    break
+                            # 通常のテキスト応答
+                            session.history.history.append(MessageInfo(role=peer.role, text=response_msg))
+                            await log_message(session.session_id, "AI", peer.assistant_id, peer.role, "Assistant", response_msg, logger, is_initial_message=False)
+                            await user.ws.send_json(MessageForwarded(session_id=session.session_id, user_msg=response_msg).dict())
+                elif isinstance(peer, UserDef):
+                    for m in messages[batch.delivered:]:
+                        # 相手のWSが他のワーカにある場合は、そのワーカに転送される
+                        await session_store.send(peer, MessageForwarded(session_id=session.session_id, user_msg=m.user_msg).dict())
+                        batch.delivered += 1
+                        await log_message(session.session_id, peer.user_name, peer.target_patient_id, peer.role, "Assistant", m.user_msg, logger, is_initial_message=False)
+                    batch.done = True
+            return None
+
+        async def on_overflow(m: MessageSubmitted):
+            logger.warning(f"Too many pending messages in session {session.session_id}. Rejected a message.")
+            await user.ws.send_json(MessageRejected(session_id=session.session_id, reason="Too many messages are pending.").dict())
+
+        async def on_debriefing(data: dict):
+            m = DebriefingRequest.model_validate(data)
+            logger.info(f"DebriefingRequest received from user: {m.user_id}")
+            await _execute_debriefing(session, user, logger, oaw)
+
+        async def on_continue(data: dict):
+            m = ContinueConversationRequest.model_validate(data)
+            logger.info(f"ContinueConversationRequest received from user: {m.user_id}")
+            peer_ai = next((p for p in session.users if isinstance(p, AssistantDef)), None)
+            if peer_ai and oaw:
+                cancelled = await oaw.cancel_run(peer_ai.thread_id)
+                if cancelled:
+                    logger.info(f"Run cancelled for thread {peer_ai.thread_id}. Notifying client to continue.")
+                    await user.ws.send_json(ConversationContinueAccepted(session_id=session.session_id).dict())
+                else:
+                    logger.warning(f"Failed to cancel run for thread {peer_ai.thread_id}. Client might be stuck.")
+
+        async def on_end_session(data: dict):
+            m = EndSessionRequest.model_validate(data)
+            try:
+                await history_archive.save(session.session_id, session.history)
+                logger.debug(f"History has been archived for session {session.session_id}")
+            except Exception as e:
+                logger.error(f"Failed to archive history for session {session.session_id}: {e}")
+
+            # Mark session as completed in the new table
+            async with modelDatabase.SessionLocal() as db:
+                await db.execute(update(SessionModel).where(
+                    SessionModel.session_id == session.session_id
+                ).values(status='completed', completed_at=datetime.now()))
+                await db.commit()
+            session_cache.invalidate(session.session_id)
+
+            for u in session.users:
+                if isinstance(u, UserDef):
+                    reason = "EndSession request is accepted." if u.user_id == m.user_id else "Peer sent the end of session."
+                    await session_store.send(u, SessionTerminated(session_id=session.session_id, reason=reason).dict(), close=True)
+                if isinstance(u, AssistantDef) and oaw:
+                    await oaw.delete_thread(u)
+
+        pipeline = SessionPipeline(user.ws, logger, on_messages,
+                                   config.session_max_pending, config.coalesce_messages)
+        pipeline.on_overflow = on_overflow
+        pipeline.add_control(MsgType.ContinueConversationRequest.name, on_continue)
+        pipeline.add_control(MsgType.DebriefingRequest.name, on_debriefing, JOB, SessionState.Debriefing)
+        pipeline.add_control(MsgType.EndSessionRequest.name, on_end_session, FINAL)
+        try:
+            await pipeline.run()
         except WebSocketDisconnect:
             logger.debug(f"WS Disconnect in session: {user.user_id}")
         except Exception as e:
             logger.error(f"Error in session handler: {e}")
         finally:
-            if session.session_id in users_session:
-                del users_session[session.session_id]
+            registry.remove_session(session.session_id)
 
     app.mount("/", StaticFiles(directory=config.www_path, html=True), name="www")
     return app
@@ -18,9 +18,56 @@ class ChatConfigModel(BaseModel):
     enable_debug: bool = False
     tz: str = "Asia/Tokyo"
     max_queue_size: int = 100
+    registration_ttl: float = 60
+    human_match_timeout: float = 0
     assistants_storage: str
-    gdrive_file_id: str
-    gdrive_service_account: str
+    role_source: str = "gdrive"
+    role_source_path: str = ""
+    role_source_table: str = "patients"
+    gdrive_file_id: str = ""
+    gdrive_service_account: str = ""
+    log_queue_size: int = 10000
+    log_batch_size: int = 100
+    log_flush_interval: float = 0.5
+    patient_prompt_cache_size: int = 256
+    frame_cache_dir: str = ""
+    role_refresh_interval: float = 300
+    stream_responses: bool = False
+    openai_max_concurrency: int = 16
+    openai_rpm: int = 0
+    openai_tpm: int = 0
+    openai_run_tokens: int = 4000
+    openai_max_retries: int = 5
+    openai_backoff_base: float = 1.0
+    openai_backoff_max: float = 60
+    openai_backend: str = "openai"
+    fake_latency_ms: float = 1000
+    fake_latency_sigma: float = 0.5
+    fake_request_latency_ms: float = 50
+    fake_response_chars: int = 100
+    fake_stream_chunks: int = 10
+    fake_failure_rate: float = 0
+    fake_tool_call_rate: float = 0
+    fake_rate_limit_rate: float = 0
+    fake_retry_after: float = 1
+    fake_seed: Optional[int] = None
+    thread_pool_size: int = 0
+    thread_pool_patients: int = 5
+    thread_pool_ttl: float = 3600
+    thread_pool_refill_interval: float = 30
+    thread_pool_demand_halflife: float = 1800
+    session_cache_size: int = 1000
+    session_cache_ttl: float = 3600
+    history_archive_path: str = "history"
+    session_max_pending: int = 10
+    coalesce_messages: bool = True
+    session_store: str = "memory"
+    session_store_path: str = "session_store.db"
+    session_store_poll_interval: float = 0.05
+    session_store_node_ttl: float = 10
+    enable_profiling: bool = False
+    admin_token_storage: str = "env:PEN_ADMIN_TOKEN"
+    slow_callback_ms: float = 0
 
 def __from_args(args):
     ap = ArgumentParser(
@@ -0,0 +1,152 @@
+import asyncio
+from time import perf_counter
+from typing import Dict, List
+from sqlalchemy import insert
+
+import modelDatabase
+from metrics import REGISTRY
+
+FLUSH_SECONDS = REGISTRY.histogram(
+    "chat_log_flush_seconds", "Time to insert and commit one batch of chat logs.")
+FLUSHED_RECORDS = REGISTRY.counter(
+    "chat_log_records_total", "Chat log records written, by result.", ("result",))
+
+class ChatLogWriter():
+    """
+    ChatLogの書き込みを呼び出し側から切り離してまとめて行う。
+    呼び出し側は put() でキューに積むだけで、専用タスクが
+    flush_interval 秒ごと、または batch_size 件たまるごとに
+    複数行INSERTと1回のcommitでまとめて書き込む。
+    """
+    def __init__(self, config):
+        self.logger = config.logger
+        self.batch_size = max(1, config.log_batch_size)
+        self.flush_interval = config.log_flush_interval
+        self.queue = asyncio.Queue(maxsize=config.log_queue_size)
+        self.task = None
+        # session_id -> キューに積まれ、まだ書き込みの終わっていないログの数
+        self.unwritten: Dict[str, int] = {}
+        self.written = asyncio.Condition()
+        # metrics
+        self.enqueued_records = 0
+        self.flushed_records = 0
+        self.failed_records = 0
+        self.flush_count = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """キューに残っているログを全て書き込んでから停止する。"""
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        self.logger.info(f"ChatLogWriter stopped. {self.stats()}")
+
+    async def put(self, record: dict):
+        """
+        ChatLogの1行分(カラム名をキーとした辞書)をキューに積む。
+        キューが一杯の場合は空きができるまで待つ。
+        """
+        await self.queue.put(record)
+        self._count(record)
+        self.enqueued_records += 1
+
+    async def put_many(self, records: List[dict]):
+        """複数のログを順序を保ったままキューに積む。"""
+        for record in records:
+            await self.queue.put(record)
+            self._count(record)
+        self.enqueued_records += len(records)
+
+    async def wait_written(self, session_id: str):
+        """session_idのログのうち、これまでに積まれたものの書き込みが終わるまで待つ。"""
+        if self.task is None:
+            return
+        async with self.written:
+            await self.written.wait_for(lambda: not self.unwritten.get(session_id))
+
+    def _count(self, record: dict):
+        session_id = record["session_id"]
+        self.unwritten[session_id] = self.unwritten.get(session_id, 0) + 1
+
+    async def _next_batch(self) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._flush(batch)
+            finally:
+                for record in batch:
+                    session_id = record["session_id"]
+                    self.unwritten[session_id] -= 1
+                    if not self.unwritten[session_id]:
+                        del self.unwritten[session_id]
+                    self.queue.task_done()
+            async with self.written:
+                self.written.notify_all()
+
+    async def _flush(self, batch: List[dict]):
+        t0 = perf_counter()
+        try:
+            await self._write_batch(batch)
+            self.flushed_records += len(batch)
+            FLUSHED_RECORDS.inc(len(batch), result="ok")
+        except Exception as e:
+            self.failed_records += len(batch)
+            FLUSHED_RECORDS.inc(len(batch), result="failed")
+            self.logger.error(f"Failed to write {len(batch)} chat logs: {e}")
+        latency = perf_counter() - t0
+        FLUSH_SECONDS.observe(latency)
+        self.flush_count += 1
+        self.last_flush_latency = latency
+        self.total_flush_latency += latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.logger.debug(f"Flushed {len(batch)} chat logs in {latency*1000:.1f} ms")
+
+    async def _write_batch(self, batch: List[dict]):
+        async with modelDatabase.SessionLocal() as db:
+            await db.execute(insert(modelDatabase.ChatLog), batch)
+            await db.commit()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_maxsize": self.queue.maxsize,
+            "enqueued_records": self.enqueued_records,
+            "flushed_records": self.flushed_records,
+            "failed_records": self.failed_records,
+            "flush_count": self.flush_count,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+            "avg_flush_latency": (self.total_flush_latency / self.flush_count
+                                  if self.flush_count else 0.0),
+        }
@@ -0,0 +1,78 @@
+from __future__ import annotations
+import glob
+import os
+import tempfile
+from datetime import datetime
+from typing import Optional
+
+from lazyimport import is_available, lazy_import
+
+pd = lazy_import("pandas")
+# pyarrowは使う時に読み込む
+HAS_PYARROW = is_available("pyarrow")
+
+# datetimeの列名 (行動履歴の日付) を文字列の列名として保存する際の接頭辞
+DATETIME_COLUMN_PREFIX = "__datetime__:"
+
+class FrameCache():
+    """
+    読み込んだシートを、バージョン (etag) ごとのファイルに保存する。
+    pyarrowがあればArrow IPC (Feather V2) 形式で保存し、読み込み時はmemory mapする。
+    無ければpickleで保存する。
+    ファイルはdirectory (省略時は一時ディレクトリのchatserver) に置く。
+    """
+    def __init__(self, prefix: str = "cached_data", directory: Optional[str] = None):
+        self.prefix = prefix
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "chatserver")
+        self.suffix = ".arrow" if HAS_PYARROW else ".pkl"
+
+    def path(self, version: str) -> str:
+        return os.path.join(self.directory, f"{self.prefix}-{version}{self.suffix}")
+
+    def load(self, version: Optional[str]) -> Optional[pd.DataFrame]:
+        if not version or not os.path.exists(self.path(version)):
+            return None
+        if not HAS_PYARROW:
+            return pd.read_pickle(self.path(version))
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(self.path(version), memory_map=True)
+        df = table.to_pandas()
+        df.columns = [_decode_column(c) for c in df.columns]
+        return df
+
+    def save(self, df: pd.DataFrame, version: str):
+        """versionのファイルを書き、それ以外のバージョンのファイルを削除する。"""
+        path = self.path(version)
+        tmp = path + ".tmp"
+        os.makedirs(self.directory, exist_ok=True)
+        if not HAS_PYARROW:
+            df.to_pickle(tmp)
+        else:
+            import pyarrow.feather
+            pyarrow.feather.write_feather(_to_table(df), tmp, compression="uncompressed")
+        os.replace(tmp, path)
+        for old in glob.glob(os.path.join(glob.escape(self.directory), f"{glob.escape(self.prefix)}-*")):
+            if old != path and not old.endswith(".tmp"):
+                os.remove(old)
+
+def _encode_column(name) -> str:
+    if isinstance(name, datetime):
+        return DATETIME_COLUMN_PREFIX + name.isoformat()
+    return str(name)
+
+def _decode_column(name: str):
+    if name.startswith(DATETIME_COLUMN_PREFIX):
+        return datetime.fromisoformat(name[len(DATETIME_COLUMN_PREFIX):])
+    return name
+
+def _to_table(df: pd.DataFrame):
+    import pyarrow
+    arrays = []
+    for col in df.columns:
+        series = df[col]
+        try:
+            arrays.append(pyarrow.array(series, from_pandas=True))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # 数値と文字列が混在する列などは、値を文字列にして保存する
+            arrays.append(pyarrow.array(series.map(lambda v: v if pd.isna(v) else str(v)), from_pandas=True))
+    return pyarrow.table(arrays, names=[_encode_column(c) for c in df.columns])
@@ -0,0 +1,144 @@
+import asyncio
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsではプロセス間のロックをしない
+    fcntl = None
+
+from modelHistory import History
+
+INDEX_FILE = "index.jsonl"
+
+class HistoryArchive():
+    """
+    終了したセッションの対話履歴を保存する。
+
+    - 履歴は保存日ごとのディレクトリ (root/YYYY/MM/DD/history.jsonl.gz) に、
+      1件を1つのgzipメンバとして追記する。gzipはメンバを連結したものも
+      1つのファイルとして読めるため、シャードはそのままzcatなどで読める。
+    - root/index.jsonl に session_id, シャードのパス, オフセット, 長さを追記し、
+      session_idからは該当するメンバだけを読み出す。
+    - 圧縮と書き込みはスレッドで行い、イベントループを止めない。
+    - 複数のワーカが同じrootに書くため、追記は索引ファイルのflockで排他する。
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = asyncio.Lock()
+        # session_id -> 索引のエントリ。read()で初めて読み込む。
+        self.index: Optional[Dict[str, dict]] = None
+
+    def shard_path(self, saved_at: datetime) -> str:
+        return os.path.join(saved_at.strftime("%Y"), saved_at.strftime("%m"),
+                            saved_at.strftime("%d"), "history.jsonl.gz")
+
+    async def save(self, session_id: str, history: History) -> dict:
+        """履歴を追記し、索引のエントリを返す。"""
+        saved_at = datetime.now(timezone.utc)
+        record = {"session_id": session_id, "saved_at": saved_at.isoformat(), **history.model_dump()}
+        data = await asyncio.to_thread(_compress_record, record)
+        entry = {"session_id": session_id, "shard": self.shard_path(saved_at),
+                 "length": len(data), "saved_at": record["saved_at"]}
+        # このプロセスの中では1件ずつ書き、スレッドを占有しない
+        async with self.lock:
+            entry["offset"] = await asyncio.to_thread(self._append, entry, data)
+        if self.index is not None:
+            self.index[session_id] = entry
+        return entry
+
+    def _append(self, entry: dict, data: bytes) -> int:
+        """
+        シャードにdataを追記し、索引にentryを書いて、追記したオフセットを返す。
+        他のワーカの追記とオフセットの取得が入れ替わらないよう、索引ファイルをロックする。
+        """
+        path = os.path.join(self.root, entry["shard"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(os.path.join(self.root, INDEX_FILE), "a", encoding="utf-8") as index_fd:
+            if fcntl is not None:
+                fcntl.flock(index_fd, fcntl.LOCK_EX)
+            try:
+                with open(path, "ab") as fd:
+                    offset = fd.seek(0, os.SEEK_END)
+                    fd.write(data)
+                entry = {**entry, "offset": offset}
+                index_fd.write(json.dumps(entry) + "\n")
+                index_fd.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(index_fd, fcntl.LOCK_UN)
+        return offset
+
+    # --- reader ---
+    def load_index(self) -> Dict[str, dict]:
+        """索引を読み込む。同じsession_idが複数あれば後のものを使う。"""
+        index = {}
+        try:
+            with open(os.path.join(self.root, INDEX_FILE), encoding="utf-8") as fd:
+                for line in fd:
+                    if line.strip():
+                        entry = json.loads(line)
+                        index[entry["session_id"]] = entry
+        except FileNotFoundError:
+            pass
+        self.index = index
+        return index
+
+    def read_record(self, session_id: str) -> Optional[dict]:
+        """session_idの保存内容 (session_id, saved_at, 履歴) を返す。無ければNone。"""
+        loaded = self.index is None
+        index = self.load_index() if loaded else self.index
+        entry = index.get(session_id)
+        if entry is None and not loaded:
+            # 他のワーカが後から保存したものかもしれない
+            entry = self.load_index().get(session_id)
+        if entry is None:
+            return None
+        with open(os.path.join(self.root, entry["shard"]), "rb") as fd:
+            fd.seek(entry["offset"])
+            data = fd.read(entry["length"])
+        return json.loads(gzip.decompress(data))
+
+    def read(self, session_id: str) -> Optional[History]:
+        """session_idの履歴を返す。無ければNone。"""
+        record = self.read_record(session_id)
+        if record is None:
+            return None
+        return History.model_validate(record)
+
+    def iter_histories(self, date_from: Optional[str] = None, date_to: Optional[str] = None) -> Iterator[Tuple[str, History]]:
+        """
+        保存日がdate_from以上date_to以下 (YYYY-MM-DD) のシャードを日付順に読み、
+        (session_id, 履歴) を返す。索引は使わない。
+        """
+        for day, path in self._shards():
+            if (date_from and day < date_from) or (date_to and day > date_to):
+                continue
+            with gzip.open(path, "rt", encoding="utf-8") as fd:
+                for line in fd:
+                    if line.strip():
+                        record = json.loads(line)
+                        yield record["session_id"], History.model_validate(record)
+
+    def _shards(self) -> Iterator[Tuple[str, str]]:
+        if not os.path.isdir(self.root):
+            return
+        for year in sorted(os.listdir(self.root)):
+            year_dir = os.path.join(self.root, year)
+            if not (year.isdigit() and os.path.isdir(year_dir)):
+                continue
+            for month in sorted(os.listdir(year_dir)):
+                month_dir = os.path.join(year_dir, month)
+                if not os.path.isdir(month_dir):
+                    continue
+                for day in sorted(os.listdir(month_dir)):
+                    path = os.path.join(month_dir, day, "history.jsonl.gz")
+                    if os.path.isfile(path):
+                        yield f"{year}-{month}-{day}", path
+
+def _compress_record(record: dict) -> bytes:
+    return gzip.compress((json.dumps(record, ensure_ascii=False) + "\n").encode())
@@ -0,0 +1,34 @@
+import importlib
+import importlib.util
+import sys
+from types import ModuleType
+
+class LazyModule(ModuleType):
+    """
+    属性に初めてアクセスした時に、同じ名前のモジュールを読み込むプロキシ。
+    読み込み自体は通常のimportで行うため、複数のスレッドから使っても安全。
+    """
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        value = getattr(module, attr)
+        # 2回目からはこのモジュールの属性として見つかる
+        setattr(self, attr, value)
+        return value
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    nameのモジュールを、属性に初めてアクセスした時に読み込む。
+    pandasやopenaiのように読み込みに時間のかかるモジュールを、起動時ではなく
+    最初に使う時まで遅らせるために使う。
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+    return LazyModule(name)
+
+def is_available(name: str) -> bool:
+    """nameのモジュールが読み込めるか。モジュール自体は読み込まない。"""
+    if name in sys.modules:
+        return True
+    return importlib.util.find_spec(name) is not None
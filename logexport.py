@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+"""
+対話ログ (chat_logs) をセッション情報とともにNDJSON/CSV/Parquetで書き出す。
+行はサーバサイドカーソルでexport_batch_size件ずつ読み、読んだ分だけ
+エンコードして出力するため、件数によらずメモリ使用量は一定になる。
+
+    python logexport.py -f csv --gzip --from 2025-01-01 --to 2025-02-01 -o logs.csv.gz
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import modelDatabase
+from modelSession import Session as SessionModel
+
+from lazyimport import is_available
+
+# pyarrowはParquetで書き出す時に読み込む
+HAS_PYARROW = is_available("pyarrow")
+
+EXPORT_FORMATS = ("ndjson", "csv", "parquet")
+EXPORT_BATCH_SIZE = 1000
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# 書き出す列。chat_logsの列に、セッションの状態と面接日を加える。
+EXPORT_COLUMNS = {
+    "id": modelDatabase.ChatLog.id,
+    "session_id": modelDatabase.ChatLog.session_id,
+    "user_name": modelDatabase.ChatLog.user_name,
+    "patient_id": modelDatabase.ChatLog.patient_id,
+    "user_role": modelDatabase.ChatLog.user_role,
+    "sender": modelDatabase.ChatLog.sender,
+    "message": modelDatabase.ChatLog.message,
+    "is_initial_message": modelDatabase.ChatLog.is_initial_message,
+    "created_at": modelDatabase.ChatLog.created_at,
+    "session_patient_id": SessionModel.patient_id,
+    "session_status": SessionModel.status,
+    "interview_date": SessionModel.interview_date,
+}
+
+class ExportError(Exception):
+    """指定された形式では書き出せない。"""
+    pass
+
+def check_format(fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown export format: {fmt}")
+    if fmt == "parquet" and not HAS_PYARROW:
+        raise ExportError("Parquet export requires pyarrow.")
+
+def export_filename(fmt: str, compress: bool) -> str:
+    suffix = ".gz" if compress and fmt != "parquet" else ""
+    return f"chat_logs-{datetime.now().strftime('%Y%m%d%H%M%S')}.{fmt}{suffix}"
+
+def export_statement(date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                     patient_id: Optional[str] = None):
+    """
+    書き出す行のクエリ。patient_idはセッションの対象患者で絞り込む
+    (chat_logs.patient_idはAIの発言ではassistant_idになるため)。
+    """
+    ChatLog = modelDatabase.ChatLog
+    stmt = select(*EXPORT_COLUMNS.values()).outerjoin(
+        SessionModel, SessionModel.session_id == ChatLog.session_id
+    )
+    if date_from:
+        stmt = stmt.where(ChatLog.created_at >= date_from)
+    if date_to:
+        stmt = stmt.where(ChatLog.created_at < date_to)
+    if patient_id:
+        stmt = stmt.where(SessionModel.patient_id == patient_id)
+    return stmt.order_by(ChatLog.id)
+
+async def iter_batches(db: AsyncSession, stmt, batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[List[Dict]]:
+    """サーバサイドカーソルでbatch_size件ずつ行を取り出す。"""
+    result = await db.stream(stmt.execution_options(yield_per=batch_size))
+    names = list(EXPORT_COLUMNS)
+    async for partition in result.partitions():
+        yield [dict(zip(names, _plain_row(row))) for row in partition]
+
+def _plain_row(row) -> list:
+    # 日時はAPIの応答と同じくISO 8601の文字列にする
+    return [v.isoformat() if isinstance(v, datetime) else v for v in row]
+
+async def encode(batches: AsyncIterator[List[Dict]], fmt: str, compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    行のバッチを指定の形式のバイト列にして返す。
+    compressはNDJSON/CSVでは出力全体のgzip、Parquetでは列データの圧縮方式になる。
+    """
+    check_format(fmt)
+    if fmt == "ndjson":
+        chunks = _encode_ndjson(batches)
+    elif fmt == "csv":
+        chunks = _encode_csv(batches)
+    else:
+        chunks = _encode_parquet(batches, "gzip" if compress else "snappy")
+        compress = False
+    if not compress:
+        async for chunk in chunks:
+            yield chunk
+        return
+    gz = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = gz.compress(chunk)
+        if data:
+            yield data
+    yield gz.flush()
+
+async def _encode_ndjson(batches):
+    async for batch in batches:
+        yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in batch).encode()
+
+async def _encode_csv(batches):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=list(EXPORT_COLUMNS))
+    writer.writeheader()
+    async for batch in batches:
+        writer.writerows(batch)
+        yield buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+class _ChunkSink(io.RawIOBase):
+    """ParquetWriterの出力を溜め、呼び出し側が順に取り出せるようにする。"""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def _parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("id", pa.int64()),
+        ("session_id", pa.string()),
+        ("user_name", pa.string()),
+        ("patient_id", pa.string()),
+        ("user_role", pa.string()),
+        ("sender", pa.string()),
+        ("message", pa.string()),
+        ("is_initial_message", pa.bool_()),
+        ("created_at", pa.string()),
+        ("session_patient_id", pa.string()),
+        ("session_status", pa.string()),
+        ("interview_date", pa.string()),
+    ])
+
+async def _encode_parquet(batches, compression: str):
+    import pyarrow
+    import pyarrow.parquet
+    # バッチごとに1つのrow groupとして書き出す
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression=compression)
+    async for batch in batches:
+        writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    yield sink.drain()
+
+async def export_logs(fmt: str, compress: bool = False, date_from: Optional[datetime] = None,
+                      date_to: Optional[datetime] = None, patient_id: Optional[str] = None,
+                      batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[bytes]:
+    """条件に合うログを書き出す。出力の間だけDBのセッションを保持する。"""
+    check_format(fmt)
+    stmt = export_statement(date_from, date_to, patient_id)
+    async with modelDatabase.SessionLocal() as db:
+        async for chunk in encode(iter_batches(db, stmt, batch_size), fmt, compress):
+            yield chunk
+
+#
+# main
+#
+async def _main(opt):
+    import sys
+    modelDatabase.initialize_database(opt.db_url)
+    out = open(opt.output, "wb") if opt.output else sys.stdout.buffer
+    try:
+        async for chunk in export_logs(opt.format, opt.gzip, opt.date_from, opt.date_to,
+                                       opt.patient_id, opt.batch_size):
+            out.write(chunk)
+    finally:
+        if opt.output:
+            out.close()
+        await modelDatabase.close_database()
+
+if __name__ == "__main__":
+    import asyncio
+    from argparse import ArgumentParser
+    from os import environ
+    from dotenv import load_dotenv
+    load_dotenv()
+    ap = ArgumentParser(description="Export chat logs.")
+    ap.add_argument("-f", help="specify the output format.", dest="format",
+                    choices=EXPORT_FORMATS, default="ndjson")
+    ap.add_argument("-o", help="specify the output file. default is stdout.",
+                    dest="output")
+    ap.add_argument("--gzip", help="compress the output.", action="store_true")
+    ap.add_argument("--from", help="export logs created at or after this date (ISO 8601).",
+                    dest="date_from", type=datetime.fromisoformat)
+    ap.add_argument("--to", help="export logs created before this date (ISO 8601).",
+                    dest="date_to", type=datetime.fromisoformat)
+    ap.add_argument("--patient", help="export sessions of this patient only.",
+                    dest="patient_id")
+    ap.add_argument("--batch-size", help="number of rows fetched at once.",
+                    dest="batch_size", type=int, default=EXPORT_BATCH_SIZE)
+    ap.add_argument("--db", help="specify the database URL. default is DATABASE_URL.",
+                    dest="db_url", default=environ.get("DATABASE_URL"))
+    opt = ap.parse_args()
+    try:
+        check_format(opt.format)
+    except ExportError as e:
+        ap.error(str(e))
+    if not opt.db_url:
+        ap.error("DATABASE_URL is not set.")
+    asyncio.run(_main(opt))
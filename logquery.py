@@ -0,0 +1,47 @@
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+from sqlalchemy import Select, tuple_
+
+class InvalidCursor(ValueError):
+    """ページ送りのカーソルが解釈できない。"""
+    pass
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    """(created_at, id) を、次のページを取得するためのカーソル文字列にする。"""
+    raw = json.dumps([created_at.isoformat() if created_at else None, row_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return (datetime.fromisoformat(created_at) if created_at else None), int(row_id)
+    except Exception as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+def keyset_page(stmt: Select, model, cursor: Optional[str], limit: int, descending: bool = False) -> Select:
+    """
+    stmtを (created_at, id) の順に並べ、cursorの次からlimit+1件を取り出すクエリにする。
+    OFFSETを使わないため、何ページ目でも (created_at, id) の索引を辿る範囲は同じになる。
+    1件多く取るのは、次のページがあるかを判定するため。
+    """
+    key = tuple_(model.created_at, model.id)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        bound = tuple_(created_at, row_id)
+        stmt = stmt.where(key < bound if descending else key > bound)
+    if descending:
+        stmt = stmt.order_by(model.created_at.desc(), model.id.desc())
+    else:
+        stmt = stmt.order_by(model.created_at.asc(), model.id.asc())
+    return stmt.limit(limit + 1)
+
+def split_page(rows: List, limit: int) -> Tuple[List, Optional[str]]:
+    """keyset_page()の結果を、そのページの行と次のページのカーソルに分ける。"""
+    if len(rows) <= limit:
+        return list(rows), None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last.created_at, last.id)
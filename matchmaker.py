@@ -0,0 +1,190 @@
+import asyncio
+from typing import Dict, Optional
+from fastapi import WebSocketDisconnect
+
+from modelChat import Established, QueuePosition
+from modelHistory import History
+from modelUserDef import UserDef
+from sessionregistry import APISession, SessionRegistry
+from sessionstore import SessionStore, user_record
+
+PEER_ROLES = {"保健師": "患者", "患者": "保健師"}
+# 待ち行列から取り出された後、相手のノードからセッションが知らされるまで待つ秒数
+MATCH_NOTIFY_TIMEOUT = 10
+
+class QueueFull(Exception):
+    """ロールの待ち行列がmax_queue_sizeに達している。"""
+    pass
+
+class Matchmaker():
+    """
+    保健師/患者のロールごとのFIFO待ち行列で、人間同士の組み合わせを決める。
+    待ち行列と登録済みユーザはSessionStoreにあり、他のワーカのユーザとも組み合わせる。
+    このプロセスにWSのあるユーザは、SessionRegistryにも持つ。
+    ここでは受付数の制限、先頭との組み合わせ、待ち順の通知を扱う。
+    """
+    def __init__(self, registry: SessionRegistry, store: SessionStore, max_queue_size: int, logger):
+        self.registry = registry
+        self.store = store
+        self.max_queue_size = max_queue_size
+        self.logger = logger
+        # user_id -> 相手が見つかった時にセッションが設定されるFuture
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.rejected = 0
+        self.matched = 0
+        self.remote_matched = 0
+
+    async def admit(self, user: UserDef):
+        """登録を受け付ける。待ち行列が一杯ならQueueFullを送出する。"""
+        if not await self.store.add_user(user_record(user), self.max_queue_size):
+            self.rejected += 1
+            raise QueueFull(f"The waiting queue for {user.role} is full.")
+
+    async def register(self, user: UserDef):
+        """
+        受付数を確認せずに登録する。登録はストアにだけ置き、
+        WSを受け付けたワーカがlookup()でそのプロセスの登録にする。
+        """
+        await self.store.put_user(user_record(user))
+
+    async def lookup(self, user_id: str) -> Optional[UserDef]:
+        """登録済みのユーザを探す。どのワーカが登録を受け付けたユーザでもよい。"""
+        user = self.registry.get_waiting(user_id)
+        if user is None:
+            record = await self.store.get_user(user_id)
+            if record is None:
+                return None
+            user = UserDef(**record)
+            self.registry.add_waiting(user)
+        return user
+
+    async def attach(self, user: UserDef, ws):
+        """WSを受け付けたユーザを、このノードにいるユーザとして記録する。"""
+        user.ws = ws
+        user.node_id = self.store.node_id
+        await self.store.put_user(user_record(user))
+
+    async def leave(self, user_id: str):
+        """セッションが確立した、または切断したユーザを登録から外す。"""
+        self.registry.remove_waiting(user_id)
+        await self.store.remove_user(user_id)
+
+    async def match(self, user: UserDef) -> Optional[UserDef]:
+        """
+        最も長く待っている相手ロールのユーザを取り出す。
+        見つかった場合は、双方とも待ち行列から外れる。
+        相手が他のノードにいる場合、返すUserDefはwsを持たずnode_idだけを持つ。
+        """
+        while True:
+            record = await self.store.dequeue(PEER_ROLES[user.role])
+            if record is None:
+                return None
+            if record.get("node_id") == self.store.node_id:
+                peer = self.registry.get_waiting(record["user_id"])
+                if peer is None or peer.user_id not in self.pending:
+                    # 待つのをやめたユーザが行列に残っていた
+                    continue
+            else:
+                peer = UserDef(**record)
+                self.remote_matched += 1
+            break
+        await self.leave(peer.user_id)
+        await self.leave(user.user_id)
+        self.matched += 1
+        return peer
+
+    async def complete(self, user: UserDef, peer: UserDef, session: APISession):
+        """
+        match()で取り出した相手に、確立したセッションを知らせ、双方にEstablishedを送る。
+        相手が他のノードにいる場合は、そのノードがon_matched()で同じセッションを作る。
+        """
+        if peer.ws is not None:
+            fut = self.pending.get(peer.user_id)
+            if fut is not None and not fut.done():
+                fut.set_result(session)
+        else:
+            await self.store.publish(peer.node_id, {
+                "type": "matched", "user_id": peer.user_id,
+                "session_id": session.session_id, "peer": user_record(user),
+            })
+        established = Established(session_id=session.session_id).dict()
+        await self.store.send(peer, established)
+        await self.store.send(user, established)
+
+    def on_matched(self, event: dict):
+        """他のノードのユーザと組み合わされた、このノードのユーザのセッションを作る。"""
+        user = self.registry.get_waiting(event["user_id"])
+        fut = self.pending.get(event["user_id"])
+        if user is None or fut is None or fut.done():
+            self.logger.warning(f"Matched user {event['user_id']} is no longer waiting.")
+            return
+        peer = UserDef(**event["peer"])
+        session = APISession(users=[user, peer], history=History(), session_id=event["session_id"])
+        self.registry.remove_waiting(user.user_id)
+        self.registry.add_session(session)
+        fut.set_result(session)
+
+    async def wait_for_match(self, user: UserDef, timeout: Optional[float] = None) -> Optional[APISession]:
+        """
+        待ち行列の末尾に並び、相手が見つかるまで待つ。待っている間にWSが切断された場合は
+        WebSocketDisconnectを送出する。timeout秒経っても相手が見つからない場合は
+        待ち行列から外れてNoneを返す。
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending[user.user_id] = fut
+        self.registry.set_prepared(user)
+        await self.store.enqueue(user.role, user.user_id)
+        deadline = None if timeout is None else loop.time() + timeout
+        receiver = None
+        claimed = False
+        try:
+            await self.notify_positions(user.role)
+            while not fut.done():
+                if receiver is None:
+                    receiver = asyncio.ensure_future(user.ws.receive())
+                remaining = None if deadline is None else max(0, deadline - loop.time())
+                done, _ = await asyncio.wait([fut, receiver], timeout=remaining,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if claimed or await self.store.remove_queued(user.role, user.user_id):
+                        break
+                    # 既に他のユーザに取り出されている。セッションが知らされるまで待つ。
+                    claimed = True
+                    deadline = loop.time() + MATCH_NOTIFY_TIMEOUT
+                    continue
+                if receiver in done:
+                    message = receiver.result()
+                    receiver = None
+                    if message.get("type") == "websocket.disconnect":
+                        raise WebSocketDisconnect(message.get("code", 1000))
+            return fut.result() if fut.done() else None
+        finally:
+            if receiver is not None:
+                receiver.cancel()
+            self.pending.pop(user.user_id, None)
+            if not fut.done():
+                self.registry.remove_prepared(user)
+                await self.store.remove_queued(user.role, user.user_id)
+                await self.notify_positions(user.role)
+
+    async def notify_positions(self, role: str):
+        """ロールの待ち行列にいる全員に、現在の待ち順を送る。"""
+        records = await self.store.queued(role)
+        for position, record in enumerate(records, start=1):
+            # このノードのユーザはWSを持つ登録を使い、他のノードのユーザにはイベントで送る
+            u = self.registry.get_waiting(record["user_id"]) or UserDef(**record)
+            try:
+                await self.store.send(u, QueuePosition(position=position, queue_size=len(records)).dict())
+            except Exception as e:
+                self.logger.debug(f"Failed to send queue position to {u.user_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "max_queue_size": self.max_queue_size,
+            "queued": {role: self.registry.waiting_count(role) for role in PEER_ROLES},
+            "waiting_for_peer": len(self.pending),
+            "matched": self.matched,
+            "remote_matched": self.remote_matched,
+            "rejected": self.rejected,
+        }
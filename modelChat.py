@@ -29,6 +29,7 @@ C. ユーザとのWebSocketセッションを開始する。
 
 D. ユーザの相手を見つける。
     - ユーザの状態は**Prepared**であること。
+    - 相手を待っている間、システムは待ち順が変わるたびに*Queue Position*をユーザに送信する。
     - 相手を見つけると、システムは*Establishment Succeeded*を双方に送信する。
     - ユーザの状態は**Established**になる。
     - Eに移行できる。
@@ -80,9 +81,11 @@ class MsgType(Enum):
     ToolCallDetected = 8
     ContinueConversationRequest = 9
     ConversationContinueAccepted = 10
+    QueuePosition = 11
     MessageSubmitted = 201
     MessageForwarded = 202
     MessageRejected = 203
+    MessageDelta = 204
     RegistrationRejected = 401
     PreparationRejected = 402
 
@@ -111,12 +114,20 @@ class RegistrationAccepted(BaseModel):
 class RegistrationRejected(BaseModel):
     msg_type: str=MsgType.RegistrationRejected.name
     user_status: str=Status.Initial.name
+    reason: Optional[str] = None
 
 # S > U
 class Prepared(BaseModel):
     msg_type: str=MsgType.Prepared.name
     user_status: str=Status.Prepared.name
 
+# S > U
+class QueuePosition(BaseModel):
+    msg_type: str=MsgType.QueuePosition.name
+    user_status: str=Status.Prepared.name
+    position: int = Field(description="1から始まる待ち順")
+    queue_size: int
+
 # S > U
 class PreparationRejected(BaseModel):
     msg_type: str=MsgType.PreparationRejected.name
@@ -143,6 +154,13 @@ class MessageForwarded(BaseModel):
     session_id: str
     user_msg: str
 
+# S > U
+# ストリーミング応答の断片。応答全体は最後にMessageForwardedで送られる。
+class MessageDelta(BaseModel):
+    msg_type: str=MsgType.MessageDelta.name
+    session_id: str
+    delta: str
+
 # S > U
 class MessageRejected(BaseModel):
     msg_type: str=MsgType.MessageRejected.name
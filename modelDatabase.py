@@ -1,6 +1,7 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, Index
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
 import os
 
@@ -12,14 +13,40 @@ engine = None
 SessionLocal = None
 Base = declarative_base()
 
+# URLのバックエンド名ごとに使用する非同期ドライバ
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "sqlite": "aiosqlite",
+}
+
+def to_async_url(db_url: str):
+    """
+    DATABASE_URLを非同期ドライバ用のURLに変換する。
+    例: postgres://... -> postgresql+asyncpg://..., sqlite:///x.db -> sqlite+aiosqlite:///x.db
+    """
+    # Heroku/Render形式の postgres:// はSQLAlchemyが解釈できないため置き換える
+    if db_url.startswith("postgres://"):
+        db_url = "postgresql://" + db_url[len("postgres://"):]
+    url = make_url(db_url)
+    backend = url.get_backend_name()
+    driver = ASYNC_DRIVERS.get(backend)
+    if driver is None:
+        raise ValueError(f"非同期ドライバが未対応のデータベースです: {backend}")
+    url = url.set(drivername=f"{backend}+{driver}")
+    if driver == "asyncpg" and "sslmode" in url.query:
+        # asyncpgはsslmodeを解釈しないため、sslに読み替える
+        url = url.update_query_dict({"ssl": url.query["sslmode"]}).difference_update_query(["sslmode"])
+    return url
+
 def initialize_database(db_url: str):
     """データベースエンジンとセッションファクトリを初期化します。"""
     global engine, SessionLocal
     if not db_url:
         raise ValueError("データベースURLが設定されていません。データベースを初期化できません。")
     
-    engine = create_engine(db_url)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine = create_async_engine(to_async_url(db_url))
+    # commit後に属性を再読込すると非同期では暗黙のI/Oになるため、expireしない
+    SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
 TABLE_SUFFIX = os.getenv("TABLE_SUFFIX", "")
 
@@ -36,10 +63,29 @@ class ChatLog(Base):
     is_initial_message = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-def init_db():
+    # /v1/logs/{session_id} のページ送り用
+    __table_args__ = (
+        Index(f"ix_{__tablename__}_session_id_created_at_id", "session_id", "created_at", "id"),
+    )
+
+async def init_db():
     """データベーステーブルを作成します。"""
     if engine is None:
         raise RuntimeError("データベースが初期化されていません。先に initialize_database() を呼び出してください。")
     # 両方のモデルのテーブルを作成
-    Base.metadata.create_all(bind=engine)
-    SessionBase.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(SessionBase.metadata.create_all)
+        # 既存のテーブルにはcreate_allで索引が作られないため、無いものを作成
+        await conn.run_sync(_create_missing_indexes)
+
+def _create_missing_indexes(conn):
+    for metadata in (Base.metadata, SessionBase.metadata):
+        for table in metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+async def close_database():
+    """コネクションプールを解放します。"""
+    if engine is not None:
+        await engine.dispose()
@@ -1,41 +1,201 @@
 # modelRole.py
-import pandas as pd
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.errors import HttpError
-import io
+from __future__ import annotations
+from lazyimport import lazy_import
+# pandasは患者データを読み込む時まで読み込まない
+pd = lazy_import("pandas")
 import os
 import json
 from datetime import datetime, timedelta
 import random
 import argparse
 import asyncio
+from time import monotonic
+from dataclasses import dataclass
+from types import MappingProxyType
 from chatconf import ChatConfigModel, set_config
-from typing import List
+from cacheutil import LRUCache
+from framecache import FrameCache
+from metrics import REGISTRY, timed
+from rolesource import create_role_source
+from typing import List, Mapping, Optional, Tuple
+
+PROMPT_CHUNKS_SECONDS = REGISTRY.histogram(
+    "chat_prompt_chunks_seconds", "Time to get the prompt chunks of a patient, including cache hits.")
+ROLE_LOAD_SECONDS = REGISTRY.histogram(
+    "chat_role_load_seconds", "Time to load the patient data, by trigger.", ("trigger",))
+
+def normalize_patient_id(value) -> Optional[str]:
+    """患者IDを比較用の文字列に正規化する。1, 1.0, "1", "01" はいずれも "1" になる。"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    try:
+        return str(int(float(value)))
+    except (ValueError, TypeError, OverflowError):
+        value_str = str(value).strip()
+        return value_str or None
+
+def _format_date(value) -> str:
+    try:
+        return pd.to_datetime(value).strftime('%Y年%m月%d日') if value else '不明'
+    except (ValueError, TypeError):
+        return '不明'
+
+@dataclass(frozen=True)
+class PatientRecord:
+    """1人分の患者データ。PatientIndexの構築時に一度だけ作られる。"""
+    patient_id: str
+    # 調査日の基準日 (発症日 > 感染日 > 固定日)。解析できない場合はNone。
+    base_date: Optional[datetime]
+    # プロンプト用の基本情報 ("ラベル: 値" の行の連結)
+    base_info: str
+    # 日ごとの行動履歴 (日付, 本文)。target_columnsの順。
+    activities: Tuple[Tuple[datetime, str], ...]
+    # get_patient_details() で返す表示用の情報。読み取り専用。
+    details: Mapping
+
+class PatientIndex:
+    """
+    患者IDをキーにしたPatientRecordの読み取り専用インデックス。
+    シート全体の走査は構築時の1回だけで、検索は辞書引きになる。
+    """
+    def __init__(self, df: pd.DataFrame, target_columns: list):
+        columns = {col: i for i, col in enumerate(df.columns)}
+        column_indices = {col: columns.get(col, -1) for col in target_columns}
+        self.has_id_column = column_indices.get("ID", -1) != -1
+
+        patients = {}
+        id_name_map = []
+        if self.has_id_column:
+            id_idx = column_indices["ID"]
+            name_idx = column_indices.get("氏名", -1)
+            for row in df.values.tolist():
+                patient_id = normalize_patient_id(row[id_idx])
+                if patient_id is None:
+                    continue
+                if name_idx != -1 and pd.notna(row[name_idx]):
+                    id_name_map.append({"ID": int(patient_id) if patient_id.isdigit() else patient_id,
+                                        "name": row[name_idx]})
+                if patient_id not in patients:
+                    patients[patient_id] = self._build_record(patient_id, row, column_indices)
+        self.patients = MappingProxyType(patients)
+        self.id_name_json = json.dumps(id_name_map, ensure_ascii=False)
+        self.available_patient_ids = self._build_available_ids(df)
+
+    @staticmethod
+    def _build_record(patient_id: str, row: list, column_indices: dict) -> PatientRecord:
+        def get_value(col_name, default='N/A'):
+            idx = column_indices.get(col_name, -1)
+            if idx != -1 and pd.notna(row[idx]):
+                return row[idx]
+            return default
+
+        # 調査日の基準日を 発症日 > 感染日 > 固定日 の優先順位で決定
+        base_date_value = get_value('発症日', None)
+        if base_date_value is None:
+            base_date_value = get_value('感染日', "2022-04-30")
+        try:
+            base_date = pd.to_datetime(base_date_value)
+            if pd.isna(base_date):
+                base_date = None
+        except (ValueError, TypeError):
+            base_date = None
+
+        base_info = ""
+        activities = []
+        for column_label, column_index in column_indices.items():
+            if column_index == -1:
+                continue
+            value = row[column_index]
+            if pd.isna(value):
+                continue
+            value_str = str(value).strip()
+            if not value_str:
+                continue
+            if isinstance(column_label, datetime):
+                activities.append((column_label, value_str))
+            else:
+                base_info += f'{column_label}: {value_str}\n'
+
+        details = {}
+        # mock.jsxの項目に合わせてデータを抽出・整形
+        details['id'] = get_value('ID', 'N/A')
+        details['name'] = get_value('氏名')
+        age_val = get_value('年齢', None)
+        try:
+            details['age'] = int(age_val) if age_val is not None else 'N/A'
+        except (ValueError, TypeError):
+            details['age'] = 'N/A'
+        details['gender'] = get_value('性別')
+        details['residence'] = get_value('変換後都道府県')
+        details['birthDate'] = _format_date(get_value('生年月日', None))
+        details['onsetDate'] = _format_date(get_value('発症日', None))
+        details['infectionDate'] = _format_date(get_value('感染日', None))
+        details['symptoms'] = get_value('プロフィール', '情報なし')
+        details['profile'] = get_value('プロフィール', '情報なし')
+        details['notes'] = get_value('備考欄', '特になし')
+
+        return PatientRecord(patient_id=patient_id, base_date=base_date,
+                             base_info=base_info, activities=tuple(activities),
+                             details=MappingProxyType(details))
+
+    @staticmethod
+    def _build_available_ids(df: pd.DataFrame) -> Tuple[str, ...]:
+        status_col = "作業ステータス"
+        id_col = "ID"
+
+        if status_col not in df.columns or id_col not in df.columns:
+            print(f"必要なカラム '{status_col}' または '{id_col}' が見つかりません。")
+            return ()
+
+        try:
+            completed_df = df[df[status_col] == '完了']
+            # 整数に変換してから文字列に変換することで、小数点以下を削除
+            return tuple(completed_df[id_col].dropna().astype(float).astype(int).astype(str).unique().tolist())
+        except Exception as e:
+            print(f"IDリストのフィルタリング中にエラーが発生しました: {e}")
+            return ()
+
+    def get(self, patient_id) -> Optional[PatientRecord]:
+        return self.patients.get(normalize_patient_id(patient_id))
+
+@dataclass(frozen=True)
+class PatientData:
+    """
+    読み込んだシートとそのインデックスの組。読み込み直すと丸ごと差し替えられる。
+    セッションは開始時のPatientDataを保持し、終了までそのデータを使い続ける。
+    """
+    df: pd.DataFrame
+    index: PatientIndex
+    # RoleSource.get_version()の値。取得できなかった場合はNone。
+    version: Optional[str]
+    loaded_at: datetime
 
 class PatientRoleProvider:
     """
-    Google Drive上のExcelファイルから患者のロール設定を非同期で読み込み、AI用のプロンプトを生成する。
+    患者のロール設定を非同期で読み込み、AI用のプロンプトを生成する。
+    読み込み元 (Google Drive, 手元のExcel/CSV, SQLite) はconfig.role_sourceで選ぶ。
     設定はChatConfigModelオブジェクトから取得する。
+    start()するとrole_refresh_interval秒ごとにファイルの更新を確認し、
+    更新されていれば読み込み直してdataを差し替える。
     """
     def __init__(self, config: ChatConfigModel):
-        if not config.gdrive_file_id:
-            raise ValueError("設定にGoogle DriveのファイルID(gdrive_file_id)が指定されていません。")
-        if not os.path.exists(config.gdrive_service_account):
-            raise FileNotFoundError(f"サービスアカウントのキーファイルが見つかりません: {config.gdrive_service_account}")
-
         self.config = config
-        self.sheet_name = 2
-        self.cache_etag_file = "cache_etag.txt"
-        self.cache_data_file = "cached_data.pkl"
-        self.df = None
+        # 読み込んだ列をバージョンごとに保存する
+        self.frame_cache = FrameCache("cached_data", config.frame_cache_dir or None)
+        # 現在のデータ。読み込み直した時は、この属性への代入1回で差し替える。
+        self.data: Optional[PatientData] = None
+        # (患者ID, 調査日, データバージョン) -> 組み立て済みのプロンプトチャンク
+        self.prompt_cache = LRUCache(config.patient_prompt_cache_size)
         self.loop = config.loop # アプリケーションとイベントループを共有する
+        self.refresh_interval = config.role_refresh_interval
+        self.refresh_task = None
+        self.refresh_lock = asyncio.Lock()
+        # metrics
+        self.refresh_count = 0
+        self.last_refresh_at = None
+        self.last_refresh_duration = None
+        self.last_refresh_error = None
 
-        scope = ["https://www.googleapis.com/auth/drive.readonly"]
-        self.creds = Credentials.from_service_account_file(self.config.gdrive_service_account, scopes=scope)
-        self.drive_service = build("drive", "v3", credentials=self.creds)
-        
         self.target_columns = [
             "ID", "氏名", "年齢", "生年月日", "性別", "変換後都道府県", "プロフィール",
             "感染日", "発症日",
@@ -51,56 +211,106 @@ class PatientRoleProvider:
             datetime(2022, 4, 29), datetime(2022, 4, 30),
             '（旅行有の場合）旅行先が流行地か否か、旅行の目的等', '備考欄', '都道府県'
         ]
+        # シートから読み込む列。get_available_patient_ids()で作業ステータスも使う。
+        self.use_columns = set(self.target_columns) | {"作業ステータス"}
+        self.source = create_role_source(config, self.use_columns)
 
-    async def _get_file_etag(self):
-        try:
-            file_metadata = await self.loop.run_in_executor(
-                None, lambda: self.drive_service.files().get(fileId=self.config.gdrive_file_id, fields="md5Checksum").execute()
-            )
-            return file_metadata.get("md5Checksum")
-        except HttpError as e:
-            print(f"ETagの取得エラー: {e}")
-            return None
-
-    async def _download_and_read_excel(self):
-        try:
-            request = self.drive_service.files().get_media(fileId=self.config.gdrive_file_id)
-            file_stream = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_stream, request)
-            done = False
-            while not done:
-                status, done = await self.loop.run_in_executor(None, downloader.next_chunk)
-            file_stream.seek(0)
-            return pd.read_excel(file_stream, sheet_name=self.sheet_name)
-        except HttpError as e:
-            print(f"ファイルのダウンロードエラー: {e}")
-            return None
-        except ValueError as e:
-            print(f"シート '{self.sheet_name}' の読み込みエラー: {e}")
-            return None
+    @property
+    def df(self) -> Optional[pd.DataFrame]:
+        return self.data.df if self.data else None
 
-    async def initialize(self):
-        current_etag = await self._get_file_etag()
-        
-        cached_etag = None
-        if os.path.exists(self.cache_etag_file):
-            with open(self.cache_etag_file, "r") as f:
-                cached_etag = f.read().strip()
+    @property
+    def index(self) -> Optional[PatientIndex]:
+        return self.data.index if self.data else None
 
-        if current_etag and current_etag == cached_etag and os.path.exists(self.cache_data_file):
-            self.df = pd.read_pickle(self.cache_data_file)
-            return
+    @property
+    def data_version(self) -> Optional[str]:
+        return self.data.version if self.data else None
 
-        df = await self._download_and_read_excel()
+    async def initialize(self):
+        async with self.refresh_lock:
+            # 起動時の読み込みと、要求に応じた読み込みが重なった場合は一度だけ読む
+            if self.data is not None:
+                return
+            with ROLE_LOAD_SECONDS.time(trigger="initialize"):
+                await self._load(await self.source.get_version())
+
+    async def _load(self, etag: Optional[str]) -> bool:
+        """etagのデータを、保存済みであればキャッシュから、無ければ読み込み元から読み込む。"""
+        df = await self.loop.run_in_executor(None, self.frame_cache.load, etag)
         if df is not None:
-            self.df = df
-            if current_etag:
-                df.to_pickle(self.cache_data_file)
-                with open(self.cache_etag_file, "w") as f:
-                    f.write(current_etag)
+            await self._set_data(df, etag)
+            return True
+        df = await self.source.read()
+        if df is None:
+            return False
+        await self._set_data(df, etag)
+        if etag:
+            await self.loop.run_in_executor(None, self.frame_cache.save, df, etag)
+        return True
+
+    async def _set_data(self, df: pd.DataFrame, version: Optional[str]):
+        # インデックスはイベントループの外で作り、完成してから差し替える
+        index = await self.loop.run_in_executor(None, PatientIndex, df, self.target_columns)
+        self.data = PatientData(df=df, index=index, version=version, loaded_at=datetime.now())
+        # 古いデータから作ったチャンクは使わない
+        self.prompt_cache.clear()
+
+    def start(self):
+        """ファイルの更新の定期的な確認を始める。"""
+        if self.refresh_interval > 0 and self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._run_refresh())
+
+    async def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            try:
+                await self.refresh_task
+            except asyncio.CancelledError:
+                pass
+            self.refresh_task = None
+
+    async def _run_refresh(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.last_refresh_error = str(e)
+                self.config.logger.error(f"Failed to refresh patient data: {e}")
 
-    def _get_column_indices(self):
-        return {col: self.df.columns.tolist().index(col) if col in self.df.columns else -1 for col in self.target_columns}
+    async def refresh(self) -> bool:
+        """
+        ファイルが更新されていれば読み込み直す。読み込み直した場合はTrueを返す。
+        読み込みに失敗した場合は、それまでのデータを使い続ける。
+        """
+        async with self.refresh_lock:
+            current_etag = await self.source.get_version()
+            if current_etag is None or (self.data is not None and current_etag == self.data_version):
+                return False
+            start = monotonic()
+            if not await self._load(current_etag):
+                self.last_refresh_error = f"Failed to load the file of version {current_etag}."
+                return False
+            self.refresh_count += 1
+            self.last_refresh_at = datetime.now()
+            self.last_refresh_duration = monotonic() - start
+            ROLE_LOAD_SECONDS.observe(self.last_refresh_duration, trigger="refresh")
+            self.last_refresh_error = None
+            self.config.logger.info(f"Patient data has been reloaded: version {current_etag} "
+                                    f"in {self.last_refresh_duration:.2f}s")
+            return True
+
+    def stats(self) -> dict:
+        return {
+            "data_version": self.data_version,
+            "loaded_at": self.data.loaded_at.isoformat() if self.data else None,
+            "refresh_interval": self.refresh_interval,
+            "refresh_count": self.refresh_count,
+            "last_refresh_at": self.last_refresh_at.isoformat() if self.last_refresh_at else None,
+            "last_refresh_duration": self.last_refresh_duration,
+            "last_refresh_error": self.last_refresh_error,
+        }
 
     def _determine_interview_date(self, onset_date_str: str) -> (datetime, str):
         """発症日に基づいて調査日と時間帯を確率的に決定する"""
@@ -162,42 +372,28 @@ class PatientRoleProvider:
 
         return [chunk for chunk in chunks if chunk] # 空のチャンクを除外
 
-    def get_patient_prompt_chunks(self, patient_id: str, interview_date_str: str = None) -> (List[str], str):
+    @timed(PROMPT_CHUNKS_SECONDS)
+    def get_patient_prompt_chunks(self, patient_id: str, interview_date_str: str = None, data: PatientData = None) -> (List[str], str):
         """
         指定された患者IDのプロンプトを、API制限を考慮して分割されたチャンクのリストとして返す。
         interview_date_strが指定された場合はその日付を、されなければ動的に日付を決定する。
+        dataを指定した場合は、現在のデータではなくそのデータから作る。
         """
-        if self.df is None:
+        data = data or self.data
+        if data is None:
             raise RuntimeError("Provider is not initialized. Call `await provider.initialize()` first.")
 
-        column_indices = self._get_column_indices()
-        if column_indices.get("ID", -1) == -1:
+        if not data.index.has_id_column:
             return ["エラー: 'ID'カラムが見つかりません。"], None
 
-        try:
-            row_list = self.df.values.tolist()
-            row = next(filter(lambda r: int(r[column_indices["ID"]]) == int(patient_id), row_list))
-        except (StopIteration, ValueError):
+        record = data.index.get(patient_id)
+        if record is None:
             return [f"患者ID {patient_id} のデータは見つかりませんでした。"], None
-        except Exception as e:
-            return [f"検索中に予期せぬエラーが発生しました: {e}"], None
 
         # 調査日を決定
         interview_date = None
         if not interview_date_str:
-            # 基準日を 発症日 > 感染日 > 固定日 の優先順位で決定
-            base_date_str = None
-            onsetDate_idx = column_indices.get("発症日", -1)
-            infectionDate_idx = column_indices.get("感染日", -1)
-
-            if onsetDate_idx != -1 and pd.notna(row[onsetDate_idx]):
-                base_date_str = row[onsetDate_idx]
-            elif infectionDate_idx != -1 and pd.notna(row[infectionDate_idx]):
-                base_date_str = row[infectionDate_idx]
-            else:
-                base_date_str = "2022-04-30"
-
-            interview_date, time_of_day = self._determine_interview_date(base_date_str)
+            interview_date, time_of_day = self._determine_interview_date(record.base_date)
             
             weekdays = ["月", "火", "水", "木", "金", "土", "日"]
             weekday_str = weekdays[interview_date.weekday()]
@@ -210,6 +406,15 @@ class PatientRoleProvider:
                 # パース失敗の場合は現在の日付をフォールバックとして使用
                 interview_date = datetime.now()
 
+        cache_key = (record.patient_id, interview_date_str, interview_date.date(), data.version)
+        chunks = self.prompt_cache.get(cache_key)
+        if chunks is None:
+            chunks = self._build_patient_prompt_chunks(record, interview_date_str, interview_date, data.index)
+            self.prompt_cache.put(cache_key, chunks)
+        return list(chunks), interview_date_str
+
+    def _build_patient_prompt_chunks(self, record: PatientRecord, interview_date_str: str, interview_date: datetime, index: PatientIndex) -> Tuple[str, ...]:
+        """プロンプトチャンクを組み立てる。結果はprompt_cacheに保持される。"""
         chunks = []
         
         # --- チャンク1: 基本情報と指示 ---
@@ -222,103 +427,47 @@ class PatientRoleProvider:
         base_prompt += "今日の日付について言及する際は、基本的には「今日」と表現し、日付での回答を求められた場合だけ日付で回答してください。「昨日」や「一昨日」についても同様です。\n"
         base_prompt += "ユーザー（保健師）が会話を終了しようとしていると判断した場合、例えば『ご協力ありがとうございました』のような感謝の言葉で締めくくった場合は、通常の応答はせず、必ず`end_conversation_and_start_debriefing`ツールを呼び出して会話を終了してください。\n\n"
 
-        base_info = ""
-        for column_label, column_index in column_indices.items():
-            if not isinstance(column_label, datetime) and column_index != -1:
-                value = row[column_index]
-                if pd.notna(value):
-                    value_str = str(value).strip()
-                    if value_str:
-                        base_info += f'{column_label}: {value_str}\n'
-
-        chunks.append(base_prompt + base_info)
+        chunks.append(base_prompt + record.base_info)
 
         # --- チャンク2以降: 日ごとの行動履歴（調査日以前の情報のみ） ---
-        for column_label, column_index in column_indices.items():
-            if isinstance(column_label, datetime) and column_index != -1:
-                # 調査日より後の情報は含めない
-                if column_label.date() > interview_date.date():
-                    continue
-                
-                value = row[column_index]
-                if pd.notna(value):
-                    date_str = column_label.strftime("%Y-%m-%d")
-                    value_str = str(value).strip()
-                    if value_str:
-                        header = f"【{date_str}の行動履歴】\n"
-                        # OpenAIのAPI制限を考慮し、安全マージンをとって2000文字程度に
-                        max_chunk_length = 2000
-                        
-                        sub_chunks = self._split_text_for_prompt(value_str, max_chunk_length)
-                        for sub_chunk in sub_chunks:
-                            chunks.append(header + sub_chunk)
+        for column_label, value_str in record.activities:
+            # 調査日より後の情報は含めない
+            if column_label.date() > interview_date.date():
+                continue
+            date_str = column_label.strftime("%Y-%m-%d")
+            header = f"【{date_str}の行動履歴】\n"
+            # OpenAIのAPI制限を考慮し、安全マージンをとって2000文字程度に
+            max_chunk_length = 2000
+
+            sub_chunks = self._split_text_for_prompt(value_str, max_chunk_length)
+            for sub_chunk in sub_chunks:
+                chunks.append(header + sub_chunk)
 
         # --- 最終チャンク: IDと名前の対応表と指示 ---
-        id_name_map = []
-        id_idx = column_indices.get("ID")
-        name_idx = column_indices.get("氏名")
-        if id_idx != -1 and name_idx != -1:
-            for r in self.df.values:
-                if pd.notna(r[id_idx]) and pd.notna(r[name_idx]):
-                    id_name_map.append({"ID": int(r[id_idx]), "name": r[name_idx]})
-        
-        id_name_json = json.dumps(id_name_map, ensure_ascii=False)
         final_instruction = (
             "以下に示す情報は、患者IDと名前の対応を表しています。"
             "ここまでの情報の中に、ID:3などのようにIDが含まれている場合、ユーザーに言及された場合は患者IDをそのまま答えるのではなく、名前に変換してから回答するようにしてください。"
-            f"{id_name_json}"
+            f"{index.id_name_json}"
         )
         chunks.append(final_instruction)
+        return tuple(chunks)
 
-        return chunks, interview_date_str
-
-    def get_patient_details(self, patient_id: str) -> dict:
+    def get_patient_details(self, patient_id: str, data: PatientData = None) -> dict:
         """
         指定された患者IDの詳細情報を辞書として返す。UI表示用。
+        インデックスの内容は共有しているため、呼び出し側が変更してよい複製を返す。
         """
-        if self.df is None:
+        data = data or self.data
+        if data is None:
             raise RuntimeError("Provider is not initialized.")
 
-        column_indices = self._get_column_indices()
-        if column_indices.get("ID", -1) == -1:
+        if not data.index.has_id_column:
             return {"error": "ID column not found."}
 
-        try:
-            row_list = self.df.values.tolist()
-            row = next(filter(lambda r: str(int(r[column_indices["ID"]])) == str(patient_id), row_list))
-        except (StopIteration, ValueError):
+        record = data.index.get(patient_id)
+        if record is None:
             return {"error": f"Patient ID {patient_id} not found."}
-        except Exception as e:
-            return {"error": f"An unexpected error occurred: {e}"}
-
-        details = {}
-        # mock.jsxの項目に合わせてデータを抽出・整形
-        def get_value(col_name, default='N/A'):
-            idx = column_indices.get(col_name, -1)
-            if idx != -1 and pd.notna(row[idx]):
-                return row[idx]
-            return default
-
-        details['id'] = get_value('ID', 'N/A')
-        details['name'] = get_value('氏名')
-        age_val = get_value('年齢', None)
-        details['age'] = int(age_val) if age_val is not None else 'N/A'
-        details['gender'] = get_value('性別')
-        details['residence'] = get_value('変換後都道府県')
-        birthDate = get_value('生年月日', None)
-        details['birthDate'] = pd.to_datetime(birthDate).strftime('%Y年%m月%d日') if birthDate else '不明'
-        
-        onsetDate = get_value('発症日', None)
-        details['onsetDate'] = pd.to_datetime(onsetDate).strftime('%Y年%m月%d日') if onsetDate else '不明'
-        infectionDate = get_value('感染日', None)
-        details['infectionDate'] = pd.to_datetime(infectionDate).strftime('%Y年%m月%d日') if infectionDate else '不明'
-        
-        details['symptoms'] = get_value('プロフィール', '情報なし')
-        
-        details['profile'] = get_value('プロフィール', '情報なし')
-        details['notes'] = get_value('備考欄', '特になし')
-
-        return details
+        return dict(record.details)
 
     def get_interviewer_prompt_chunks(self) -> (List[str], str):
         """
@@ -339,24 +488,9 @@ class PatientRoleProvider:
         return [prompt], initial_message
 
     def get_available_patient_ids(self) -> list[str]:
-        if self.df is None:
+        if self.index is None:
             raise RuntimeError("Provider is not initialized. Call `await provider.initialize()` first.")
-
-        status_col = "作業ステータス"
-        id_col = "ID"
-
-        if status_col not in self.df.columns or id_col not in self.df.columns:
-            print(f"必要なカラム '{status_col}' または '{id_col}' が見つかりません。")
-            return []
-
-        try:
-            completed_df = self.df[self.df[status_col] == '完了']
-            # 整数に変換してから文字列に変換することで、小数点以下を削除
-            available_ids = completed_df[id_col].dropna().astype(float).astype(int).astype(str).unique().tolist()
-            return available_ids
-        except Exception as e:
-            print(f"IDリストのフィルタリング中にエラーが発生しました: {e}")
-            return []
+        return list(self.index.available_patient_ids)
 
 async def main():
     parser = argparse.ArgumentParser(description="患者AIのプロンプトを生成します。")
@@ -1,7 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 import os
+from datetime import datetime, timezone
 
 Base = declarative_base()
 
@@ -18,5 +19,16 @@ class Session(Base):
     status = Column(String, default='active', nullable=False, index=True) # e.g., 'active', 'completed'
     thread_id = Column(String, nullable=True) # OpenAI Assistant thread_id
     interview_date = Column(String, nullable=True) # The date of the interview
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # SQLiteのCURRENT_TIMESTAMPは秒までの文字列になり、ページ送りのカーソルと
+    # 比較できないため、アプリ側でも値を設定する
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), server_default=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
+
+    # /v1/logs のページ送り (created_at, id) と絞り込み用
+    __table_args__ = (
+        Index(f"ix_{__tablename__}_created_at_id", "created_at", "id"),
+        Index(f"ix_{__tablename__}_status_created_at_id", "status", "created_at", "id"),
+        Index(f"ix_{__tablename__}_user_name_created_at_id", "user_name", "created_at", "id"),
+        Index(f"ix_{__tablename__}_user_role_created_at_id", "user_role", "created_at", "id"),
+        Index(f"ix_{__tablename__}_patient_id_created_at_id", "patient_id", "created_at", "id"),
+    )
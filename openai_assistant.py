@@ -1,24 +1,93 @@
 import logging
 from pydantic import BaseModel
 from modelUserDef import AssistantDef
-from openai import AsyncOpenAI
 from openai_etc import openai_get_apikey
-from typing import Optional, Any, List
+from openai_fake import FakeAsyncOpenAI
+from openai_scheduler import OpenAIScheduler
+from metrics import REGISTRY, timed
+from lazyimport import lazy_import
+from typing import Optional, Any, List, Callable, Awaitable, Hashable
 from asyncio import sleep as sleep
 
+# threads.create()に初期メッセージとして渡せる件数の上限
+MAX_INITIAL_MESSAGES = 32
+
+# openaiは読み込みに時間がかかるため、最初にclientを使う時に読み込む
+openai = lazy_import("openai")
+
+# 終わっていないrunの状態
+ACTIVE_RUN_STATUSES = ('queued', 'in_progress', 'requires_action', 'cancelling')
+
+OPENAI_SECONDS = REGISTRY.histogram(
+    "chat_openai_operation_seconds",
+    "Latency of OpenAIAssistantWrapper operations, including the scheduler queue wait.",
+    ("operation",))
+
+def _total_tokens(run) -> Optional[int]:
+    usage = getattr(run, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+def _rate_limited_run(run) -> bool:
+    """TPMの超過などで、実行中にレート制限で失敗したrun。"""
+    last_error = getattr(run, "last_error", None)
+    return run is not None and run.status == "failed" and last_error is not None \
+        and last_error.code == "rate_limit_exceeded"
+
 class OpenAIAssistantWrapper():
     def __init__(self, config):
         self.config = config
-        self.client = AsyncOpenAI(
-            api_key=openai_get_apikey(config.apikey_storage)
-        )
+        self._client = None
+        # 同時実行数、RPM/TPM、429の再試行はschedulerで扱う
+        self.scheduler = OpenAIScheduler(
+            config.openai_max_concurrency, config.openai_rpm, config.openai_tpm,
+            config.openai_run_tokens, config.openai_max_retries,
+            config.openai_backoff_base, config.openai_backoff_max, config.logger)
 
-    async def create_thread(self):
-        thread = await self.client.beta.threads.create()
+    @property
+    def client(self):
+        if self._client is None:
+            if self.config.openai_backend == "fake":
+                # OpenAI APIに接続せずに応答する偽物 (性能の計測用)
+                self._client = FakeAsyncOpenAI(self.config)
+            elif self.config.openai_backend == "openai":
+                self._client = openai.AsyncOpenAI(
+                    api_key=openai_get_apikey(self.config.apikey_storage),
+                    # 再試行はschedulerが全体の受付を止めてから行う
+                    max_retries=0,
+                )
+            else:
+                raise ValueError(f"未対応のopenai_backendです: {self.config.openai_backend}")
+        return self._client
+
+    @timed(OPENAI_SECONDS, operation="create_thread")
+    async def create_thread(self, key: Hashable):
+        """スレッドを作成する。keyはschedulerで順番を待つ単位 (セッションID)。"""
+        async with self.scheduler.slot(key):
+            thread = await self.scheduler.call(lambda: self.client.beta.threads.create())
+        return thread.id
+
+    @timed(OPENAI_SECONDS, operation="create_seeded_thread")
+    async def create_seeded_thread(self, message_texts: List[str], key: Hashable, background: bool = False) -> str:
+        """
+        初期指示（ペルソナ設定）のメッセージを投入済みのスレッドを作成する。
+        MAX_INITIAL_MESSAGES件までは作成と同じ1回のリクエストで投入する。
+        keyとbackgroundはscheduler.slot()に渡す。
+        """
+        messages = [{"role": "user", "content": text} for text in message_texts]
+        requests = 1 + max(0, len(messages) - MAX_INITIAL_MESSAGES)
+        async with self.scheduler.slot(key, requests=requests, background=background):
+            thread = await self.scheduler.call(lambda: self.client.beta.threads.create(
+                messages=messages[:MAX_INITIAL_MESSAGES]))
+            # 上限を超えた分は順序を保つため1件ずつ追加する
+            for message in messages[MAX_INITIAL_MESSAGES:]:
+                await self.add_message_to_thread(thread.id, message["content"])
         return thread.id
 
     async def delete_thread(self, assistant: AssistantDef):
-        status = await self.client.beta.threads.delete(assistant.thread_id)
+        return await self.delete_thread_id(assistant.thread_id)
+
+    async def delete_thread_id(self, thread_id: str):
+        status = await self.client.beta.threads.delete(thread_id)
         return status
 
     async def cancel_run(self, thread_id: str):
@@ -33,24 +102,36 @@ class OpenAIAssistantWrapper():
             logging.error(f"Failed to cancel run for thread {thread_id}: {e}")
             return False
 
+    async def cancel_run_id(self, thread_id: str, run_id: str):
+        """runを取り消し、終わるまで待つ。既に終わっているrunはそのままにする。"""
+        runs = self.client.beta.threads.runs
+        try:
+            run = await runs.retrieve(run_id, thread_id=thread_id)
+            if run.status in ACTIVE_RUN_STATUSES:
+                if run.status != 'cancelling':
+                    logging.info(f"Cancelling dangling run {run_id} with status {run.status}")
+                    await runs.cancel(run_id=run_id, thread_id=thread_id)
+                await runs.poll(run_id, thread_id=thread_id)
+        except Exception as e:
+            logging.error(f"Failed to cancel run {run_id} for thread {thread_id}: {e}")
+
     async def add_message_to_thread(self, thread_id: str, message_text: str):
         """
         指定されたスレッドに、'user'ロールでメッセージを追加する。
         これはAIへの初期指示（ペルソナ設定）を注入するために使用する。
         """
-        thread_message = await self.client.beta.threads.messages.create(
+        thread_message = await self.scheduler.call(lambda: self.client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user", # 'system'ロールはAPIでサポートされていないため'user'として送信
             content=message_text,
-        )
+        ))
         return thread_message
 
-    async def send_message(self,
-                           assistant: AssistantDef,
-                           request_text: str,
-                           tool_choice: Optional[Any] = None,
-                           tools: Optional[List[Any]] = None,
-                           ) -> (Optional[str], Optional[Any]):
+    def _build_run_params(self,
+                          assistant: AssistantDef,
+                          tool_choice: Optional[Any] = None,
+                          tools: Optional[List[Any]] = None,
+                          ) -> dict:
             if tools is None:
                 # デフォルトのツール（関数）の定義
                 tools = [
@@ -67,9 +148,6 @@ class OpenAIAssistantWrapper():
                     }
                 ]
 
-            # ユーザーからのメッセージをスレッドに追加
-            await self.add_message_to_thread(assistant.thread_id, request_text)
-            
             run_params = {
                 "thread_id": assistant.thread_id,
                 "assistant_id": assistant.assistant_id,
@@ -81,17 +159,11 @@ class OpenAIAssistantWrapper():
             }
             if tool_choice:
                 run_params["tool_choice"] = tool_choice
+            return run_params
 
-            run = await self.client.beta.threads.runs.create_and_poll(**run_params)
-
+    def _handle_run_result(self, run, assistant_response: Optional[str]) -> (Optional[str], Optional[Any]):
             if run.status == 'completed':
-                messages = await self.client.beta.threads.messages.list(
-                    thread_id=assistant.thread_id,
-                    order="desc",
-                    limit=1
-                )
-                if messages.data and messages.data[0].role == "assistant":
-                    assistant_response = messages.data[0].content[0].text.value
+                if assistant_response:
                     return assistant_response, None
                 else:
                     return "FAILED: No response from assistant.", None
@@ -114,3 +186,127 @@ class OpenAIAssistantWrapper():
                 logging.error(f"Run object: {run}")
                 # FAILED: から始まる文字列を返す
                 return f"FAILED: {error_message}", None
+
+    @timed(OPENAI_SECONDS, operation="send_message")
+    async def send_message(self,
+                           assistant: AssistantDef,
+                           request_text: str,
+                           tool_choice: Optional[Any] = None,
+                           tools: Optional[List[Any]] = None,
+                           add_message: bool = True,
+                           on_added: Optional[Callable[[], None]] = None,
+                           ) -> (Optional[str], Optional[Any]):
+            """
+            request_textをスレッドに追加し、runの結果を返す。
+            追加し終えるとon_added()を呼ぶ。add_messageがFalseなら、
+            追加済みとしてrunだけを行う (取り消されたrunのやり直し)。
+            """
+            run_params = self._build_run_params(assistant, tool_choice, tools)
+            runs = self.client.beta.threads.runs
+
+            created = None
+
+            async def create_and_poll():
+                # 再試行は外側のscheduler.call()だけで行う。
+                # 作成済みのrunのpollが失敗した場合は、作り直さずにpollだけをやり直す。
+                nonlocal created
+                if created is None:
+                    created = await runs.create(**run_params)
+                run = await runs.poll(created.id, thread_id=assistant.thread_id)
+                # レート制限で失敗したrunは、再試行で作り直す
+                created = None
+                return run
+
+            key = assistant.thread_id
+            # メッセージの追加、runの作成、応答の取得で3リクエスト
+            async with self.scheduler.slot(key, self.scheduler.estimate(key, request_text), requests=3) as slot:
+                if add_message:
+                    # ユーザーからのメッセージをスレッドに追加
+                    await self.add_message_to_thread(assistant.thread_id, request_text)
+                    if on_added:
+                        on_added()
+
+                run = await self.scheduler.call(create_and_poll, rate_limited=_rate_limited_run)
+                slot.used(_total_tokens(run))
+
+                assistant_response = None
+                if run.status == 'completed':
+                    messages = await self.scheduler.call(lambda: self.client.beta.threads.messages.list(
+                        thread_id=assistant.thread_id,
+                        order="desc",
+                        limit=1
+                    ))
+                    if messages.data and messages.data[0].role == "assistant":
+                        assistant_response = messages.data[0].content[0].text.value
+            return self._handle_run_result(run, assistant_response)
+
+    @timed(OPENAI_SECONDS, operation="stream_message")
+    async def stream_message(self,
+                             assistant: AssistantDef,
+                             request_text: str,
+                             on_delta: Callable[[str], Awaitable[None]],
+                             tool_choice: Optional[Any] = None,
+                             tools: Optional[List[Any]] = None,
+                             add_message: bool = True,
+                             on_added: Optional[Callable[[], None]] = None,
+                             ) -> (Optional[str], Optional[Any]):
+            """
+            send_message()のストリーミング版。
+            応答テキストの断片が届くたびにon_delta()を呼び出し、
+            最後にsend_message()と同じ形式で応答全体またはtool_callを返す。
+            """
+            run_params = self._build_run_params(assistant, tool_choice, tools)
+            text_parts = []
+            # 最後に作成したrunのID
+            run_id = None
+            # 断片を送った後に途切れたストリームのエラー
+            interrupted = None
+
+            async def stream_run():
+                nonlocal run_id, interrupted
+                if run_id is not None:
+                    # 接続が切れても、前の試行のrunはサーバで動き続けていることがある
+                    await self.cancel_run_id(assistant.thread_id, run_id)
+                    run_id = None
+                try:
+                    async with self.client.beta.threads.runs.stream(**run_params) as stream:
+                        async for event in stream:
+                            if event.event == "thread.run.created":
+                                run_id = event.data.id
+                            if event.event != "thread.message.delta":
+                                continue
+                            for block in event.data.delta.content or []:
+                                if block.type == "text" and block.text and block.text.value:
+                                    text_parts.append(block.text.value)
+                                    await on_delta(block.text.value)
+                        return stream.current_run
+                except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                    # 断片を送った後に再試行すると、クライアントに同じ文章が重複して届く
+                    if not text_parts:
+                        raise
+                    interrupted = e
+                    return None
+
+            def rate_limited(run) -> bool:
+                return not text_parts and _rate_limited_run(run)
+
+            key = assistant.thread_id
+            async with self.scheduler.slot(key, self.scheduler.estimate(key, request_text), requests=2) as slot:
+                if add_message:
+                    # ユーザーからのメッセージをスレッドに追加
+                    await self.add_message_to_thread(assistant.thread_id, request_text)
+                    if on_added:
+                        on_added()
+
+                run = await self.scheduler.call(stream_run, rate_limited=rate_limited)
+                slot.used(_total_tokens(run))
+                if interrupted is not None and run_id is not None:
+                    # 次のメッセージでrunを作れるよう、途切れたrunを止めておく
+                    await self.cancel_run_id(assistant.thread_id, run_id)
+
+            if interrupted is not None:
+                logging.error(f"Run stream was interrupted after sending deltas: {interrupted}")
+                return f"FAILED: Run stream was interrupted: {interrupted}", None
+            if run is None:
+                return "FAILED: Run stream ended without a run object.", None
+            return self._handle_run_result(run, "".join(text_parts))
@@ -0,0 +1,386 @@
+"""
+OpenAI Assistants API (client.beta.threads) の偽物。
+openai_backendが"fake"の場合に、OpenAIAssistantWrapperがAsyncOpenAIの代わりに使う。
+OpenAI APIに接続せずに、チャットサーバ自体の処理時間を測るために使う。
+
+- threads, messages, runs (create, poll, create_and_poll, retrieve, list, cancel,
+  submit_tool_outputs, stream) を、プロセスの中の辞書で実装する。
+- runの応答時間は中央値fake_latency_ms、ばらつきfake_latency_sigmaの対数正規分布。
+  それ以外のリクエストはfake_request_latency_msを中央値とする。
+- fake_rate_limit_rateの割合のリクエストは429 (retry-afterはfake_retry_after秒) を返す。
+- fake_failure_rateの割合のrunはfailed、fake_tool_call_rateの割合のrunは
+  最初のツールを呼ぶrequires_actionで終わる。tool_choiceで関数を指定した場合は必ず呼ぶ。
+fake_seedを指定すると、同じ順に呼び出せば同じ結果になる。
+"""
+import asyncio
+import json
+import math
+from itertools import count
+from random import Random
+from time import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from lazyimport import lazy_import
+
+openai = lazy_import("openai")
+
+# 終わっていないrunの状態
+ACTIVE_STATUSES = ("queued", "in_progress", "requires_action", "cancelling")
+# 応答の文章。fake_response_charsの長さになるまで繰り返す。
+RESPONSE_TEXT = "はい、そうですね。その時のことを少し思い出してみます。"
+
+def _error(cls, status: int, message: str, headers: Optional[dict] = None):
+    """openaiの例外を、HTTPの応答を持つ形で作る。"""
+    response = SimpleNamespace(status_code=status, headers=headers or {}, request=None)
+    return cls(message, response=response, body={"error": {"message": message}})
+
+def _sample_arguments(schema: dict) -> Any:
+    """JSON Schemaに合う最小の値。ツール呼び出しの引数に使う。"""
+    kind = schema.get("type")
+    if kind == "object":
+        return {k: _sample_arguments(v) for k, v in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_sample_arguments(schema.get("items", {}))]
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "boolean":
+        return False
+    return ""
+
+def _text_content(text: str) -> list:
+    return [SimpleNamespace(type="text", text=SimpleNamespace(value=text, annotations=[]))]
+
+class _Run():
+    def __init__(self, run_id: str, thread_id: str, assistant_id: str, tools: list, tool_choice: Any):
+        self.id = run_id
+        self.thread_id = thread_id
+        self.assistant_id = assistant_id
+        self.tools = tools or []
+        self.tool_choice = tool_choice
+        self.status = "queued"
+        self.created_at = int(time())
+        self.usage = None
+        self.last_error = None
+        self.required_action = None
+        self.task: Optional[asyncio.Task] = None
+        # 終わるかrequires_actionになると立つ
+        self.settled = asyncio.Event()
+
+    def snapshot(self) -> SimpleNamespace:
+        """APIの応答と同じく、その時点の内容を返す。"""
+        return SimpleNamespace(
+            id=self.id, object="thread.run", thread_id=self.thread_id, assistant_id=self.assistant_id,
+            status=self.status, created_at=self.created_at, usage=self.usage,
+            last_error=self.last_error, required_action=self.required_action,
+            tools=self.tools, tool_choice=self.tool_choice)
+
+class _Thread():
+    def __init__(self, thread_id: str):
+        self.id = thread_id
+        self.messages: List[SimpleNamespace] = []
+        self.runs: Dict[str, _Run] = {}
+
+    def active_run(self) -> Optional[_Run]:
+        return next((r for r in self.runs.values() if r.status in ACTIVE_STATUSES), None)
+
+class FakeBackend():
+    """偽のAPIの状態と、応答時間やエラーの注入。"""
+    def __init__(self, config):
+        self.latency = config.fake_latency_ms / 1000
+        self.sigma = config.fake_latency_sigma
+        self.request_latency = config.fake_request_latency_ms / 1000
+        self.response_chars = config.fake_response_chars
+        self.stream_chunks = max(1, config.fake_stream_chunks)
+        self.failure_rate = config.fake_failure_rate
+        self.rate_limit_rate = config.fake_rate_limit_rate
+        self.retry_after = config.fake_retry_after
+        self.tool_call_rate = config.fake_tool_call_rate
+        self.random = Random(config.fake_seed)
+        self.ids = count(1)
+        self.threads: Dict[str, _Thread] = {}
+        # metrics
+        self.requests = 0
+        self.rate_limited = 0
+        self.runs = 0
+        self.failed = 0
+        self.tool_calls = 0
+        self.cancelled = 0
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}_fake{next(self.ids):08d}"
+
+    def sample_latency(self, median: float) -> float:
+        if median <= 0:
+            return 0
+        return self.random.lognormvariate(math.log(median), self.sigma) if self.sigma > 0 else median
+
+    async def request(self):
+        """1回のHTTPリクエストにかかる時間を待ち、指定の割合で429を返す。"""
+        self.requests += 1
+        await asyncio.sleep(self.sample_latency(self.request_latency))
+        if self.rate_limit_rate > 0 and self.random.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            raise _error(openai.RateLimitError, 429, "Rate limit reached (fake).",
+                         {"retry-after-ms": str(int(self.retry_after * 1000))})
+
+    def thread(self, thread_id: str) -> _Thread:
+        thread = self.threads.get(thread_id)
+        if thread is None:
+            raise _error(openai.NotFoundError, 404, f"No thread found with id '{thread_id}'.")
+        return thread
+
+    def run(self, thread_id: str, run_id: str) -> _Run:
+        run = self.thread(thread_id).runs.get(run_id)
+        if run is None:
+            raise _error(openai.NotFoundError, 404, f"No run found with id '{run_id}'.")
+        return run
+
+    def add_message(self, thread: _Thread, role: str, text: str, run_id: Optional[str] = None) -> SimpleNamespace:
+        message = SimpleNamespace(
+            id=self.new_id("msg"), object="thread.message", thread_id=thread.id, role=role,
+            content=_text_content(text), created_at=int(time()), run_id=run_id)
+        thread.messages.append(message)
+        return message
+
+    def plan(self, run: _Run):
+        """runの結果を決める。(状態, 応答の文章またはツール)"""
+        tools = [t for t in run.tools if t.get("type") == "function"]
+        choice = run.tool_choice
+        if isinstance(choice, dict) and choice.get("type") == "function":
+            name = choice["function"]["name"]
+            tool = next((t for t in tools if t["function"]["name"] == name), None)
+            if tool is not None:
+                return "requires_action", tool
+        if tools and choice != "none" and (choice == "required" or self.random.random() < self.tool_call_rate):
+            return "requires_action", tools[0]
+        if self.failure_rate > 0 and self.random.random() < self.failure_rate:
+            return "failed", None
+        text = (RESPONSE_TEXT * (self.response_chars // len(RESPONSE_TEXT) + 1))[:self.response_chars]
+        return "completed", text
+
+    def settle(self, run: _Run, status: str, result: Any):
+        if run.status not in ACTIVE_STATUSES:
+            # 取り消し済み
+            return
+        thread = self.threads.get(run.thread_id)
+        prompt = sum(len(m.content[0].text.value) for m in thread.messages) if thread else 0
+        if status == "completed":
+            self.add_message(thread, "assistant", result, run.id)
+            run.usage = SimpleNamespace(prompt_tokens=prompt, completion_tokens=len(result),
+                                        total_tokens=prompt + len(result))
+        elif status == "requires_action":
+            self.tool_calls += 1
+            function = result["function"]
+            tool_call = SimpleNamespace(
+                id=self.new_id("call"), type="function",
+                function=SimpleNamespace(name=function["name"], arguments=json.dumps(
+                    _sample_arguments(function.get("parameters", {})), ensure_ascii=False)))
+            run.required_action = SimpleNamespace(
+                type="submit_tool_outputs",
+                submit_tool_outputs=SimpleNamespace(tool_calls=[tool_call]))
+            run.usage = SimpleNamespace(prompt_tokens=prompt, completion_tokens=0, total_tokens=prompt)
+        else:
+            self.failed += 1
+            run.last_error = SimpleNamespace(code="server_error", message="The run failed (fake).")
+        run.status = status
+        run.settled.set()
+
+    async def execute(self, run: _Run, outcome):
+        run.status = "in_progress"
+        await asyncio.sleep(self.sample_latency(self.latency))
+        self.settle(run, *outcome)
+
+    def start(self, thread: _Thread, assistant_id: str, tools: Optional[list], tool_choice: Any) -> _Run:
+        if thread.active_run() is not None:
+            raise _error(openai.BadRequestError, 400,
+                         f"Thread {thread.id} already has an active run {thread.active_run().id}.")
+        self.runs += 1
+        run = _Run(self.new_id("run"), thread.id, assistant_id, tools, tool_choice)
+        thread.runs[run.id] = run
+        return run
+
+    def cancel(self, run: _Run):
+        if run.task is not None and not run.task.done():
+            run.task.cancel()
+        run.status = "cancelled"
+        run.settled.set()
+        self.cancelled += 1
+
+    def stats(self) -> dict:
+        return {
+            "threads": len(self.threads),
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "runs": self.runs,
+            "failed": self.failed,
+            "tool_calls": self.tool_calls,
+            "cancelled": self.cancelled,
+        }
+
+class FakeMessages():
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    async def create(self, thread_id: str, role: str, content: str, **kwargs):
+        await self.backend.request()
+        thread = self.backend.thread(thread_id)
+        if thread.active_run() is not None:
+            raise _error(openai.BadRequestError, 400,
+                         f"Can't add messages to {thread_id} while a run is active.")
+        return self.backend.add_message(thread, role, content)
+
+    async def list(self, thread_id: str, order: str = "desc", limit: int = 20, **kwargs):
+        await self.backend.request()
+        messages = self.backend.thread(thread_id).messages
+        ordered = list(reversed(messages)) if order == "desc" else list(messages)
+        return SimpleNamespace(data=ordered[:limit])
+
+class FakeRunStream():
+    """runs.stream()の戻り値。応答をfake_stream_chunks個の断片に分けて返す。"""
+    def __init__(self, backend: FakeBackend, params: dict):
+        self.backend = backend
+        self.params = params
+        self.run: Optional[_Run] = None
+
+    @property
+    def current_run(self):
+        return self.run.snapshot() if self.run else None
+
+    async def __aenter__(self):
+        backend = self.backend
+        await backend.request()
+        thread = backend.thread(self.params["thread_id"])
+        self.run = backend.start(thread, self.params.get("assistant_id"),
+                                 self.params.get("tools"), self.params.get("tool_choice"))
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.run.status in ACTIVE_STATUSES and self.run.status != "requires_action":
+            self.backend.cancel(self.run)
+        return False
+
+    def __aiter__(self):
+        return self._events()
+
+    async def _events(self):
+        backend, run = self.backend, self.run
+        yield SimpleNamespace(event="thread.run.created", data=run.snapshot())
+        status, result = backend.plan(run)
+        run.status = "in_progress"
+        yield SimpleNamespace(event="thread.run.in_progress", data=run.snapshot())
+        latency = backend.sample_latency(backend.latency)
+        if status == "completed":
+            size = math.ceil(len(result) / backend.stream_chunks)
+            for i in range(0, len(result), size):
+                await asyncio.sleep(latency / backend.stream_chunks)
+                if run.status != "in_progress":
+                    break
+                delta = SimpleNamespace(content=[SimpleNamespace(
+                    index=0, type="text", text=SimpleNamespace(value=result[i:i + size]))])
+                yield SimpleNamespace(event="thread.message.delta", data=SimpleNamespace(delta=delta))
+        else:
+            await asyncio.sleep(latency)
+        backend.settle(run, status, result)
+        yield SimpleNamespace(event=f"thread.run.{run.status}", data=run.snapshot())
+
+class FakeRuns():
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+
+    async def create(self, thread_id: str, assistant_id: str, tools: Optional[list] = None,
+                     tool_choice: Any = None, **kwargs):
+        backend = self.backend
+        await backend.request()
+        run = backend.start(backend.thread(thread_id), assistant_id, tools, tool_choice)
+        run.task = asyncio.create_task(backend.execute(run, backend.plan(run)))
+        return run.snapshot()
+
+    async def retrieve(self, run_id: str, thread_id: str, **kwargs):
+        await self.backend.request()
+        return self.backend.run(thread_id, run_id).snapshot()
+
+    async def poll(self, run_id: str, thread_id: str, **kwargs):
+        """終わるかrequires_actionになるまで待つ。実際のSDKと違い、途中の確認は送らない。"""
+        await self.backend.request()
+        run = self.backend.run(thread_id, run_id)
+        await run.settled.wait()
+        return run.snapshot()
+
+    async def create_and_poll(self, thread_id: str, **kwargs):
+        run = await self.create(thread_id=thread_id, **kwargs)
+        return await self.poll(run.id, thread_id=thread_id)
+
+    async def list(self, thread_id: str, limit: int = 20, order: str = "desc", **kwargs):
+        await self.backend.request()
+        runs = [r.snapshot() for r in self.backend.thread(thread_id).runs.values()]
+        if order == "desc":
+            runs.reverse()
+        return SimpleNamespace(data=runs[:limit])
+
+    async def cancel(self, run_id: str, thread_id: str, **kwargs):
+        await self.backend.request()
+        run = self.backend.run(thread_id, run_id)
+        if run.status not in ACTIVE_STATUSES:
+            raise _error(openai.BadRequestError, 400, f"Cannot cancel run with status '{run.status}'.")
+        self.backend.cancel(run)
+        return run.snapshot()
+
+    async def submit_tool_outputs(self, run_id: str, thread_id: str, tool_outputs: list, **kwargs):
+        """ツールの結果を受け取り、ツールを使わない応答で終える。"""
+        backend = self.backend
+        await backend.request()
+        run = backend.run(thread_id, run_id)
+        if run.status != "requires_action":
+            raise _error(openai.BadRequestError, 400, f"Run {run_id} is not waiting for tool outputs.")
+        run.required_action = None
+        run.settled.clear()
+        run.tools = []
+        run.task = asyncio.create_task(backend.execute(run, backend.plan(run)))
+        return run.snapshot()
+
+    async def submit_tool_outputs_and_poll(self, run_id: str, thread_id: str, tool_outputs: list, **kwargs):
+        await self.submit_tool_outputs(run_id, thread_id, tool_outputs)
+        return await self.poll(run_id, thread_id=thread_id)
+
+    def stream(self, **params) -> FakeRunStream:
+        return FakeRunStream(self.backend, params)
+
+class FakeThreads():
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+        self.messages = FakeMessages(backend)
+        self.runs = FakeRuns(backend)
+
+    async def create(self, messages: Optional[List[dict]] = None, **kwargs):
+        backend = self.backend
+        await backend.request()
+        thread = _Thread(backend.new_id("thread"))
+        backend.threads[thread.id] = thread
+        for message in messages or []:
+            backend.add_message(thread, message.get("role", "user"), message["content"])
+        return SimpleNamespace(id=thread.id, object="thread", created_at=int(time()))
+
+    async def retrieve(self, thread_id: str, **kwargs):
+        await self.backend.request()
+        thread = self.backend.thread(thread_id)
+        return SimpleNamespace(id=thread.id, object="thread")
+
+    async def delete(self, thread_id: str, **kwargs):
+        backend = self.backend
+        await backend.request()
+        thread = backend.thread(thread_id)
+        for run in thread.runs.values():
+            if run.status in ACTIVE_STATUSES:
+                backend.cancel(run)
+        del backend.threads[thread_id]
+        return SimpleNamespace(id=thread_id, object="thread.deleted", deleted=True)
+
+class FakeAsyncOpenAI():
+    """AsyncOpenAIのうち、OpenAIAssistantWrapperが使うclient.beta.threadsだけを持つ。"""
+    def __init__(self, config):
+        self.backend = FakeBackend(config)
+        self.beta = SimpleNamespace(threads=FakeThreads(self.backend))
+
+    def stats(self) -> dict:
+        return self.backend.stats()
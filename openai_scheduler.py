@@ -0,0 +1,284 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from random import random
+from time import monotonic
+from typing import Any, Awaitable, Callable, Deque, Hashable, Optional
+
+from cacheutil import LRUCache
+from lazyimport import lazy_import
+from metrics import REGISTRY
+
+openai = lazy_import("openai")
+
+# 待ち時間の分位点を計算するために残す件数
+WAIT_SAMPLES = 1000
+
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "chat_openai_queue_wait_seconds", "Time OpenAI operations waited for a scheduler slot.")
+RATE_LIMITED = REGISTRY.counter(
+    "chat_openai_rate_limited_total", "OpenAI responses that hit a rate limit.")
+
+class TokenBucket():
+    """
+    毎分rate_per_minuteずつ補充されるバケツ。容量は1分分。
+    rate_per_minuteが0なら制限しない。
+    """
+    def __init__(self, rate_per_minute: float):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.level = rate_per_minute
+        self.updated_at = monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """amountを取り出せるまでの秒数。容量より多い量は容量まで溜まれば取り出せる。"""
+        if not self.enabled:
+            return 0
+        self._refill(now)
+        shortage = min(amount, self.capacity) - self.level
+        return shortage / self.rate if shortage > 0 else 0
+
+    def take(self, amount: float):
+        """取り出す。実際の使用量による補正では、残量が負になってもよい。"""
+        if self.enabled:
+            self.level -= amount
+
+class _Waiter():
+    def __init__(self, fut: asyncio.Future, tokens: int, requests: int, background: bool):
+        self.fut = fut
+        self.tokens = tokens
+        self.requests = requests
+        self.background = background
+        self.enqueued_at = monotonic()
+
+class Slot():
+    """OpenAIScheduler.slot()で受け取る、実行の権利。"""
+    def __init__(self, scheduler: "OpenAIScheduler", key: Hashable, tokens: int):
+        self.scheduler = scheduler
+        self.key = key
+        self.tokens = tokens
+
+    def used(self, total_tokens: Optional[int]):
+        """実際に使ったトークン数を知らせ、見積もりとの差をバケツに反映する。"""
+        if total_tokens is None:
+            return
+        self.scheduler.token_bucket.take(total_tokens - self.tokens)
+        self.tokens = total_tokens
+        self.scheduler.usage.put(self.key, total_tokens)
+        self.scheduler.used_tokens += total_tokens
+
+class OpenAIScheduler():
+    """
+    OpenAI APIの呼び出しの受付制御。
+    - 同時に実行する操作をmax_concurrencyまでにする (0なら制限しない)。
+    - 毎分のリクエスト数 (rpm) とトークン数 (tpm) をトークンバケットで制限する。
+    - 待っている操作は、セッション (key) ごとの列を順番に回して取り出す。
+      1つのセッションが続けて呼び出しても、他のセッションを待たせない。
+      backgroundの操作は、それ以外の操作が待っていない時だけ取り出す。
+    - 429 (RateLimitError) を受けたら、全体の受付をretry-afterの秒数
+      (無ければ指数バックオフ) だけ止めてから再試行する。
+    トークン数はkeyごとに前回の実際の使用量で見積もり、実行後に補正する。
+    """
+    def __init__(self, max_concurrency: int, rpm: int, tpm: int, run_tokens: int,
+                 max_retries: int, backoff_base: float, backoff_max: float, logger):
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.run_tokens = run_tokens
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.logger = logger
+        # key -> 待っている操作の列。先頭のkeyから順に1つずつ取り出し、末尾に回す。
+        self.queues: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()
+        self.running = 0
+        # 429を受けて受付を止めている間はこの時刻まで待つ
+        self.paused_until = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # key -> 前回の実際のトークン使用量
+        self.usage = LRUCache(10000)
+        # metrics
+        self.waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.rate_limited = 0
+        self.retries = 0
+        self.used_tokens = 0
+
+    def estimate(self, key: Hashable, text: str = "") -> int:
+        """keyの次の実行で使うトークン数の見積もり。"""
+        return self.usage.get(key, self.run_tokens) + len(text)
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable, tokens: int = 0, requests: int = 1, background: bool = False):
+        """
+        順番が来るまで待ち、実行の間だけ同時実行数の枠を持つ。
+        backgroundは事前の準備などの急がない操作で、セッションの操作を先に行う。
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(key, deque()).append(_Waiter(fut, tokens, requests, background))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # 枠を受け取った直後に取り消された
+                self._release()
+            else:
+                self._discard(key, fut)
+            raise
+        try:
+            yield Slot(self, key, tokens)
+        finally:
+            self._release()
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def _discard(self, key: Hashable, fut: asyncio.Future):
+        queue = self.queues.get(key)
+        if queue is None:
+            return
+        for waiter in queue:
+            if waiter.fut is fut:
+                queue.remove(waiter)
+                break
+        if not queue:
+            del self.queues[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        now = monotonic()
+        while self.queues and (self.max_concurrency <= 0 or self.running < self.max_concurrency):
+            key, queue = self._next_queue()
+            waiter = queue[0]
+            if waiter.fut.done():
+                # 待っている間に取り消された
+                queue.popleft()
+                if not queue:
+                    del self.queues[key]
+                continue
+            delay = max(self.paused_until - now, self.request_bucket.delay(waiter.requests, now),
+                        self.token_bucket.delay(waiter.tokens, now))
+            if delay > 0:
+                # 先頭を飛ばすと順番が崩れるため、先頭が取り出せるまで待つ
+                self.timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            queue.popleft()
+            if queue:
+                self.queues.move_to_end(key)
+            else:
+                del self.queues[key]
+            self.request_bucket.take(waiter.requests)
+            self.token_bucket.take(waiter.tokens)
+            self.running += 1
+            wait = now - waiter.enqueued_at
+            self.waits.append(wait)
+            self.granted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            QUEUE_WAIT_SECONDS.observe(wait)
+            waiter.fut.set_result(None)
+
+    def _next_queue(self):
+        """次に取り出すkeyの列。backgroundの操作は、他に待っているものが無い時だけ選ぶ。"""
+        for key, queue in self.queues.items():
+            if not queue[0].background:
+                return key, queue
+        return next(iter(self.queues.items()))
+
+    async def call(self, fn: Callable[[], Awaitable[Any]],
+                   rate_limited: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        fn()を呼び出し、失敗した場合はmax_retries回まで再試行する。
+        - 429の場合、またはrate_limited(結果)が真の場合は、全体の受付を止めてから再試行する。
+        - 接続エラーと5xxの場合は、この呼び出しだけ待ってから再試行する。
+        リクエストが受け付けられなかった場合にだけ失敗する呼び出しに使う。
+        """
+        attempt = 0
+        while True:
+            delay = self.paused_until - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                result = await fn()
+                if rate_limited is None or not rate_limited(result) or attempt >= self.max_retries:
+                    return result
+                error = None
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt >= self.max_retries:
+                    if isinstance(e, openai.RateLimitError):
+                        self.rate_limited += 1
+                        RATE_LIMITED.inc()
+                    raise
+                error = e
+            delay = _retry_after(error) if error is not None else None
+            if delay is None:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * (0.5 + random() / 2)
+            attempt += 1
+            self.retries += 1
+            if error is None or isinstance(error, openai.RateLimitError):
+                self.rate_limited += 1
+                RATE_LIMITED.inc()
+                self.logger.warning(f"OpenAI rate limit hit. Pausing requests for {delay:.1f}s (attempt {attempt}).")
+                self.paused_until = max(self.paused_until, monotonic() + delay)
+            else:
+                self.logger.warning(f"OpenAI request failed: {error}. Retrying in {delay:.1f}s (attempt {attempt}).")
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        def quantile(q):
+            return waits[min(len(waits) - 1, int(q * len(waits)))] if waits else 0.0
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "waiting": self.waiting,
+            "waiting_sessions": len(self.queues),
+            "granted": self.granted,
+            "queue_wait": {
+                "mean": self.total_wait / self.granted if self.granted else 0.0,
+                "p50": quantile(0.5),
+                "p95": quantile(0.95),
+                "p99": quantile(0.99),
+                "max": self.max_wait,
+            },
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "paused_for": max(0.0, self.paused_until - monotonic()),
+            "request_bucket": self.request_bucket.level if self.request_bucket.enabled else None,
+            "token_bucket": self.token_bucket.level if self.token_bucket.enabled else None,
+            "used_tokens": self.used_tokens,
+        }
+
+def _retry_after(e) -> Optional[float]:
+    """429の応答のretry-after(-ms)ヘッダの秒数。"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
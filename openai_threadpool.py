@@ -0,0 +1,187 @@
+import asyncio
+import math
+from collections import deque
+from dataclasses import dataclass
+from time import monotonic
+from typing import Deque, Dict, List, Optional
+
+from modelRole import PatientRoleProvider, normalize_patient_id
+from openai_assistant import OpenAIAssistantWrapper
+
+# 補充するスレッドの作成は、このkeyでセッションの操作が待っていない時に行う
+THREAD_POOL_KEY = "threadpool"
+
+@dataclass
+class WarmThread:
+    """患者のプロンプトを投入済みで、セッションに割り当てられるのを待っているスレッド。"""
+    thread_id: str
+    patient_id: str
+    interview_date_str: str
+    prompt_chunks: List[str]
+    data_version: Optional[str]
+    created_at: float
+
+class AssistantThreadPool():
+    """
+    よく選ばれる患者ごとに、プロンプト投入済みのスレッドを事前に用意しておく。
+    セッション開始時はclaim()でスレッドを受け取るだけで済む。
+
+    - 患者ごとの需要はclaim()の回数を半減期つきで数えたもので、
+      需要の大きい上位thread_pool_patients人に、需要に応じて
+      最大thread_pool_size個までスレッドを用意する。
+    - thread_pool_ttl秒使われなかったスレッドや、読み込み直す前の
+      データから作ったスレッドは削除する。
+    """
+    def __init__(self, config, oaw: OpenAIAssistantWrapper, role_provider: PatientRoleProvider):
+        self.logger = config.logger
+        self.oaw = oaw
+        self.role_provider = role_provider
+        self.max_per_patient = config.thread_pool_size
+        self.max_patients = config.thread_pool_patients
+        self.ttl = config.thread_pool_ttl
+        self.refill_interval = config.thread_pool_refill_interval
+        self.demand_halflife = config.thread_pool_demand_halflife
+        self.pools: Dict[str, Deque[WarmThread]] = {}
+        self.demand: Dict[str, float] = {}
+        self.demand_updated_at = monotonic()
+        self.task = None
+        # claim()から投げた削除処理のタスク
+        self.deleting = set()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.expired = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_per_patient > 0 and self.max_patients > 0
+
+    def start(self):
+        if self.enabled and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """補充を止め、使われなかったスレッドを全て削除する。"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        threads = [t for pool in self.pools.values() for t in pool]
+        self.pools.clear()
+        await asyncio.gather(*(self._delete(t) for t in threads))
+
+    def claim(self, patient_id: str) -> Optional[WarmThread]:
+        """用意済みのスレッドがあれば取り出す。無ければNoneを返す。"""
+        if not self.enabled:
+            return None
+        patient_id = normalize_patient_id(patient_id)
+        self._decay_demand()
+        self.demand[patient_id] = self.demand.get(patient_id, 0.0) + 1.0
+        pool = self.pools.get(patient_id)
+        now = monotonic()
+        while pool:
+            warm = pool.popleft()
+            if self._is_usable(warm, now):
+                self.hits += 1
+                return warm
+            # 期限切れなどは次の補充時ではなくここで捨てる
+            self.expired += 1
+            task = asyncio.create_task(self._delete(warm))
+            self.deleting.add(task)
+            task.add_done_callback(self.deleting.discard)
+        self.misses += 1
+        return None
+
+    def _is_usable(self, warm: WarmThread, now: float) -> bool:
+        return (now - warm.created_at < self.ttl
+                and warm.data_version == self.role_provider.data_version)
+
+    def _decay_demand(self):
+        now = monotonic()
+        elapsed = now - self.demand_updated_at
+        self.demand_updated_at = now
+        if elapsed <= 0 or not self.demand:
+            return
+        factor = 0.5 ** (elapsed / self.demand_halflife)
+        self.demand = {pid: d * factor for pid, d in self.demand.items() if d * factor >= 0.01}
+
+    def targets(self) -> Dict[str, int]:
+        """患者IDごとに用意しておくスレッド数。"""
+        if self.role_provider.index is None:
+            return {}
+        available = set(self.role_provider.get_available_patient_ids())
+        ranked = sorted((pid for pid in self.demand if pid in available),
+                        key=lambda pid: self.demand[pid], reverse=True)
+        return {pid: min(self.max_per_patient, math.ceil(self.demand[pid]))
+                for pid in ranked[:self.max_patients]}
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refill()
+            except Exception as e:
+                self.logger.error(f"Failed to refill assistant thread pool: {e}")
+            await asyncio.sleep(self.refill_interval)
+
+    async def refill(self):
+        """期限切れのスレッドを削除し、目標数に足りない分を作成する。"""
+        self._decay_demand()
+        targets = self.targets()
+        now = monotonic()
+        stale = []
+        for pid, pool in self.pools.items():
+            keep = deque()
+            for t in pool:
+                (keep if self._is_usable(t, now) else stale).append(t)
+            # 需要が減った分も削除する
+            while len(keep) > targets.get(pid, 0):
+                stale.append(keep.pop())
+            self.pools[pid] = keep
+        self.expired += len(stale)
+        jobs = [pid for pid, target in targets.items()
+                for _ in range(target - len(self.pools.get(pid, ())))]
+        await asyncio.gather(*(self._delete(t) for t in stale),
+                             *(self._create(pid) for pid in jobs))
+
+    async def _create(self, patient_id: str):
+        data_version = self.role_provider.data_version
+        prompt_chunks, interview_date_str = self.role_provider.get_patient_prompt_chunks(patient_id)
+        if not interview_date_str:
+            return
+        try:
+            thread_id = await self.oaw.create_seeded_thread(prompt_chunks, THREAD_POOL_KEY, background=True)
+        except Exception as e:
+            self.failed += 1
+            self.logger.warning(f"Failed to create a warm thread for patient {patient_id}: {e}")
+            return
+        self.created += 1
+        self.pools.setdefault(patient_id, deque()).append(WarmThread(
+            thread_id=thread_id, patient_id=patient_id,
+            interview_date_str=interview_date_str, prompt_chunks=prompt_chunks,
+            data_version=data_version, created_at=monotonic(),
+        ))
+
+    async def _delete(self, warm: WarmThread):
+        try:
+            await self.oaw.delete_thread_id(warm.thread_id)
+        except Exception as e:
+            self.logger.debug(f"Failed to delete warm thread {warm.thread_id}: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "pooled": {pid: len(pool) for pid, pool in self.pools.items() if pool},
+            "targets": self.targets() if self.enabled else {},
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "created": self.created,
+            "expired": self.expired,
+            "failed": self.failed,
+        }
@@ -0,0 +1,195 @@
+"""
+動いているサーバの調査用。管理者用のエンドポイント (/v1/admin/profile/...) から使う。
+- SamplingProfiler: イベントループのスレッドのスタックを一定間隔で取り出して数える。
+- memory_diff: tracemallocのスナップショットを2回取り、増えた箇所を並べる。
+- LoopWatchdog: イベントループが止まっている間に、止めているコールバックのスタックをログに出す。
+"""
+import asyncio
+import os
+import sys
+import threading
+import tracemalloc
+import traceback
+from collections import Counter, deque
+from time import monotonic, sleep
+from typing import Optional
+
+# 待ち受け中 (selectなど) のサンプルの判定に使う関数名
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "kqueue", "_run_once"}
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+def _function_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler():
+    """
+    thread_idのスレッドのスタックをinterval秒ごとに取り出す。
+    関数ごとの自身の時間 (self) と、スタックに含まれていた時間 (total) を、
+    サンプル数の割合で返す。stacksはflamegraph.plなどで読める畳み込み形式。
+    """
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+
+    def run(self, seconds: float, top: int = 30) -> dict:
+        """seconds秒サンプリングする。呼び出したスレッドを止めるため、asyncio.to_thread()で使う。"""
+        stacks = Counter()
+        self_counts = Counter()
+        total_counts = Counter()
+        samples = idle = 0
+        deadline = monotonic() + seconds
+        while monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            labels = []
+            functions = set()
+            leaf = frame
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                functions.add(_function_label(frame))
+                frame = frame.f_back
+            del frame
+            samples += 1
+            if leaf.f_code.co_name in IDLE_FUNCTIONS:
+                idle += 1
+            else:
+                stacks[";".join(reversed(labels))] += 1
+                self_counts[_function_label(leaf)] += 1
+                total_counts.update(functions)
+            del leaf
+            sleep(self.interval)
+        busy = samples - idle
+        def ranking(counts):
+            return [{"function": f, "samples": n, "ratio": n / samples}
+                    for f, n in counts.most_common(top)]
+        return {
+            "seconds": seconds,
+            "interval": self.interval,
+            "samples": samples,
+            "idle_samples": idle,
+            "busy_ratio": busy / samples if samples else 0.0,
+            "top_self": ranking(self_counts),
+            "top_total": ranking(total_counts),
+            "stacks": "\n".join(f"{s} {n}" for s, n in stacks.most_common()),
+        }
+
+async def memory_diff(seconds: float, top: int = 30, frames: int = 10) -> dict:
+    """
+    seconds秒の間に増えたメモリを、確保した行ごとに返す。
+    tracemallocが止まっていれば、この間だけ動かす (動いている間は処理が遅くなる)。
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        before = await asyncio.to_thread(tracemalloc.take_snapshot)
+        await asyncio.sleep(seconds)
+        after = await asyncio.to_thread(tracemalloc.take_snapshot)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), "lineno")
+    return {
+        "seconds": seconds,
+        "traced_current": current,
+        "traced_peak": peak,
+        "size_diff": sum(s.size_diff for s in stats),
+        "top": [{
+            "location": f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+            "size_diff": s.size_diff,
+            "size": s.size,
+            "count_diff": s.count_diff,
+            "count": s.count,
+        } for s in stats[:top]],
+    }
+
+class LoopWatchdog():
+    """
+    イベントループがthreshold秒以上応答しない間に、ループのスレッドのスタックを
+    ログに出す。ループの中では0.25*threshold秒ごとに時刻を記録するだけのタスクが動き、
+    別のスレッドがその時刻の更新が止まっていないかを確認する。
+    """
+    def __init__(self, threshold: float, logger, history: int = 20):
+        self.threshold = threshold
+        self.logger = logger
+        self.beat = monotonic()
+        self.loop_thread_id = None
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        # metrics
+        self.blocked = 0
+        self.max_blocked = 0.0
+        self.recent = deque(maxlen=history)
+
+    def start(self):
+        """イベントループのスレッドから呼ぶ。"""
+        if self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.beat = monotonic()
+        self.stopping.clear()
+        self.task = asyncio.create_task(self._heartbeat())
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.stopping.set()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await asyncio.to_thread(self.thread.join)
+        self.thread = None
+
+    async def _heartbeat(self):
+        interval = self.threshold / 4
+        while True:
+            await asyncio.sleep(interval)
+            now = monotonic()
+            # 予定より遅れた分が、ループが止まっていた時間
+            lag = now - self.beat - interval
+            self.beat = now
+            if lag > self.threshold:
+                self.blocked += 1
+                self.max_blocked = max(self.max_blocked, lag)
+                if self.recent and self.recent[-1]["duration"] is None:
+                    self.recent[-1]["duration"] = lag
+                self.logger.warning(f"Event loop was blocked for {lag * 1000:.0f} ms.")
+
+    def _watch(self):
+        reported = None
+        while not self.stopping.wait(self.threshold / 4):
+            beat = self.beat
+            if monotonic() - beat <= self.threshold * 1.25 or reported == beat:
+                continue
+            # 止まっている最中なので、今のスタックが止めている処理
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            del frame
+            reported = beat
+            self.recent.append({"detected_after": monotonic() - beat, "duration": None, "stack": stack})
+            self.logger.warning(f"Event loop is blocked for more than {self.threshold * 1000:.0f} ms:\n{stack}")
+
+    def stats(self) -> dict:
+        return {
+            "running": self.task is not None,
+            "threshold_ms": self.threshold * 1000,
+            "blocked": self.blocked,
+            "max_blocked_ms": self.max_blocked * 1000,
+            "recent": list(self.recent),
+        }
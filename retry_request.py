@@ -7,6 +7,7 @@ from argparse import ArgumentParser
 import re
 from os import environ
 from modelHistory import History
+from historyarchive import HistoryArchive
 from openai_etc import openai_get_apikey
 
 class Config(BaseModel):
@@ -68,7 +69,11 @@ def start_test(client,
 #
 ap = ArgumentParser()
 ap.add_argument("-i", help="specify a history file.",
-                dest="history_file", required=True)
+                dest="history_file")
+ap.add_argument("-a", help="specify a history archive directory.",
+                dest="archive_path")
+ap.add_argument("--session", help="read the history of this session from the archive.",
+                dest="session_id")
 ap.add_argument("-o", help="specify a result file.",
                 dest="result_file", required=True)
 ap.add_argument("-k", help="specify APIKEY file.",
@@ -80,10 +85,19 @@ ap.add_argument("-w", help="specify a number of waiting time in second.",
 ap.add_argument("-v", help="set verbose mode.",
                 action="store_true", dest="verbose")
 opt = ap.parse_args()
+if not opt.history_file and not (opt.archive_path and opt.session_id):
+    ap.error("either -i or both -a and --session are required.")
 
+history = None
 if opt.history_file:
     js = json.load(open(opt.history_file, encoding="utf-8"))
     history = History.model_validate(js)
+elif opt.archive_path:
+    history = HistoryArchive(opt.archive_path).read(opt.session_id)
+    if history is None:
+        ap.error(f"session {opt.session_id} is not found in {opt.archive_path}.")
+
+if history is not None:
     config = Config(
             wait_time = opt.wait_time,
             truncation_strategy = {
@@ -0,0 +1,171 @@
+from __future__ import annotations
+import asyncio
+import io
+import os
+import sqlite3
+from datetime import datetime
+from typing import Optional, Set
+
+from lazyimport import lazy_import
+
+pd = lazy_import("pandas")
+
+class RoleSource():
+    """
+    患者データの読み込み元。PatientRoleProviderはget_version()で更新を確認し、
+    変わっていればread()で読み込み直す。
+    read()が返すDataFrameは、use_columnsに含まれる列だけを持つ。
+    行動履歴の列名はdatetimeにしておく。
+    """
+    def __init__(self, use_columns: Set):
+        self.use_columns = use_columns
+
+    async def get_version(self) -> Optional[str]:
+        """データの版を表す文字列。取得できない場合はNone。"""
+        raise NotImplementedError
+
+    async def read(self) -> Optional[pd.DataFrame]:
+        """データを読み込む。読み込めない場合はNone。"""
+        raise NotImplementedError
+
+    def _select_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        df = df.rename(columns=_parse_date_column)
+        return df[[c for c in df.columns if c in self.use_columns]]
+
+class GoogleDriveRoleSource(RoleSource):
+    """Google Drive上のExcelファイル。版はファイルのmd5Checksum。"""
+    def __init__(self, use_columns: Set, file_id: str, service_account: str, sheet_name=2):
+        super().__init__(use_columns)
+        if not file_id:
+            raise ValueError("設定にGoogle DriveのファイルID(gdrive_file_id)が指定されていません。")
+        if not service_account or not os.path.exists(service_account):
+            raise FileNotFoundError(f"サービスアカウントのキーファイルが見つかりません: {service_account}")
+        self.file_id = file_id
+        self.sheet_name = sheet_name
+        self.service_account = service_account
+        self._drive_service = None
+
+    @property
+    def drive_service(self):
+        # googleapiclientの読み込みとクライアントの構築は、最初に使う時まで遅らせる
+        if self._drive_service is None:
+            from google.oauth2.service_account import Credentials
+            from googleapiclient.discovery import build
+            scope = ["https://www.googleapis.com/auth/drive.readonly"]
+            creds = Credentials.from_service_account_file(self.service_account, scopes=scope)
+            self._drive_service = build("drive", "v3", credentials=creds)
+        return self._drive_service
+
+    async def get_version(self) -> Optional[str]:
+        from googleapiclient.errors import HttpError
+        loop = asyncio.get_running_loop()
+        try:
+            file_metadata = await loop.run_in_executor(
+                None, lambda: self.drive_service.files().get(fileId=self.file_id, fields="md5Checksum").execute()
+            )
+            return file_metadata.get("md5Checksum")
+        except HttpError as e:
+            print(f"ETagの取得エラー: {e}")
+            return None
+
+    async def read(self) -> Optional[pd.DataFrame]:
+        from googleapiclient.errors import HttpError
+        from googleapiclient.http import MediaIoBaseDownload
+        loop = asyncio.get_running_loop()
+        try:
+            request = self.drive_service.files().get_media(fileId=self.file_id)
+            file_stream = io.BytesIO()
+            downloader = MediaIoBaseDownload(file_stream, request)
+            done = False
+            while not done:
+                status, done = await loop.run_in_executor(None, downloader.next_chunk)
+            file_stream.seek(0)
+            # シートの解析は時間がかかるため、イベントループの外で行う
+            return await loop.run_in_executor(
+                None, lambda: pd.read_excel(file_stream, sheet_name=self.sheet_name,
+                                            usecols=lambda col: col in self.use_columns)
+            )
+        except HttpError as e:
+            print(f"ファイルのダウンロードエラー: {e}")
+            return None
+        except ValueError as e:
+            print(f"シート '{self.sheet_name}' の読み込みエラー: {e}")
+            return None
+
+class LocalFileRoleSource(RoleSource):
+    """
+    手元のExcel (.xlsx) またはCSVファイル。版はファイルの更新時刻とサイズ。
+    CSVの場合、日付の見出し (2022-04-02など) は行動履歴の列として扱う。
+    """
+    def __init__(self, use_columns: Set, path: str, sheet_name=2):
+        super().__init__(use_columns)
+        self.path = path
+        self.sheet_name = sheet_name
+
+    async def get_version(self) -> Optional[str]:
+        return _file_version(self.path)
+
+    async def read(self) -> Optional[pd.DataFrame]:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._read)
+        except (OSError, ValueError) as e:
+            print(f"ファイルの読み込みエラー: {self.path}: {e}")
+            return None
+
+    def _read(self) -> pd.DataFrame:
+        if self.path.lower().endswith(".csv"):
+            return self._select_columns(pd.read_csv(self.path))
+        return pd.read_excel(self.path, sheet_name=self.sheet_name,
+                             usecols=lambda col: col in self.use_columns)
+
+class SQLiteRoleSource(RoleSource):
+    """
+    SQLiteのテーブル。列名はシートの見出しと同じにする。版はファイルの更新時刻とサイズ。
+    """
+    def __init__(self, use_columns: Set, path: str, table: str):
+        super().__init__(use_columns)
+        self.path = path
+        self.table = table
+
+    async def get_version(self) -> Optional[str]:
+        return _file_version(self.path)
+
+    async def read(self) -> Optional[pd.DataFrame]:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._read)
+        except (OSError, ValueError, sqlite3.Error, pd.errors.DatabaseError) as e:
+            print(f"テーブルの読み込みエラー: {self.path} {self.table}: {e}")
+            return None
+
+    def _read(self) -> pd.DataFrame:
+        # 読み取り専用で開き、ファイルが無い場合に空のDBを作らないようにする
+        with sqlite3.connect(f"file:{self.path}?mode=ro", uri=True) as conn:
+            table = self.table.replace('"', '""')
+            return self._select_columns(pd.read_sql_query(f'SELECT * FROM "{table}"', conn))
+
+def create_role_source(config, use_columns: Set) -> RoleSource:
+    """config.role_sourceに応じた読み込み元を作る。"""
+    if config.role_source == "gdrive":
+        return GoogleDriveRoleSource(use_columns, config.gdrive_file_id, config.gdrive_service_account)
+    if config.role_source == "file":
+        return LocalFileRoleSource(use_columns, config.role_source_path)
+    if config.role_source == "sqlite":
+        return SQLiteRoleSource(use_columns, config.role_source_path, config.role_source_table)
+    raise ValueError(f"未対応のrole_sourceです: {config.role_source}")
+
+def _file_version(path: str) -> Optional[str]:
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        print(f"ファイルの情報の取得エラー: {path}: {e}")
+        return None
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+def _parse_date_column(name):
+    """"2022-04-02" のような見出しをdatetimeにする。それ以外はそのまま返す。"""
+    if isinstance(name, str) and name[:1].isdigit():
+        try:
+            return datetime.fromisoformat(name.strip())
+        except ValueError:
+            pass
+    return name
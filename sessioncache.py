@@ -0,0 +1,105 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cacheutil import LRUCache
+import modelDatabase
+from modelSession import Session as SessionModel
+
+# スナップショットに保持するsessionsテーブルのカラム
+SESSION_COLUMNS = ("session_id", "user_name", "user_role", "patient_id", "status",
+                   "thread_id", "interview_date", "created_at", "completed_at")
+# スナップショットに保持するchat_logsテーブルのカラム
+TRANSCRIPT_COLUMNS = ("sender", "message", "is_initial_message", "created_at")
+
+@dataclass
+class SessionSnapshot:
+    """セッションの復元に必要な情報一式。"""
+    # sessionsテーブルの1行 (SESSION_COLUMNS)
+    session: dict
+    # chat_logsの行 (TRANSCRIPT_COLUMNS) を記録順に並べたもの
+    transcript: List[dict] = field(default_factory=list)
+    # 保健師のセッションで表示する患者情報
+    patient_info: dict = field(default_factory=dict)
+
+class SessionSnapshotCache():
+    """
+    セッションのスナップショットを件数上限とTTLつきで保持する。
+    対話ログはlog_message()からの書き込み時にここにも追記されるため、
+    GET /v1/session/{session_id} とWSでの復元はDBを読まずに済む。
+    キャッシュに無い場合だけDBから読み込んで保持する。
+    DBから読む前に、ChatLogWriterに残っているそのセッションのログの書き込みを待つ。
+    """
+    def __init__(self, maxsize: int, ttl: Optional[float]):
+        self.cache = LRUCache(maxsize, ttl)
+        self.db_loads = 0
+
+    def get(self, session_id: str) -> Optional[SessionSnapshot]:
+        return self.cache.get(session_id)
+
+    def put(self, snapshot: SessionSnapshot):
+        self.cache.put(snapshot.session["session_id"], snapshot)
+
+    def put_session_row(self, db_session: SessionModel, patient_info: dict = None) -> SessionSnapshot:
+        """新しく作ったセッションを、空の対話ログとともに保持する。"""
+        snapshot = SessionSnapshot(session=_row_to_dict(db_session, SESSION_COLUMNS),
+                                   patient_info=patient_info or {})
+        self.put(snapshot)
+        return snapshot
+
+    def update_session(self, session_id: str, **values):
+        snapshot = self.cache.get(session_id)
+        if snapshot is not None:
+            snapshot.session.update(values)
+
+    def append_log(self, record: dict):
+        """log_message()で書き込むログを、保持しているスナップショットにも追記する。"""
+        snapshot = self.cache.get(record["session_id"])
+        if snapshot is not None:
+            snapshot.transcript.append({k: record.get(k) for k in TRANSCRIPT_COLUMNS})
+            # 使われているセッションは期限を延ばす
+            self.put(snapshot)
+
+    def invalidate(self, session_id: str):
+        self.cache.pop(session_id)
+
+    async def load(self, db: AsyncSession, session_id: str, role_provider=None,
+                   log_writer=None) -> Optional[SessionSnapshot]:
+        """キャッシュから、無ければDBからスナップショットを取得する。"""
+        snapshot = self.cache.get(session_id)
+        if snapshot is not None:
+            return snapshot
+
+        if log_writer is not None:
+            await log_writer.wait_written(session_id)
+
+        db_session = (await db.execute(select(SessionModel).where(
+            SessionModel.session_id == session_id
+        ))).scalars().first()
+        if db_session is None:
+            return None
+        logs = (await db.execute(select(modelDatabase.ChatLog).where(
+            modelDatabase.ChatLog.session_id == session_id
+        ).order_by(modelDatabase.ChatLog.created_at.asc()))).scalars().all()
+        self.db_loads += 1
+
+        patient_info = {}
+        if (role_provider is not None and role_provider.index is not None
+                and db_session.user_role == '保健師' and db_session.patient_id):
+            patient_info = role_provider.get_patient_details(db_session.patient_id)
+        snapshot = SessionSnapshot(
+            session=_row_to_dict(db_session, SESSION_COLUMNS),
+            transcript=[_row_to_dict(log, TRANSCRIPT_COLUMNS) for log in logs],
+            patient_info=patient_info,
+        )
+        self.put(snapshot)
+        return snapshot
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats["db_loads"] = self.db_loads
+        return stats
+
+def _row_to_dict(row, columns) -> dict:
+    return {c: getattr(row, c) for c in columns}
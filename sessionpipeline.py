@@ -0,0 +1,202 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from enum import Enum
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from modelChat import MsgType, MessageSubmitted
+from metrics import REGISTRY
+
+WS_MESSAGES = REGISTRY.counter(
+    "chat_ws_received_messages_total", "WebSocket messages received in sessions, by type.", ("msg_type",))
+MESSAGE_BATCH_SECONDS = REGISTRY.histogram(
+    "chat_message_batch_seconds", "Time to process a batch of user messages, including the AI response.")
+
+class SessionState(Enum):
+    Idle = 1            # 発言を待っている
+    Running = 2         # 発言を処理している (AIの応答待ちなど)
+    AwaitingAction = 3  # AIが会話の終了を提案し、利用者の判断 (Continue/Debriefing) を待っている
+    Debriefing = 4      # 評価を生成している
+    Ending = 5          # 終了処理をしている
+    Closed = 6
+
+# 制御メッセージの実行方法
+INLINE = "inline"   # 受信側でその場で実行し、Idleに戻る
+JOB = "job"         # 処理中の発言の代わりにworkerの仕事として実行する
+FINAL = "final"     # 実行後にセッションを終える
+
+@dataclass
+class MessageBatch:
+    """
+    workerが1回で処理する発言。取り消されて処理し直す時に、
+    済んだ処理を繰り返さないよう、on_messagesがどこまで進んだかを持つ。
+    """
+    messages: List[MessageSubmitted]
+    # ログと履歴に記録した発言の数 (先頭から)
+    recorded: int = 0
+    # 相手 (AIのスレッドまたは人間) に届けた発言の数 (先頭から)
+    delivered: int = 0
+    # 相手の応答まで済んだ
+    done: bool = False
+
+MessagesHandler = Callable[[MessageBatch], Awaitable[Optional[SessionState]]]
+ControlHandler = Callable[[dict], Awaitable[None]]
+
+class SessionPipeline():
+    """
+    1つのWSの受信 (reader) と、受信した発言の処理 (worker) を分けて動かす。
+    - readerはWSを読み続ける。発言は列に積み、制御メッセージは処理中の発言を
+      取り消してから実行するため、AIの応答を待たずに効く。
+    - workerはIdleの時だけ列の発言を取り出す。処理中に届いた発言は、次の1回でまとめて
+      (coalesceがFalseなら1件ずつ) 届いた順に処理する。
+    - 列がmax_pending件に達している間に届いた発言はon_overflowに渡して捨てる。
+    - INLINEの制御メッセージで取り消した発言は、他の発言とまとめずに次の1回で処理し直す。
+      on_messagesはMessageBatchの記録を見て、済んだ処理 (ログ、スレッドへの追加、転送) を飛ばす。
+    on_messagesは次の状態を返せる。AwaitingActionを返すと、制御メッセージが来るまで
+    列の発言を処理しない。
+    """
+    def __init__(self, ws, logger, on_messages: MessagesHandler,
+                 max_pending: int = 10, coalesce: bool = True):
+        self.ws = ws
+        self.logger = logger
+        self.on_messages = on_messages
+        self.on_overflow: Optional[Callable[[MessageSubmitted], Awaitable[None]]] = None
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+        self.state = SessionState.Idle
+        self.pending: deque = deque()
+        # msg_type -> (handler, 実行方法, JOBの実行中の状態)
+        self.controls: Dict[str, Tuple[ControlHandler, str, SessionState]] = {}
+        # 実行中の仕事 (発言の処理またはJOBの制御メッセージ)
+        self.job: Optional[asyncio.Task] = None
+        # 処理中の発言と、取り消されて処理し直す発言
+        self.batch: Optional[MessageBatch] = None
+        self.retry: Optional[MessageBatch] = None
+        self.wakeup = asyncio.Event()
+        self.coalesced = 0
+        self.preempted = 0
+        self.requeued = 0
+        self.rejected = 0
+
+    def add_control(self, msg_type: str, handler: ControlHandler, mode: str = INLINE,
+                    state: SessionState = SessionState.Running):
+        self.controls[msg_type] = (handler, mode, state)
+
+    async def run(self):
+        """WSが切断されるか、FINALの制御メッセージを実行し終えるまで動く。"""
+        worker = asyncio.create_task(self._work())
+        try:
+            await self._read()
+        finally:
+            self.state = SessionState.Closed
+            for task in (worker, self.job):
+                if task is not None and not task.done():
+                    task.cancel()
+            await asyncio.gather(*(t for t in (worker, self.job) if t is not None), return_exceptions=True)
+
+    async def _read(self):
+        while True:
+            data = await self.ws.receive_json()
+            msg_type = data.get("msg_type")
+            WS_MESSAGES.inc(msg_type=msg_type if msg_type in MsgType.__members__ else "unknown")
+            if msg_type == MsgType.MessageSubmitted.name:
+                m = MessageSubmitted.model_validate(data)
+                if len(self.pending) >= self.max_pending:
+                    self.rejected += 1
+                    if self.on_overflow:
+                        await self.on_overflow(m)
+                    continue
+                self.pending.append(m)
+                self.wakeup.set()
+                continue
+            if msg_type not in self.controls:
+                self.logger.warning(f"Unknown message type in session: {msg_type}")
+                continue
+            handler, mode, state = self.controls[msg_type]
+            # INLINE (Continue) の後は列の発言を続けて処理し、それ以外では捨てる
+            await self.preempt(drop_pending=mode != INLINE)
+            if mode == FINAL:
+                self.state = SessionState.Ending
+                await handler(data)
+                return
+            if mode == JOB:
+                self.state = state
+                self.job = asyncio.create_task(self._control_job(handler, data, state))
+                continue
+            await handler(data)
+            self.state = SessionState.Idle
+            self.wakeup.set()
+
+    async def preempt(self, drop_pending: bool = False):
+        """
+        実行中の仕事を取り消し、終わるのを待つ。
+        drop_pendingでなければ、取り消した発言を次に処理し直す。
+        """
+        job = self.job
+        batch = self.batch
+        if job is not None and not job.done():
+            self.preempted += 1
+            self.logger.debug(f"Preempting the in-flight job in state {self.state.name}")
+            job.cancel()
+            await asyncio.wait([job])
+            if job.cancelled() and batch is not None and not batch.done and not drop_pending:
+                self.retry = batch
+                self.requeued += len(batch.messages)
+                self.logger.debug(f"Requeued {len(batch.messages)} preempted messages.")
+        self.batch = None
+        if drop_pending:
+            self.retry = None
+        if drop_pending and self.pending:
+            self.logger.info(f"Dropped {len(self.pending)} pending messages.")
+            self.pending.clear()
+
+    async def _control_job(self, handler: ControlHandler, data: dict, state: SessionState):
+        try:
+            await handler(data)
+        except Exception as e:
+            self.logger.error(f"Error while processing a control message: {e}")
+        if self.state == state:
+            self.state = SessionState.Idle
+            self.wakeup.set()
+
+    def _take(self) -> List[MessageSubmitted]:
+        if not self.coalesce:
+            return [self.pending.popleft()]
+        batch = list(self.pending)
+        self.pending.clear()
+        self.coalesced += len(batch) - 1
+        return batch
+
+    async def _work(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.state == SessionState.Idle and (self.retry or self.pending):
+                self.state = SessionState.Running
+                self.batch = self.retry or MessageBatch(self._take())
+                self.retry = None
+                self.job = asyncio.create_task(self.on_messages(self.batch))
+                job = self.job
+                with MESSAGE_BATCH_SECONDS.time():
+                    await asyncio.wait([job])
+                next_state = None
+                if job.cancelled():
+                    # 取り消した側が次の状態を決める
+                    continue
+                self.batch = None
+                if job.exception() is not None:
+                    self.logger.error(f"Error while processing messages: {job.exception()}")
+                else:
+                    next_state = job.result()
+                if self.state == SessionState.Running:
+                    self.state = next_state or SessionState.Idle
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state.name,
+            "pending": len(self.pending) + (len(self.retry.messages) if self.retry else 0),
+            "coalesced": self.coalesced,
+            "preempted": self.preempted,
+            "requeued": self.requeued,
+            "rejected": self.rejected,
+        }
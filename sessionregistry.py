@@ -0,0 +1,126 @@
+from collections import OrderedDict
+from pydantic import BaseModel
+from typing import Any, Dict, List, Optional, Union
+
+from modelChat import Status
+from modelUserDef import UserDef, AssistantDef
+from modelHistory import History
+
+class APISession(BaseModel):
+    users: List[Union[UserDef, AssistantDef]]
+    history: History
+    session_id: str
+    # セッション開始時の患者データ (modelRole.PatientData)。
+    # 患者データが読み込み直されても、セッション中はこれを使い続ける。
+    role_data: Any = None
+
+class SessionRegistry():
+    """
+    登録済みユーザとセッションの管理。
+    全ての操作はawaitを含まないため、イベントループ上では不可分に実行される。
+    いずれの検索・追加・削除も全ユーザの走査を行わず、O(1)で済む。
+    """
+    def __init__(self):
+        # user_id -> 登録済み(Registered/Prepared)でセッション未確立のユーザ
+        self.waiting: Dict[str, UserDef] = {}
+        # role -> waitingにいるそのロールのユーザ数
+        self.waiting_counts: Dict[str, int] = {}
+        # role -> (user_id -> Prepared状態のユーザ)。登録順に並ぶ。
+        self.prepared: Dict[str, OrderedDict] = {}
+        # session_id -> セッション
+        self.sessions: Dict[str, APISession] = {}
+        # user_id -> session_id
+        self.user_sessions: Dict[str, str] = {}
+
+    # --- waiting users ---
+    def add_waiting(self, user: UserDef):
+        if user.user_id not in self.waiting:
+            self.waiting_counts[user.role] = self.waiting_counts.get(user.role, 0) + 1
+        self.waiting[user.user_id] = user
+
+    def waiting_count(self, role: str) -> int:
+        return self.waiting_counts.get(role, 0)
+
+    def get_waiting(self, user_id: str) -> Optional[UserDef]:
+        return self.waiting.get(user_id)
+
+    def set_prepared(self, user: UserDef):
+        """WS接続が確立したユーザを、相手を待つユーザとして登録する。"""
+        user.status = Status.Prepared.name
+        self.prepared.setdefault(user.role, OrderedDict())[user.user_id] = user
+
+    def remove_waiting(self, user_id: str) -> Optional[UserDef]:
+        user = self.waiting.pop(user_id, None)
+        if user is not None:
+            self.waiting_counts[user.role] -= 1
+            self.remove_prepared(user)
+        return user
+
+    def remove_prepared(self, user: UserDef):
+        """相手を待つユーザの列からだけ外す。waitingには残る。"""
+        queue = self.prepared.get(user.role)
+        if queue is not None:
+            queue.pop(user.user_id, None)
+
+    def prepared_users(self, role: str) -> List[UserDef]:
+        queue = self.prepared.get(role)
+        return list(queue.values()) if queue else []
+
+    def find_prepared(self, role: str) -> Optional[UserDef]:
+        """指定したロールで最も長く待っているPreparedのユーザを返す。"""
+        queue = self.prepared.get(role)
+        if not queue:
+            return None
+        return next(iter(queue.values()))
+
+    # --- sessions ---
+    def add_session(self, session: APISession):
+        self.sessions[session.session_id] = session
+        for u in session.users:
+            self.user_sessions[u.user_id] = session.session_id
+
+    def attach_user(self, session: APISession, user: UserDef):
+        """再接続したユーザを、同じロールの既存ユーザと置き換えてセッションに結びつける。"""
+        for i, u in enumerate(session.users):
+            if isinstance(u, UserDef) and u.role == user.role:
+                if self.user_sessions.get(u.user_id) == session.session_id:
+                    del self.user_sessions[u.user_id]
+                session.users[i] = user
+                break
+        else:
+            session.users.append(user)
+        self.user_sessions[user.user_id] = session.session_id
+
+    def get_session(self, session_id: str) -> Optional[APISession]:
+        return self.sessions.get(session_id)
+
+    def find_user_session(self, user_id: str) -> Optional[APISession]:
+        session_id = self.user_sessions.get(user_id)
+        if session_id is None:
+            return None
+        return self.sessions.get(session_id)
+
+    def find_user(self, user_id: str) -> Optional[UserDef]:
+        """user_idのユーザを、待ち中またはセッション中のユーザから探す。"""
+        user = self.waiting.get(user_id)
+        if user is not None:
+            return user
+        session = self.find_user_session(user_id)
+        if session is None:
+            return None
+        return next((u for u in session.users if u.user_id == user_id), None)
+
+    def remove_session(self, session_id: str) -> Optional[APISession]:
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            for u in session.users:
+                if self.user_sessions.get(u.user_id) == session_id:
+                    del self.user_sessions[u.user_id]
+        return session
+
+    def stats(self) -> dict:
+        return {
+            "waiting_users": len(self.waiting),
+            "prepared_users": {role: len(q) for role, q in self.prepared.items()},
+            "active_sessions": len(self.sessions),
+        }
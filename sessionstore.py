@@ -0,0 +1,418 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from modelUserDef import UserDef
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+def new_node_id() -> str:
+    """このプロセスを表すID。ホスト名とpidに、再起動で重ならないよう乱数を付ける。"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+def user_record(user: UserDef) -> dict:
+    """ユーザをストアに保存する形 (WSを除いたdict) にする。"""
+    return user.model_dump(exclude={"ws"})
+
+class SessionStore():
+    """
+    複数のワーカ/ノードで共有するセッションの状態。
+    - 登録済みでセッション未確立のユーザ (POST /v1 とWS接続を別のワーカが受けても引ける)
+    - 人間同士を組み合わせるロールごとの待ち行列
+    - ノード間のイベント (他のノードにあるWSへのMessageForwardedなど) の受け渡し
+    ユーザのWSを持つノードは、ユーザのnode_idに記録する。
+    registration_ttl秒経ってもWSを接続しない (node_idの無い) 登録は、無かったものとして削除する。
+    Redisなど別のサービスを使う場合は、このクラスを継承して同じメソッドを実装する。
+    """
+    backend = ""
+
+    def __init__(self, logger, node_id: Optional[str] = None, registration_ttl: float = 0):
+        self.logger = logger
+        self.node_id = node_id or new_node_id()
+        self.registration_ttl = registration_ttl
+        self.expired = 0
+        self.task: Optional[asyncio.Task] = None
+        self.published = 0
+        self.received = 0
+
+    # --- registered users ---
+    async def put_user(self, record: dict):
+        raise NotImplementedError
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def remove_user(self, user_id: str):
+        """ユーザを削除する。待ち行列からも外れる。"""
+        raise NotImplementedError
+
+    async def count_users(self, role: str) -> int:
+        """roleの登録済みのユーザ数。期限の切れた登録は数えない。"""
+        raise NotImplementedError
+
+    async def add_user(self, record: dict, limit: int) -> bool:
+        """
+        roleの登録済みのユーザがlimit人未満の場合だけ登録し、登録したかを返す。
+        数えてから登録するまでを、他のノードの登録と不可分に行う。
+        """
+        raise NotImplementedError
+
+    # --- waiting queue ---
+    async def enqueue(self, role: str, user_id: str):
+        raise NotImplementedError
+
+    async def dequeue(self, role: str) -> Optional[dict]:
+        """roleの待ち行列の先頭のユーザを取り出す。取り出しは全ノードで不可分に行う。"""
+        raise NotImplementedError
+
+    async def remove_queued(self, role: str, user_id: str) -> bool:
+        """待ち行列から外す。既に他から取り出されていた場合はFalse。"""
+        raise NotImplementedError
+
+    async def queued(self, role: str) -> List[dict]:
+        raise NotImplementedError
+
+    # --- events ---
+    async def publish(self, node_id: str, event: dict):
+        raise NotImplementedError
+
+    async def _receive(self, handler: EventHandler):
+        """このノード宛てのイベントを受け取り、handlerを呼び続ける。"""
+        raise NotImplementedError
+
+    async def send(self, user: UserDef, payload: Optional[dict] = None, close: bool = False, code: int = 1000):
+        """
+        userのWSにpayloadを送り、closeならWSを閉じる。
+        WSが他のノードにある場合は、そのノードへのsendイベントにする。
+        """
+        if user.ws is not None:
+            if payload is not None:
+                await user.ws.send_json(payload)
+            if close:
+                await user.ws.close(code=code)
+        elif user.node_id and user.node_id != self.node_id:
+            await self.publish(user.node_id, {
+                "type": "send", "user_id": user.user_id,
+                "payload": payload, "close": close, "code": code,
+            })
+
+    # --- lifecycle ---
+    def start(self, handler: EventHandler):
+        if self.task is None:
+            self.task = asyncio.create_task(self._receive(handler))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _dispatch(self, handler: EventHandler, event: dict):
+        self.received += 1
+        try:
+            await handler(event)
+        except Exception as e:
+            self.logger.error(f"Failed to handle session store event {event.get('type')}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "node_id": self.node_id,
+            "published": self.published,
+            "received": self.received,
+            "expired_registrations": self.expired,
+        }
+
+class InProcessSessionStore(SessionStore):
+    """1つのプロセスだけで使うストア。全てのユーザのWSが同じプロセスにある。"""
+    backend = "memory"
+
+    def __init__(self, logger, node_id: Optional[str] = None, registration_ttl: float = 0):
+        super().__init__(logger, node_id, registration_ttl)
+        self.users: Dict[str, dict] = {}
+        # role -> 登録済みのユーザ数。usersと一緒に更新する。
+        self.counts: Dict[str, int] = {}
+        # WSの接続を待っている登録。user_id -> 登録した時刻。登録順に並ぶ。
+        self.unattached: OrderedDict = OrderedDict()
+        # role -> (user_id -> None)。登録順に並ぶ。
+        self.queues: Dict[str, OrderedDict] = {}
+        self.events: asyncio.Queue = None
+
+    async def put_user(self, record: dict):
+        user_id = record["user_id"]
+        old = self.users.get(user_id)
+        if old is None or old["role"] != record["role"]:
+            if old is not None:
+                self.counts[old["role"]] -= 1
+            self.counts[record["role"]] = self.counts.get(record["role"], 0) + 1
+        self.users[user_id] = dict(record)
+        if record.get("node_id") is None:
+            self.unattached.setdefault(user_id, time.monotonic())
+        else:
+            self.unattached.pop(user_id, None)
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        self._expire()
+        record = self.users.get(user_id)
+        return dict(record) if record is not None else None
+
+    async def remove_user(self, user_id: str):
+        self.unattached.pop(user_id, None)
+        self._drop(user_id)
+
+    async def count_users(self, role: str) -> int:
+        self._expire()
+        return self.counts.get(role, 0)
+
+    async def add_user(self, record: dict, limit: int) -> bool:
+        self._expire()
+        if self.counts.get(record["role"], 0) >= limit:
+            return False
+        await self.put_user(record)
+        return True
+
+    def _drop(self, user_id: str):
+        record = self.users.pop(user_id, None)
+        if record is not None:
+            self.counts[record["role"]] -= 1
+            self.queues.get(record["role"], {}).pop(user_id, None)
+
+    def _expire(self):
+        """期限の切れた登録を、古い順に削除する。"""
+        if self.registration_ttl <= 0:
+            return
+        deadline = time.monotonic() - self.registration_ttl
+        while self.unattached:
+            user_id, registered_at = next(iter(self.unattached.items()))
+            if registered_at >= deadline:
+                break
+            self.unattached.popitem(last=False)
+            self._drop(user_id)
+            self.expired += 1
+
+    async def enqueue(self, role: str, user_id: str):
+        self.queues.setdefault(role, OrderedDict())[user_id] = None
+
+    async def dequeue(self, role: str) -> Optional[dict]:
+        queue = self.queues.get(role)
+        while queue:
+            user_id, _ = queue.popitem(last=False)
+            if user_id in self.users:
+                return dict(self.users[user_id])
+        return None
+
+    async def remove_queued(self, role: str, user_id: str) -> bool:
+        queue = self.queues.get(role)
+        return queue is not None and queue.pop(user_id, False) is None
+
+    async def queued(self, role: str) -> List[dict]:
+        queue = self.queues.get(role) or {}
+        return [dict(self.users[u]) for u in queue if u in self.users]
+
+    async def publish(self, node_id: str, event: dict):
+        if node_id != self.node_id:
+            self.logger.warning(f"Dropped an event for unknown node {node_id}: {event.get('type')}")
+            return
+        self.published += 1
+        await self._events().put(event)
+
+    def _events(self) -> asyncio.Queue:
+        if self.events is None:
+            self.events = asyncio.Queue()
+        return self.events
+
+    async def _receive(self, handler: EventHandler):
+        queue = self._events()
+        while True:
+            await self._dispatch(handler, await queue.get())
+
+class SQLiteSessionStore(SessionStore):
+    """
+    同じホストの複数のワーカで共有するSQLiteファイルのストア。
+    イベントはノードごとにテーブルに積み、各ノードがpoll_interval秒ごとに取り出す。
+    各ノードはイベントの取り出しのたびに生存時刻を更新し、node_ttl秒更新の無い
+    ノードのユーザとイベントは削除する。
+    """
+    backend = "sqlite"
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS store_users (user_id TEXT PRIMARY KEY, role TEXT NOT NULL,"
+        " node_id TEXT, record TEXT NOT NULL, registered_at REAL NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS ix_store_users_role ON store_users (role)",
+        "CREATE TABLE IF NOT EXISTS store_queue (seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " role TEXT NOT NULL, user_id TEXT NOT NULL UNIQUE)",
+        "CREATE TABLE IF NOT EXISTS store_events (seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " node_id TEXT NOT NULL, payload TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_store_events_node_id ON store_events (node_id)",
+        "CREATE TABLE IF NOT EXISTS store_nodes (node_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)",
+    )
+
+    def __init__(self, logger, path: str, poll_interval: float = 0.05, node_ttl: float = 10,
+                 node_id: Optional[str] = None, registration_ttl: float = 0):
+        super().__init__(logger, node_id, registration_ttl)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.node_ttl = node_ttl
+        self.conn = None
+        self.conn_lock = asyncio.Lock()
+
+    async def _connect(self):
+        async with self.conn_lock:
+            if self.conn is None:
+                import aiosqlite
+                # 自動コミットにし、書き込みはBEGIN IMMEDIATEで明示的に囲む
+                conn = await aiosqlite.connect(self.path, isolation_level=None)
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute("PRAGMA busy_timeout=5000")
+                for sql in self.SCHEMA:
+                    await conn.execute(sql)
+                async with conn.execute("PRAGMA table_info(store_users)") as cursor:
+                    columns = [r[1] for r in await cursor.fetchall()]
+                if "registered_at" not in columns:
+                    # registered_atの無い以前のファイル
+                    await conn.execute("ALTER TABLE store_users ADD COLUMN registered_at REAL NOT NULL DEFAULT 0")
+                await conn.execute("CREATE INDEX IF NOT EXISTS ix_store_users_unattached"
+                                   " ON store_users (registered_at) WHERE node_id IS NULL")
+                self.conn = conn
+        return self.conn
+
+    async def _execute(self, sql: str, params=()) -> List[tuple]:
+        conn = await self._connect()
+        async with conn.execute(sql, params) as cursor:
+            return list(await cursor.fetchall())
+
+    async def put_user(self, record: dict):
+        # 登録した時刻は最初の登録のものを残す
+        await self._execute(
+            "INSERT INTO store_users (user_id, role, node_id, record, registered_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (user_id) DO UPDATE SET role = excluded.role, node_id = excluded.node_id,"
+            " record = excluded.record",
+            (record["user_id"], record["role"], record.get("node_id"),
+             json.dumps(record, ensure_ascii=False), time.time()))
+
+    async def add_user(self, record: dict, limit: int) -> bool:
+        await self._expire()
+        # 数えることと登録を1つの文にし、同時に登録する他のワーカと合わせて上限を守る
+        rows = await self._execute(
+            "INSERT INTO store_users (user_id, role, node_id, record, registered_at)"
+            " SELECT ?, ?, ?, ?, ? WHERE (SELECT count(*) FROM store_users WHERE role = ?) < ?"
+            " RETURNING user_id",
+            (record["user_id"], record["role"], record.get("node_id"),
+             json.dumps(record, ensure_ascii=False), time.time(), record["role"], limit))
+        return bool(rows)
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        await self._expire()
+        rows = await self._execute("SELECT record FROM store_users WHERE user_id = ?", (user_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    async def _expire(self):
+        """期限の切れた登録を削除する。"""
+        if self.registration_ttl <= 0:
+            return
+        rows = await self._execute(
+            "DELETE FROM store_users WHERE node_id IS NULL AND registered_at < ? RETURNING user_id",
+            (time.time() - self.registration_ttl,))
+        if rows:
+            await self._execute(f"DELETE FROM store_queue WHERE user_id IN ({','.join('?' * len(rows))})",
+                                [r[0] for r in rows])
+            self.expired += len(rows)
+
+    async def remove_user(self, user_id: str):
+        await self._execute("DELETE FROM store_queue WHERE user_id = ?", (user_id,))
+        await self._execute("DELETE FROM store_users WHERE user_id = ?", (user_id,))
+
+    async def count_users(self, role: str) -> int:
+        await self._expire()
+        rows = await self._execute("SELECT count(*) FROM store_users WHERE role = ?", (role,))
+        return rows[0][0]
+
+    async def enqueue(self, role: str, user_id: str):
+        await self._execute("INSERT OR REPLACE INTO store_queue (role, user_id) VALUES (?, ?)", (role, user_id))
+
+    async def dequeue(self, role: str) -> Optional[dict]:
+        # 先頭を選んで削除するまでを1つの文で行うため、他のノードと同じユーザを取り合わない
+        rows = await self._execute(
+            "DELETE FROM store_queue WHERE seq = (SELECT q.seq FROM store_queue q"
+            " JOIN store_users u ON u.user_id = q.user_id"
+            " LEFT JOIN store_nodes n ON n.node_id = u.node_id"
+            " WHERE q.role = ? AND (u.node_id IS NULL OR n.seen_at >= ?)"
+            " ORDER BY q.seq LIMIT 1) RETURNING user_id",
+            (role, time.time() - self.node_ttl))
+        return await self.get_user(rows[0][0]) if rows else None
+
+    async def remove_queued(self, role: str, user_id: str) -> bool:
+        rows = await self._execute("DELETE FROM store_queue WHERE role = ? AND user_id = ? RETURNING seq",
+                                   (role, user_id))
+        return bool(rows)
+
+    async def queued(self, role: str) -> List[dict]:
+        rows = await self._execute(
+            "SELECT u.record FROM store_queue q JOIN store_users u ON u.user_id = q.user_id"
+            " WHERE q.role = ? ORDER BY q.seq", (role,))
+        return [json.loads(r[0]) for r in rows]
+
+    async def publish(self, node_id: str, event: dict):
+        self.published += 1
+        await self._execute("INSERT INTO store_events (node_id, payload) VALUES (?, ?)",
+                            (node_id, json.dumps(event, ensure_ascii=False)))
+
+    async def _heartbeat(self):
+        now = time.time()
+        await self._execute("INSERT OR REPLACE INTO store_nodes (node_id, seen_at) VALUES (?, ?)",
+                            (self.node_id, now))
+        # 応答の無くなったノード (異常終了したワーカなど) の状態を片付ける
+        dead = [r[0] for r in await self._execute(
+            "DELETE FROM store_nodes WHERE seen_at < ? RETURNING node_id", (now - self.node_ttl,))]
+        for node_id in dead:
+            self.logger.warning(f"Session store node {node_id} is not responding. Removing its users.")
+            await self._execute("DELETE FROM store_queue WHERE user_id IN"
+                                " (SELECT user_id FROM store_users WHERE node_id = ?)", (node_id,))
+            await self._execute("DELETE FROM store_users WHERE node_id = ?", (node_id,))
+            await self._execute("DELETE FROM store_events WHERE node_id = ?", (node_id,))
+
+    async def _receive(self, handler: EventHandler):
+        heartbeat_at = 0
+        while True:
+            try:
+                if time.monotonic() - heartbeat_at >= self.node_ttl / 3:
+                    await self._heartbeat()
+                    heartbeat_at = time.monotonic()
+                rows = await self._execute("DELETE FROM store_events WHERE node_id = ? RETURNING seq, payload",
+                                           (self.node_id,))
+            except Exception as e:
+                self.logger.error(f"Failed to poll the session store: {e}")
+                rows = []
+            # RETURNINGの順序は保証されないため、積まれた順に並べ直す
+            for _, payload in sorted(rows):
+                await self._dispatch(handler, json.loads(payload))
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+    async def stop(self):
+        await super().stop()
+        if self.conn is not None:
+            try:
+                await self._execute("DELETE FROM store_nodes WHERE node_id = ?", (self.node_id,))
+            except Exception as e:
+                self.logger.debug(f"Failed to unregister node {self.node_id}: {e}")
+            await self.conn.close()
+            self.conn = None
+
+def create_session_store(config) -> SessionStore:
+    """config.session_storeに応じたストアを作る。"""
+    if config.session_store == "memory":
+        return InProcessSessionStore(config.logger, registration_ttl=config.registration_ttl)
+    if config.session_store == "sqlite":
+        return SQLiteSessionStore(config.logger, config.session_store_path,
+                                  config.session_store_poll_interval, config.session_store_node_ttl,
+                                  registration_ttl=config.registration_ttl)
+    raise ValueError(f"未対応のsession_storeです: {config.session_store}")
@@ -0,0 +1,47 @@
+import time
+
+from cacheutil import LRUCache
+
+def test_evicts_the_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # aを参照したため、bが捨てられる
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.evictions == 1
+
+def test_put_replaces_and_refreshes():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 10)
+    cache.put("c", 3)
+    assert len(cache) == 2
+    assert cache.get("a") == 10 and "b" not in cache
+
+def test_ttl_expires_entries():
+    cache = LRUCache(10, ttl=0.01)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.02)
+    assert cache.get("a", "missing") == "missing"
+    assert "a" not in cache
+    assert cache.expirations == 1
+
+def test_zero_size_does_not_cache():
+    cache = LRUCache(0)
+    cache.put("a", 1)
+    assert cache.get("a") is None and len(cache) == 0
+
+def test_stats():
+    cache = LRUCache(10)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    assert cache.pop("a") == 1 and cache.pop("a", "gone") == "gone"
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["hit_ratio"] == 0.5 and stats["size"] == 0
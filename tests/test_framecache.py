@@ -0,0 +1,48 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from framecache import FrameCache
+
+def frame() -> pd.DataFrame:
+    return pd.DataFrame({
+        "患者ID": ["1", "2"],
+        "年齢": [70, 82],
+        # 数値と文字列の混在する列
+        "メモ": [1, "なし"],
+        datetime(2025, 4, 1): ["散歩", None],
+    })
+
+def test_round_trip(tmp_path):
+    cache = FrameCache(directory=str(tmp_path))
+    cache.save(frame(), "v1")
+    df = cache.load("v1")
+    assert list(df.columns) == ["患者ID", "年齢", "メモ", datetime(2025, 4, 1)]
+    assert df["患者ID"].tolist() == ["1", "2"]
+    assert df["年齢"].tolist() == [70, 82]
+    assert df[datetime(2025, 4, 1)].tolist()[0] == "散歩"
+
+def test_saving_a_version_removes_the_others(tmp_path):
+    cache = FrameCache(directory=str(tmp_path))
+    cache.save(frame(), "v1")
+    cache.save(frame(), "v2")
+    assert cache.load("v1") is None
+    assert cache.load("v2") is not None
+    assert os.listdir(tmp_path) == [os.path.basename(cache.path("v2"))]
+
+def test_other_prefixes_are_kept(tmp_path):
+    patients = FrameCache("patients", directory=str(tmp_path))
+    other = FrameCache("patients_extra", directory=str(tmp_path))
+    other.save(frame(), "v1")
+    patients.save(frame(), "v1")
+    patients.save(frame(), "v2")
+    assert other.load("v1") is not None
+
+def test_missing_version(tmp_path):
+    cache = FrameCache(directory=str(tmp_path))
+    assert cache.load(None) is None
+    assert cache.load("v1") is None
+
+def test_default_directory_is_outside_the_working_directory():
+    assert not FrameCache().path("v1").startswith(os.getcwd() + os.sep)
@@ -0,0 +1,77 @@
+import asyncio
+import gzip
+import json
+import os
+
+from historyarchive import INDEX_FILE, HistoryArchive
+from modelHistory import History, MessageInfo
+
+def history(*texts: str) -> History:
+    return History(history=[MessageInfo(role="患者", text=t) for t in texts])
+
+def test_read_uses_the_index_offsets(tmp_path):
+    async def main():
+        archive = HistoryArchive(str(tmp_path))
+        entries = [await archive.save(f"s{i}", history(f"こんにちは{i}", "はい")) for i in range(3)]
+        return archive, entries
+    archive, entries = asyncio.run(main())
+    # 同じシャードに連続して追記される
+    assert len({e["shard"] for e in entries}) == 1
+    assert [e["offset"] for e in entries] == [0, entries[0]["length"], entries[0]["length"] + entries[1]["length"]]
+    # 別のインスタンス (他のワーカ) からも索引で読める
+    reader = HistoryArchive(str(tmp_path))
+    assert reader.read("s1").history[0].text == "こんにちは1"
+    assert reader.read_record("s2")["session_id"] == "s2"
+    assert reader.read("missing") is None
+
+def test_shard_is_one_gzip_stream(tmp_path):
+    async def main():
+        archive = HistoryArchive(str(tmp_path))
+        return [await archive.save(f"s{i}", history("a")) for i in range(2)]
+    entries = asyncio.run(main())
+    with gzip.open(os.path.join(tmp_path, entries[0]["shard"]), "rt", encoding="utf-8") as fd:
+        assert [json.loads(line)["session_id"] for line in fd] == ["s0", "s1"]
+
+def test_later_save_wins(tmp_path):
+    async def main():
+        archive = HistoryArchive(str(tmp_path))
+        await archive.save("s", history("first"))
+        await archive.save("s", history("second"))
+    asyncio.run(main())
+    assert HistoryArchive(str(tmp_path)).read("s").history[0].text == "second"
+
+def test_reader_sees_saves_from_other_workers(tmp_path):
+    async def main():
+        reader = HistoryArchive(str(tmp_path))
+        writer = HistoryArchive(str(tmp_path))
+        await writer.save("s0", history("a"))
+        assert reader.read("s0") is not None
+        # readerは索引を読み込み済みだが、後から保存されたものも読み直して探す
+        await writer.save("s1", history("b"))
+        assert reader.read("s1").history[0].text == "b"
+    asyncio.run(main())
+
+def test_concurrent_saves_keep_offsets_consistent(tmp_path):
+    async def main():
+        archives = [HistoryArchive(str(tmp_path)) for _ in range(3)]
+        await asyncio.gather(*(a.save(f"s{w}-{i}", history(f"{w}-{i}" * (i + 1)))
+                               for w, a in enumerate(archives) for i in range(10)))
+    asyncio.run(main())
+    reader = HistoryArchive(str(tmp_path))
+    index = reader.load_index()
+    assert len(index) == 30
+    for session_id in index:
+        w_i = session_id[1:]
+        assert reader.read(session_id).history[0].text.startswith(w_i)
+    with open(os.path.join(tmp_path, INDEX_FILE), encoding="utf-8") as fd:
+        assert len(fd.readlines()) == 30
+
+def test_iter_histories_filters_by_day(tmp_path):
+    async def main():
+        archive = HistoryArchive(str(tmp_path))
+        return await archive.save("s", history("a"))
+    entry = asyncio.run(main())
+    day = entry["saved_at"][:10]
+    archive = HistoryArchive(str(tmp_path))
+    assert [s for s, _ in archive.iter_histories(date_from=day, date_to=day)] == ["s"]
+    assert list(archive.iter_histories(date_to="2000-01-01")) == []
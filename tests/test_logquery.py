@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from logquery import InvalidCursor, decode_cursor, encode_cursor, keyset_page, split_page
+from modelSession import Base, Session
+
+START = datetime(2025, 4, 1, tzinfo=timezone.utc)
+
+def test_cursor_round_trip():
+    created_at = datetime(2025, 4, 1, 9, 30, 15, 123456, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+    assert decode_cursor(encode_cursor(None, 7)) == (None, 7)
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", encode_cursor(START, 1)[:-3]])
+def test_invalid_cursor(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor)
+
+async def with_sessions(tmp_path, fn):
+    """20件のセッションを入れたSQLiteのDBでfn(db)を呼ぶ。created_atは2件ずつ同じ値にする。"""
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'logs.db'}")
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+        async with SessionLocal() as db:
+            db.add_all(Session(
+                session_id=f"s{i:02d}", user_name="u", patient_id="1",
+                user_role="保健師" if i % 2 else "患者",
+                created_at=START + timedelta(minutes=i // 2),
+            ) for i in range(20))
+            await db.commit()
+            return await fn(db)
+    finally:
+        await engine.dispose()
+
+async def read_pages(db, stmt, limit, descending):
+    pages, cursor = [], None
+    while True:
+        page = keyset_page(stmt, Session, cursor, limit, descending=descending)
+        rows, cursor = split_page((await db.execute(page)).scalars().all(), limit)
+        pages.append([row.session_id for row in rows])
+        if cursor is None:
+            return pages
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_pages_cover_every_row_once(tmp_path, descending):
+    async def read(db):
+        return await read_pages(db, select(Session), 3, descending)
+    pages = asyncio.run(with_sessions(tmp_path, read))
+    expected = [f"s{i:02d}" for i in range(20)]
+    if descending:
+        expected.reverse()
+    # 同じcreated_atの行もidで順番が決まり、ページの境目で欠けたり重なったりしない
+    assert [s for page in pages for s in page] == expected
+    assert [len(page) for page in pages] == [3] * 6 + [2]
+
+def test_pages_with_filter(tmp_path):
+    async def read(db):
+        return await read_pages(db, select(Session).where(Session.user_role == "患者"), 4, True)
+    pages = asyncio.run(with_sessions(tmp_path, read))
+    assert pages == [["s18", "s16", "s14", "s12"], ["s10", "s08", "s06", "s04"], ["s02", "s00"]]
+
+def test_last_full_page_has_no_cursor(tmp_path):
+    async def read(db):
+        page = keyset_page(select(Session), Session, None, 20, descending=True)
+        return split_page((await db.execute(page)).scalars().all(), 20)
+    rows, cursor = asyncio.run(with_sessions(tmp_path, read))
+    assert len(rows) == 20 and cursor is None
+
+def test_role_filter_uses_index(tmp_path):
+    async def plan(db):
+        stmt = keyset_page(select(Session).where(Session.user_role == "患者"),
+                           Session, encode_cursor(START, 5), 10, descending=True)
+        compiled = stmt.compile(db.bind, compile_kwargs={"literal_binds": True})
+        rows = await db.execute(text(f"EXPLAIN QUERY PLAN {compiled}"))
+        return " ".join(str(row[-1]) for row in rows)
+    detail = asyncio.run(with_sessions(tmp_path, plan))
+    assert f"ix_{Session.__tablename__}_user_role_created_at_id" in detail
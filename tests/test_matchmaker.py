@@ -0,0 +1,152 @@
+import asyncio
+import logging
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from matchmaker import Matchmaker, QueueFull
+from modelHistory import History
+from modelUserDef import UserDef
+from sessionregistry import APISession, SessionRegistry
+from sessionstore import InProcessSessionStore
+
+logger = logging.getLogger("test")
+
+class FakeWS():
+    def __init__(self):
+        self.sent = []
+        self.incoming = asyncio.Queue()
+
+    async def send_json(self, payload):
+        self.sent.append(payload)
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    def positions(self):
+        return [(m["position"], m["queue_size"]) for m in self.sent if m["msg_type"] == "QueuePosition"]
+
+def new_user(user_id: str, role: str) -> UserDef:
+    return UserDef(user_id=user_id, user_name=user_id, role=role, status="Registered")
+
+def new_matchmaker(max_queue_size: int = 10, registration_ttl: float = 0) -> Matchmaker:
+    store = InProcessSessionStore(logger, registration_ttl=registration_ttl)
+    return Matchmaker(SessionRegistry(), store, max_queue_size, logger)
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+async def connect(mm: Matchmaker, user_id: str, role: str) -> UserDef:
+    """登録してWSを接続したユーザを返す。"""
+    await mm.admit(new_user(user_id, role))
+    user = await mm.lookup(user_id)
+    await mm.attach(user, FakeWS())
+    return user
+
+def test_admit_rejects_when_the_queue_is_full():
+    async def main():
+        mm = new_matchmaker(max_queue_size=2)
+        await mm.admit(new_user("p1", "患者"))
+        await mm.admit(new_user("p2", "患者"))
+        with pytest.raises(QueueFull):
+            await mm.admit(new_user("p3", "患者"))
+        # 上限はロールごと
+        await mm.admit(new_user("n1", "保健師"))
+        assert mm.rejected == 1
+        # 抜けた分だけ受け付ける
+        await mm.leave("p1")
+        await mm.admit(new_user("p3", "患者"))
+    asyncio.run(main())
+
+def test_concurrent_admissions_respect_the_limit():
+    async def main():
+        mm = new_matchmaker(max_queue_size=5)
+
+        async def admit(i):
+            try:
+                await mm.admit(new_user(f"p{i}", "患者"))
+                return True
+            except QueueFull:
+                return False
+        results = await asyncio.gather(*(admit(i) for i in range(20)))
+        assert sum(results) == 5
+        assert await mm.store.count_users("患者") == 5
+    asyncio.run(main())
+
+def test_expired_registrations_are_not_counted():
+    async def main():
+        mm = new_matchmaker(max_queue_size=1, registration_ttl=0.01)
+        await mm.admit(new_user("p1", "患者"))
+        await asyncio.sleep(0.02)
+        # WSを接続しなかったp1は期限切れになり、枠が空く
+        await mm.admit(new_user("p2", "患者"))
+        assert await mm.store.get_user("p1") is None
+        assert mm.store.expired == 1
+    asyncio.run(main())
+
+def test_match_takes_the_longest_waiting_peer():
+    async def main():
+        mm = new_matchmaker()
+        patients = [await connect(mm, f"p{i}", "患者") for i in range(3)]
+        waits = []
+        for p in patients:
+            waits.append(asyncio.create_task(mm.wait_for_match(p)))
+            await settle()
+        # 並んだ時点の待ち順が知らされる
+        assert patients[0].ws.positions()[0] == (1, 1)
+        assert patients[2].ws.positions()[0] == (3, 3)
+
+        nurse = await connect(mm, "n1", "保健師")
+        peer = await mm.match(nurse)
+        assert peer.user_id == "p0"
+        session = APISession(users=[nurse, peer], history=History(), session_id="s1")
+        await mm.complete(nurse, peer, session)
+        assert (await waits[0]).session_id == "s1"
+        assert nurse.ws.sent[-1]["msg_type"] == "Established"
+
+        # 残りの待ち順は繰り上がる
+        await mm.notify_positions("患者")
+        assert patients[1].ws.positions()[-1] == (1, 2)
+        assert patients[2].ws.positions()[-1] == (2, 2)
+        for task in waits[1:]:
+            task.cancel()
+        await asyncio.gather(*waits[1:], return_exceptions=True)
+    asyncio.run(main())
+
+def test_match_without_waiting_peer():
+    async def main():
+        mm = new_matchmaker()
+        nurse = await connect(mm, "n1", "保健師")
+        assert await mm.match(nurse) is None
+    asyncio.run(main())
+
+def test_wait_for_match_times_out():
+    async def main():
+        mm = new_matchmaker()
+        patient = await connect(mm, "p1", "患者")
+        assert await mm.wait_for_match(patient, timeout=0.01) is None
+        assert await mm.store.queued("患者") == []
+        nurse = await connect(mm, "n1", "保健師")
+        assert await mm.match(nurse) is None
+    asyncio.run(main())
+
+def test_disconnect_while_waiting_leaves_the_queue():
+    async def main():
+        mm = new_matchmaker()
+        p1 = await connect(mm, "p1", "患者")
+        p2 = await connect(mm, "p2", "患者")
+        wait1 = asyncio.create_task(mm.wait_for_match(p1))
+        wait2 = asyncio.create_task(mm.wait_for_match(p2))
+        await settle()
+        p1.ws.incoming.put_nowait({"type": "websocket.disconnect", "code": 1001})
+        with pytest.raises(WebSocketDisconnect):
+            await wait1
+        await mm.leave("p1")
+        assert [r["user_id"] for r in await mm.store.queued("患者")] == ["p2"]
+        assert p2.ws.positions()[-1] == (1, 1)
+        nurse = await connect(mm, "n1", "保健師")
+        assert (await mm.match(nurse)).user_id == "p2"
+        wait2.cancel()
+        await asyncio.gather(wait2, return_exceptions=True)
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+import httpx
+import openai
+
+from chatconf import ChatConfigModel
+from modelUserDef import AssistantDef
+from openai_assistant import OpenAIAssistantWrapper
+from openai_fake import FakeRunStream
+
+logger = logging.getLogger("test")
+
+def new_wrapper(**kwargs) -> OpenAIAssistantWrapper:
+    config = ChatConfigModel(
+        server_cert=None, log_file="", assistants_storage="", logger=logger,
+        openai_backend="fake", fake_latency_ms=0, fake_request_latency_ms=0,
+        fake_seed=1, openai_backoff_base=0.001, **kwargs)
+    return OpenAIAssistantWrapper(config)
+
+async def new_assistant(oaw: OpenAIAssistantWrapper) -> AssistantDef:
+    thread_id = await oaw.create_thread("s")
+    return AssistantDef(user_id="ai", role="患者", assistant_id="asst_fake", thread_id=thread_id)
+
+class DroppedStream(FakeRunStream):
+    """eventを返した後に接続が切れるストリーム。実際のAPIと同じく、runはサーバで動き続ける。"""
+    def __init__(self, backend, params: dict, event: str):
+        super().__init__(backend, params)
+        self.event = event
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def _events(self):
+        async for event in super()._events():
+            yield event
+            if event.event == self.event:
+                raise openai.APIConnectionError(request=httpx.Request("POST", "http://fake"))
+
+def drop_first_stream(oaw: OpenAIAssistantWrapper, event: str) -> list:
+    """最初のruns.stream()を、eventの後で切れるストリームにする。呼び出しの記録を返す。"""
+    runs = oaw.client.beta.threads.runs
+    stream = runs.stream
+    calls = []
+
+    def dropping(**params):
+        calls.append(params)
+        if len(calls) == 1:
+            return DroppedStream(runs.backend, params, event)
+        return stream(**params)
+    runs.stream = dropping
+    return calls
+
+def thread_runs(oaw: OpenAIAssistantWrapper, assistant: AssistantDef):
+    return list(oaw.client.backend.threads[assistant.thread_id].runs.values())
+
+def test_stream_is_not_retried_after_a_delta():
+    async def main():
+        oaw = new_wrapper()
+        assistant = await new_assistant(oaw)
+        calls = drop_first_stream(oaw, "thread.message.delta")
+        deltas = []
+
+        async def on_delta(text):
+            deltas.append(text)
+        response, tool_call = await oaw.stream_message(assistant, "こんにちは", on_delta)
+        assert response.startswith("FAILED:")
+        assert tool_call is None
+        assert len(calls) == 1
+        assert len(deltas) == 1
+        # 途切れたrunは止めてあり、次のメッセージを送れる
+        assert [r.status for r in thread_runs(oaw, assistant)] == ["cancelled"]
+        response, _ = await oaw.stream_message(assistant, "もう一度", on_delta)
+        assert not response.startswith("FAILED:")
+    asyncio.run(main())
+
+def test_stream_is_retried_before_a_delta():
+    async def main():
+        oaw = new_wrapper(fake_stream_chunks=1)
+        assistant = await new_assistant(oaw)
+        calls = drop_first_stream(oaw, "thread.run.in_progress")
+        deltas = []
+
+        async def on_delta(text):
+            deltas.append(text)
+        response, _ = await oaw.stream_message(assistant, "こんにちは", on_delta)
+        assert len(calls) == 2
+        # 前の試行のrunを止めてから作り直すため、400にならない
+        assert [r.status for r in thread_runs(oaw, assistant)] == ["cancelled", "completed"]
+        assert response == "".join(deltas)
+    asyncio.run(main())
+
+def test_send_message_without_adding_the_message():
+    async def main():
+        oaw = new_wrapper()
+        assistant = await new_assistant(oaw)
+        added = []
+        await oaw.send_message(assistant, "こんにちは", on_added=lambda: added.append(1))
+        response, _ = await oaw.send_message(assistant, "こんにちは", add_message=False,
+                                             on_added=lambda: added.append(2))
+        assert not response.startswith("FAILED:")
+        assert added == [1]
+        messages = oaw.client.backend.threads[assistant.thread_id].messages
+        assert [m.role for m in messages] == ["user", "assistant", "assistant"]
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from time import monotonic
+
+import openai
+import pytest
+
+from openai_fake import _error
+from openai_scheduler import OpenAIScheduler, TokenBucket
+
+logger = logging.getLogger("test")
+
+def new_scheduler(max_concurrency=1, rpm=0, tpm=0, max_retries=3) -> OpenAIScheduler:
+    return OpenAIScheduler(max_concurrency, rpm, tpm, 1000, max_retries, 0.001, 0.01, logger)
+
+def rate_limit_error(retry_after_ms=None):
+    headers = {"retry-after-ms": str(retry_after_ms)} if retry_after_ms is not None else None
+    return _error(openai.RateLimitError, 429, "Rate limit reached (test).", headers)
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+def test_token_bucket():
+    bucket = TokenBucket(60)
+    now = bucket.updated_at
+    assert bucket.delay(60, now) == 0
+    bucket.take(60)
+    # 毎秒1ずつ補充される
+    assert bucket.delay(1, now) == pytest.approx(1)
+    assert bucket.delay(1, now + 0.5) == pytest.approx(0.5)
+    # 容量より多い量は、容量まで溜まれば取り出せる
+    assert bucket.delay(600, now + 0.5) == pytest.approx(59.5)
+    assert TokenBucket(0).delay(10 ** 9, now) == 0
+
+async def run_jobs(scheduler, jobs):
+    """jobsの (key, background) の順に並べ、枠を受け取った順を返す。"""
+    order = []
+    gate = asyncio.Event()
+
+    async def job(name, key, background):
+        async with scheduler.slot(key, background=background):
+            order.append(name)
+            await gate.wait()
+
+    # 最初の1つが枠を持っている間に残りを並べる
+    tasks = [asyncio.create_task(job(*j)) for j in jobs]
+    await settle()
+    gate.set()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_round_robin_between_keys():
+    async def main():
+        order = await run_jobs(new_scheduler(), [
+            ("a1", "a", False), ("a2", "a", False), ("a3", "a", False),
+            ("b1", "b", False), ("c1", "c", False),
+        ])
+        assert order == ["a1", "a2", "b1", "c1", "a3"]
+    asyncio.run(main())
+
+def test_background_waits_for_other_keys():
+    async def main():
+        order = await run_jobs(new_scheduler(), [
+            ("a1", "a", False), ("p1", "pool", True), ("p2", "pool", True),
+            ("b1", "b", False), ("a2", "a", False),
+        ])
+        assert order == ["a1", "b1", "a2", "p1", "p2"]
+    asyncio.run(main())
+
+def test_cancelled_waiter_is_skipped():
+    async def main():
+        scheduler = new_scheduler()
+        gate = asyncio.Event()
+        order = []
+
+        async def job(name, key):
+            async with scheduler.slot(key):
+                order.append(name)
+                await gate.wait()
+        first = asyncio.create_task(job("a1", "a"))
+        cancelled = asyncio.create_task(job("b1", "b"))
+        last = asyncio.create_task(job("c1", "c"))
+        await settle()
+        cancelled.cancel()
+        await settle()
+        gate.set()
+        await asyncio.gather(first, last)
+        assert order == ["a1", "c1"]
+        assert scheduler.running == 0 and scheduler.waiting == 0
+    asyncio.run(main())
+
+def test_request_bucket_delays_slots():
+    async def main():
+        # 毎分600リクエスト = 0.1秒に1つ。容量を使い切った後の1つを待つ
+        scheduler = new_scheduler(max_concurrency=0, rpm=600)
+        async with scheduler.slot("a", requests=600):
+            pass
+        started = monotonic()
+        async with scheduler.slot("b"):
+            waited = monotonic() - started
+        assert 0.05 < waited < 1
+    asyncio.run(main())
+
+def test_call_retries_rate_limit_and_pauses():
+    async def main():
+        scheduler = new_scheduler()
+        errors = [rate_limit_error(retry_after_ms=50)]
+
+        async def fn():
+            if errors:
+                raise errors.pop()
+            return "ok"
+        started = monotonic()
+        assert await scheduler.call(fn) == "ok"
+        # retry-after-msの間、全体の受付を止める
+        assert monotonic() - started >= 0.05
+        assert scheduler.paused_until >= started + 0.05
+        assert scheduler.retries == 1 and scheduler.rate_limited == 1
+    asyncio.run(main())
+
+def test_call_gives_up_after_max_retries():
+    async def main():
+        scheduler = new_scheduler(max_retries=2)
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            raise rate_limit_error()
+        with pytest.raises(openai.RateLimitError):
+            await scheduler.call(fn)
+        assert len(calls) == 3
+        assert scheduler.retries == 2 and scheduler.rate_limited == 3
+    asyncio.run(main())
+
+def test_call_retries_rate_limited_results():
+    async def main():
+        scheduler = new_scheduler()
+        results = ["ok", "rate_limited"]
+
+        async def fn():
+            return results.pop()
+        assert await scheduler.call(fn, rate_limited=lambda r: r == "rate_limited") == "ok"
+        assert scheduler.retries == 1 and scheduler.rate_limited == 1
+    asyncio.run(main())
+
+def test_call_does_not_retry_other_errors():
+    async def main():
+        scheduler = new_scheduler()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            raise _error(openai.BadRequestError, 400, "Bad request (test).")
+        with pytest.raises(openai.BadRequestError):
+            await scheduler.call(fn)
+        assert len(calls) == 1 and scheduler.retries == 0
+    asyncio.run(main())
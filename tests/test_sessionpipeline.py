@@ -0,0 +1,207 @@
+import asyncio
+import logging
+
+from modelChat import MessageSubmitted
+from sessionpipeline import FINAL, INLINE, JOB, MessageBatch, SessionPipeline, SessionState
+
+logger = logging.getLogger("test")
+
+class FakeWS():
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    async def receive_json(self):
+        return await self.queue.get()
+
+def message(text: str) -> dict:
+    return MessageSubmitted(session_id="s", user_id="u", user_msg=text).model_dump()
+
+def control(msg_type: str) -> dict:
+    return {"msg_type": msg_type}
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+class Recorder():
+    """on_messagesの呼び出しを記録する。blockのEventが立つまで、その回の処理を止める。"""
+    def __init__(self):
+        self.batches = []
+        self.block = {}
+        self.result = {}
+
+    async def __call__(self, batch: MessageBatch):
+        self.batches.append(batch)
+        n = len(self.batches)
+        batch.recorded = len(batch.messages)
+        if n in self.block:
+            await self.block[n].wait()
+        batch.done = True
+        return self.result.get(n)
+
+    def texts(self):
+        return [[m.user_msg for m in b.messages] for b in self.batches]
+
+async def start(handler, **kwargs):
+    ws = FakeWS()
+    pipeline = SessionPipeline(ws, logger, handler, **kwargs)
+    ended = []
+    async def on_end(data):
+        ended.append(data)
+    pipeline.add_control("EndSessionRequest", on_end, FINAL)
+    task = asyncio.create_task(pipeline.run())
+    return ws, pipeline, task, ended
+
+async def finish(ws, task):
+    await ws.queue.put(control("EndSessionRequest"))
+    await asyncio.wait_for(task, 1)
+
+def test_coalesces_messages_received_while_running():
+    async def main():
+        handler = Recorder()
+        handler.block[1] = asyncio.Event()
+        ws, pipeline, task, _ = await start(handler)
+        await ws.queue.put(message("a"))
+        await settle()
+        for text in ("b", "c"):
+            await ws.queue.put(message(text))
+        await settle()
+        assert pipeline.state == SessionState.Running
+        handler.block[1].set()
+        await settle()
+        assert handler.texts() == [["a"], ["b", "c"]]
+        assert pipeline.coalesced == 1
+        await finish(ws, task)
+    asyncio.run(main())
+
+def test_without_coalesce_processes_one_by_one():
+    async def main():
+        handler = Recorder()
+        handler.block[1] = asyncio.Event()
+        ws, pipeline, task, _ = await start(handler, coalesce=False)
+        for text in ("a", "b", "c"):
+            await ws.queue.put(message(text))
+        await settle()
+        handler.block[1].set()
+        await settle()
+        assert handler.texts() == [["a"], ["b"], ["c"]]
+        await finish(ws, task)
+    asyncio.run(main())
+
+def test_overflow_rejects_messages():
+    async def main():
+        handler = Recorder()
+        handler.block[1] = asyncio.Event()
+        ws, pipeline, task, _ = await start(handler, max_pending=1)
+        rejected = []
+        async def on_overflow(m):
+            rejected.append(m.user_msg)
+        pipeline.on_overflow = on_overflow
+        await ws.queue.put(message("a"))
+        await settle()
+        for text in ("b", "c"):
+            await ws.queue.put(message(text))
+        await settle()
+        assert rejected == ["c"]
+        assert pipeline.rejected == 1
+        handler.block[1].set()
+        await settle()
+        assert handler.texts() == [["a"], ["b"]]
+        await finish(ws, task)
+    asyncio.run(main())
+
+def test_inline_preempt_retries_the_same_batch_first():
+    async def main():
+        handler = Recorder()
+        handler.block[1] = asyncio.Event()
+        ws, pipeline, task, _ = await start(handler)
+        continued = []
+        async def on_continue(data):
+            continued.append(data)
+        pipeline.add_control("ContinueConversationRequest", on_continue, INLINE)
+        await ws.queue.put(message("a"))
+        await settle()
+        await ws.queue.put(message("b"))
+        await ws.queue.put(control("ContinueConversationRequest"))
+        await settle()
+        assert len(continued) == 1
+        # 取り消した発言は後から届いた発言とまとめず、記録を保ったまま処理し直す
+        assert handler.texts() == [["a"], ["a"], ["b"]]
+        assert handler.batches[1] is handler.batches[0]
+        assert handler.batches[1].recorded == 1
+        assert pipeline.preempted == 1 and pipeline.requeued == 1
+        await finish(ws, task)
+    asyncio.run(main())
+
+def test_inline_preempt_does_not_retry_a_done_batch():
+    async def main():
+        async def handler(batch):
+            batch.done = True
+            await asyncio.Event().wait()
+        ws, pipeline, task, _ = await start(handler)
+        async def on_continue(data):
+            pass
+        pipeline.add_control("ContinueConversationRequest", on_continue, INLINE)
+        await ws.queue.put(message("a"))
+        await settle()
+        await ws.queue.put(control("ContinueConversationRequest"))
+        await settle()
+        assert pipeline.preempted == 1 and pipeline.requeued == 0
+        assert pipeline.state == SessionState.Idle
+        await finish(ws, task)
+    asyncio.run(main())
+
+def test_job_preempt_drops_pending_messages():
+    async def main():
+        handler = Recorder()
+        handler.block[1] = asyncio.Event()
+        ws, pipeline, task, _ = await start(handler)
+        debriefed = asyncio.Event()
+        async def on_debriefing(data):
+            assert pipeline.state == SessionState.Debriefing
+            debriefed.set()
+        pipeline.add_control("DebriefingRequest", on_debriefing, JOB, SessionState.Debriefing)
+        await ws.queue.put(message("a"))
+        await settle()
+        await ws.queue.put(message("b"))
+        await ws.queue.put(control("DebriefingRequest"))
+        await asyncio.wait_for(debriefed.wait(), 1)
+        await settle()
+        assert handler.texts() == [["a"]]
+        assert pipeline.state == SessionState.Idle
+        assert pipeline.stats()["pending"] == 0
+        await finish(ws, task)
+    asyncio.run(main())
+
+def test_awaiting_action_holds_messages_until_a_control():
+    async def main():
+        handler = Recorder()
+        handler.result[1] = SessionState.AwaitingAction
+        ws, pipeline, task, _ = await start(handler)
+        async def on_continue(data):
+            pass
+        pipeline.add_control("ContinueConversationRequest", on_continue, INLINE)
+        await ws.queue.put(message("a"))
+        await settle()
+        await ws.queue.put(message("b"))
+        await settle()
+        assert pipeline.state == SessionState.AwaitingAction
+        assert handler.texts() == [["a"]]
+        await ws.queue.put(control("ContinueConversationRequest"))
+        await settle()
+        assert handler.texts() == [["a"], ["b"]]
+        await finish(ws, task)
+    asyncio.run(main())
+
+def test_final_control_ends_the_pipeline():
+    async def main():
+        handler = Recorder()
+        handler.block[1] = asyncio.Event()
+        ws, pipeline, task, ended = await start(handler)
+        await ws.queue.put(message("a"))
+        await settle()
+        await finish(ws, task)
+        assert len(ended) == 1
+        assert pipeline.state == SessionState.Closed
+        assert pipeline.job.cancelled()
+    asyncio.run(main())
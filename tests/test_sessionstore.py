@@ -0,0 +1,122 @@
+import asyncio
+import logging
+
+import pytest
+
+from sessionstore import InProcessSessionStore, SQLiteSessionStore
+
+logger = logging.getLogger("test")
+
+@pytest.fixture(params=["memory", "sqlite"])
+def new_store(request, tmp_path):
+    """同じ共有状態を使うストアを作る関数。sqliteでは呼ぶたびに別のノードになる。"""
+    memory = InProcessSessionStore(logger)
+
+    def new_store(**kwargs):
+        if request.param == "memory":
+            if kwargs:
+                return InProcessSessionStore(logger, **kwargs)
+            return memory
+        return SQLiteSessionStore(logger, str(tmp_path / "store.db"), poll_interval=0.01, **kwargs)
+    return new_store
+
+def record(user_id: str, role: str = "患者", node_id=None) -> dict:
+    return {"user_id": user_id, "user_name": user_id, "role": role, "status": "Registered", "node_id": node_id}
+
+def test_add_user_respects_the_limit(new_store):
+    async def main():
+        store = new_store()
+        assert await store.add_user(record("p1"), 2)
+        assert await store.add_user(record("p2"), 2)
+        assert not await store.add_user(record("p3"), 2)
+        assert await store.add_user(record("n1", "保健師"), 2)
+        assert await store.count_users("患者") == 2
+        assert await store.get_user("p3") is None
+        await store.remove_user("p1")
+        assert await store.add_user(record("p3"), 2)
+        await store.stop()
+    asyncio.run(main())
+
+def test_concurrent_add_user_across_nodes(new_store):
+    async def main():
+        stores = [new_store() for _ in range(4)]
+
+        async def admit(store, w):
+            return [await store.add_user(record(f"p{w}-{i}"), 10) for i in range(10)]
+        results = await asyncio.gather(*(admit(s, w) for w, s in enumerate(stores)))
+        assert sum(sum(r) for r in results) == 10
+        assert await stores[0].count_users("患者") == 10
+        for store in stores:
+            await store.stop()
+    asyncio.run(main())
+
+def test_put_user_keeps_the_count(new_store):
+    async def main():
+        store = new_store()
+        await store.put_user(record("p1"))
+        await store.put_user(record("p1", node_id=store.node_id))
+        assert await store.count_users("患者") == 1
+        assert (await store.get_user("p1"))["node_id"] == store.node_id
+        await store.put_user(record("p1", "保健師", node_id=store.node_id))
+        assert await store.count_users("患者") == 0
+        assert await store.count_users("保健師") == 1
+        await store.stop()
+    asyncio.run(main())
+
+def test_queue_is_fifo_and_dequeued_once(new_store):
+    async def main():
+        a, b = new_store(), new_store()
+        for i in range(3):
+            await a.put_user(record(f"p{i}"))
+            await a.enqueue("患者", f"p{i}")
+        assert [r["user_id"] for r in await b.queued("患者")] == ["p0", "p1", "p2"]
+        assert await b.remove_queued("患者", "p1")
+        assert not await a.remove_queued("患者", "p1")
+        taken = await asyncio.gather(a.dequeue("患者"), b.dequeue("患者"), a.dequeue("患者"))
+        assert sorted(r["user_id"] for r in taken if r) == ["p0", "p2"]
+        assert taken.count(None) == 1
+        await a.stop()
+        await b.stop()
+    asyncio.run(main())
+
+def test_unattached_registrations_expire(new_store):
+    async def main():
+        store = new_store(registration_ttl=0.05)
+        await store.put_user(record("p1"))
+        await store.put_user(record("p2"))
+        await store.enqueue("患者", "p1")
+        await store.put_user(record("p2", node_id=store.node_id))
+        await asyncio.sleep(0.1)
+        # WSを接続したp2は残る
+        assert await store.get_user("p1") is None
+        assert await store.get_user("p2") is not None
+        assert await store.count_users("患者") == 1
+        assert await store.queued("患者") == []
+        assert store.expired == 1
+        await store.stop()
+    asyncio.run(main())
+
+def test_events_reach_the_target_node(tmp_path):
+    async def main():
+        path = str(tmp_path / "store.db")
+        a = SQLiteSessionStore(logger, path, poll_interval=0.01)
+        b = SQLiteSessionStore(logger, path, poll_interval=0.01)
+        received = {"a": [], "b": []}
+
+        def handler(name):
+            async def handle(event):
+                received[name].append(event)
+            return handle
+        a.start(handler("a"))
+        b.start(handler("b"))
+        for i in range(3):
+            await a.publish(b.node_id, {"type": "test", "n": i})
+        for _ in range(100):
+            if len(received["b"]) == 3:
+                break
+            await asyncio.sleep(0.01)
+        assert [e["n"] for e in received["b"]] == [0, 1, 2]
+        assert received["a"] == []
+        await a.stop()
+        await b.stop()
+    asyncio.run(main())